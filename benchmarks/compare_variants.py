@@ -0,0 +1,139 @@
+"""Compares the source trees in src/ with the same benchmarks.
+
+Every source tree is benchmarked by run_benchmarks.py in a process of its own,
+with the same stand-in SDK modules, stub app and parameters. The median of
+every metric is then printed side by side, with the change from the baseline
+tree, to spot a tree that regresses startup before rolling out an SDK upgrade.
+
+Usage:
+  python benchmarks/compare_variants.py [--variants a,b] [--baseline a]
+      [--output comparison.json] [run_benchmarks.py options]
+
+Options not listed by --help are passed on to run_benchmarks.py, e.g.
+--scenarios cold_start,warm_restart,requirements_reload,shutdown.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+import run_benchmarks
+
+_SRC_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+
+# Version 1 of the comparison is a JSON object with:
+#   schema, schema_version: 'devappserver-variant-comparison', 1.
+#   baseline: The name of the source tree the others are compared with.
+#   variants: The names of the source trees in the order they ran.
+#   medians: An object with a key for each metric, whose value maps the name
+#     of every source tree to the median of the metric, or null if its
+#     scenario failed.
+#   runs: An object mapping the name of every source tree to the results of
+#     run_benchmarks.py (see run_benchmarks.RESULTS_SCHEMA_VERSION), or to
+#     {"error": message} if it didn't write any.
+COMPARISON_SCHEMA = 'devappserver-variant-comparison'
+COMPARISON_SCHEMA_VERSION = 1
+
+
+def _RunVariant(variant, benchmark_args):
+  """Benchmarks a source tree in a new process and returns its results."""
+  fd, output = tempfile.mkstemp(prefix='devappserver-bench-', suffix='.json')
+  os.close(fd)
+  try:
+    returncode = subprocess.call(
+        [sys.executable, run_benchmarks.__file__, '--variant', variant,
+         '--output', output] + benchmark_args)
+    with open(output) as f:
+      content = f.read()
+    if not content:
+      return {'error': 'run_benchmarks.py exited with %d' % returncode}
+    return json.loads(content)
+  finally:
+    os.remove(output)
+
+
+def _Medians(runs, variants):
+  medians = {}
+  for metric in (m for ms in run_benchmarks.SCENARIOS.values() for m in ms):
+    values = {
+        variant: runs[variant].get('results', {}).get(metric, {}).get('median')
+        for variant in variants}
+    if any(metric in runs[variant].get('results', {})
+           for variant in variants):
+      medians[metric] = values
+  return medians
+
+
+def _FormatTable(medians, variants, baseline):
+  """Returns the medians as a text table, with the change from baseline."""
+  rows = [['metric'] + variants]
+  for metric, values in medians.items():
+    unit = run_benchmarks.METRIC_UNITS.get(metric, 's')
+    row = ['%s (%s)' % (metric, unit)]
+    for variant in variants:
+      value = values[variant]
+      if value is None:
+        row.append('failed')
+        continue
+      cell = '%.4g' % value
+      base = values[baseline]
+      if variant != baseline and base:
+        cell += ' (%+.0f%%)' % ((value - base) * 100.0 / base)
+      row.append(cell)
+    rows.append(row)
+  widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+  return '\n'.join(
+      '  '.join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip()
+      for row in rows) + '\n'
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(
+      description='Compares the source trees in src/ with the same '
+      'benchmarks. Other options are passed on to run_benchmarks.py.')
+  parser.add_argument(
+      '--variants',
+      help='Comma separated source trees to compare (default: all of src/).')
+  parser.add_argument(
+      '--baseline',
+      help='The source tree the others are compared with (default: the '
+      'first one).')
+  parser.add_argument(
+      '--output', help='The file to write the comparison to as JSON.')
+  options, benchmark_args = parser.parse_known_args(argv)
+  variants = (options.variants.split(',') if options.variants
+              else sorted(os.listdir(_SRC_DIR)))
+  baseline = options.baseline or variants[0]
+  if baseline not in variants:
+    parser.error('the baseline %s is not compared' % baseline)
+
+  runs = {}
+  for variant in variants:
+    sys.stderr.write('Benchmarking %s\n' % variant)
+    runs[variant] = _RunVariant(variant, benchmark_args)
+  medians = _Medians(runs, variants)
+
+  sys.stdout.write(_FormatTable(medians, variants, baseline))
+  if options.output:
+    with open(options.output, 'w') as f:
+      json.dump({
+          'schema': COMPARISON_SCHEMA,
+          'schema_version': COMPARISON_SCHEMA_VERSION,
+          'baseline': baseline,
+          'variants': variants,
+          'medians': medians,
+          'runs': runs,
+      }, f, indent=2, sort_keys=True)
+      f.write('\n')
+  failed = any(
+      'error' in run or
+      any('error' in result for result in run['results'].values())
+      for run in runs.values())
+  return 1 if failed else 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,5 @@
+"""Stand-ins for the Cloud SDK modules the patched files import.
+
+Only what instance_factory.py and http_runtime.py use is implemented, closely
+enough to the SDK for the benchmarks to exercise the real code paths.
+"""
@@ -0,0 +1,40 @@
+"""Minimal stand-in for the vendored six module."""
+
+PY2 = False
+PY3 = True
+string_types = (str,)
+
+
+def ensure_str(s, encoding='utf-8', errors='strict'):
+  if isinstance(s, bytes):
+    return s.decode(encoding, errors)
+  return s
+
+
+ensure_text = ensure_str
+
+
+def ensure_binary(s, encoding='utf-8', errors='strict'):
+  if isinstance(s, str):
+    return s.encode(encoding, errors)
+  return s
+
+
+def b(s):
+  return s.encode('latin-1')
+
+
+def iteritems(d):
+  return iter(d.items())
+
+
+class _Moves(object):
+  """Subset of six.moves."""
+
+  import http.client as http_client
+  import queue
+  import urllib
+
+
+import urllib.parse  # pylint: disable=g-import-not-at-top,unused-import
+moves = _Moves()
@@ -0,0 +1,14 @@
+"""Minimal stand-in for google.appengine.api.appinfo."""
+
+LOGIN_ADMIN = 'admin'
+LOGIN_OPTIONAL = 'optional'
+
+
+class URLMap(object):
+
+  def __init__(self, url=None, script=None, login=LOGIN_OPTIONAL, **kwargs):
+    self.url = url
+    self.script = script
+    self.login = login
+    for k, v in kwargs.items():
+      setattr(self, k, v)
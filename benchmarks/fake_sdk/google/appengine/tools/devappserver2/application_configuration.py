@@ -0,0 +1,9 @@
+"""Minimal stand-in for application_configuration."""
+
+ENTRYPOINT_ADDED = 'entrypoint_added'
+ENTRYPOINT_REMOVED = 'entrypoint_removed'
+
+
+def get_app_error_file(module_configuration):
+  del module_configuration
+  return None
@@ -0,0 +1,9 @@
+"""Minimal stand-in for devappserver2 errors."""
+
+
+class Error(Exception):
+  pass
+
+
+class Python3NotFoundError(Error):
+  pass
@@ -0,0 +1,120 @@
+"""Minimal stand-in for devappserver2 http_proxy (mirrors the SDK flow)."""
+import contextlib
+import http.client as http_client
+import logging
+import socket
+import time
+import urllib.parse
+import wsgiref.headers
+
+from google.appengine.tools.devappserver2 import http_runtime_constants
+from google.appengine.tools.devappserver2 import instance
+from google.appengine.tools.devappserver2 import login
+from google.appengine.tools.devappserver2 import util
+
+
+class HttpProxy(object):
+  """Forwards HTTP requests to an application instance."""
+
+  def __init__(self, host, port, instance_died_unexpectedly,
+               instance_logs_getter, error_handler_file, prior_error=None,
+               request_id_header_name=None):
+    self._host = host
+    self._port = port
+    self._instance_died_unexpectedly = instance_died_unexpectedly
+    self._instance_logs_getter = instance_logs_getter
+    self._error_handler_file = error_handler_file
+    self._prior_error = prior_error
+    self.request_id_header_name = (
+        request_id_header_name or http_runtime_constants.REQUEST_ID_HEADER)
+
+  def _respond_with_error(self, message, start_response):
+    instance_logs = self._instance_logs_getter()
+    if instance_logs:
+      message += '\n\n' + str(instance_logs)
+    start_response('500 Internal Server Error',
+                   [('Content-Type', 'text/plain'),
+                    ('Content-Length', str(len(message)))])
+    return message.encode('utf-8')
+
+  def wait_for_connection(self, process=None, retries=100000):
+    if self._prior_error:
+      return
+    for _ in range(retries):
+      if process is not None and process.poll() is not None:
+        self._prior_error = 'instance exited with %r' % process.poll()
+        return
+      connection = http_client.HTTPConnection(self._host, self._port)
+      try:
+        connection.connect()
+      except (socket.error, http_client.HTTPException):
+        time.sleep(.1)
+      else:
+        connection.close()
+        break
+    else:
+      self._prior_error = 'cannot connect to instance'
+
+  def handle(self, environ, start_response, url_map, match, request_id,
+             request_type):
+    if self._prior_error:
+      logging.error(self._prior_error)
+      yield self._respond_with_error(self._prior_error, start_response)
+      return
+    del match, request_type
+    headers = util.get_headers_from_environ(environ)
+    if environ.get('QUERY_STRING'):
+      url = '%s?%s' % (urllib.parse.quote(environ['PATH_INFO']),
+                       environ['QUERY_STRING'])
+    else:
+      url = urllib.parse.quote(environ['PATH_INFO'])
+    if 'CONTENT_LENGTH' in environ:
+      headers['CONTENT-LENGTH'] = environ['CONTENT_LENGTH']
+      data = environ['wsgi.input'].read(int(environ['CONTENT_LENGTH']))
+    else:
+      data = None
+    user_email, admin, user_id = login.get_user_info(
+        environ.get('HTTP_COOKIE'))
+    headers[self.request_id_header_name] = request_id
+    headers[http_runtime_constants.APPENGINE_HEADER_PREFIX + 'User-Id'] = (
+        user_id)
+    headers[http_runtime_constants.APPENGINE_HEADER_PREFIX + 'User-Email'] = (
+        user_email)
+    headers[http_runtime_constants.APPENGINE_HEADER_PREFIX +
+            'User-Is-Admin'] = str(int(admin))
+    connection = http_client.HTTPConnection(self._host, self._port)
+    with contextlib.closing(connection):
+      try:
+        connection.connect()
+        connection.request(environ.get('REQUEST_METHOD', 'GET'), url, data,
+                           dict(headers.items()))
+        try:
+          response = connection.getresponse()
+        except http_client.HTTPException as e:
+          yield self._respond_with_error(
+              'the runtime process gave a bad HTTP response: %s' % e,
+              start_response)
+          return
+        headers = []
+        for name in response.msg:
+          for value in response.msg.get_all(name):
+            headers.append((name, value))
+        response_headers = wsgiref.headers.Headers(headers)
+        del response_headers[http_runtime_constants.ERROR_CODE_HEADER]
+        start_response('%s %s' % (response.status, response.reason),
+                       list(response_headers.items()))
+        while True:
+          try:
+            block = response.read(512)
+            if not block:
+              break
+            yield block
+          except http_client.IncompleteRead:
+            break
+      except Exception:  # pylint: disable=broad-except
+        if self._instance_died_unexpectedly():
+          yield self._respond_with_error(
+              'the runtime process for the instance running on port %d has '
+              'unexpectedly quit' % self._port, start_response)
+        else:
+          raise
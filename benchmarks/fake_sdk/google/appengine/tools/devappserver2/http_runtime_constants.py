@@ -0,0 +1,16 @@
+"""Minimal stand-in for http_runtime_constants."""
+
+SERVER_SOFTWARE = 'Development/2.0'
+APPENGINE_HEADER_PREFIX = 'X-Appengine-'
+APPENGINE_ENVIRON_PREFIX = 'HTTP_X_APPENGINE_'
+REQUEST_ID_HEADER = 'X-Appengine-Request-Id'
+REQUEST_ID_ENVIRON = 'HTTP_X_APPENGINE_REQUEST_ID'
+SCRIPT_HEADER = APPENGINE_ENVIRON_PREFIX + 'ROOT'
+REQUEST_TYPE_HEADER = APPENGINE_ENVIRON_PREFIX + 'INTERNAL_REQUEST_TYPE'
+ERROR_CODE_HEADER = 'X-Appengine-Error-Code'
+ENVIRONS_TO_PROPAGATE = set(['BACKEND_ID', 'DEFAULT_VERSION_HOSTNAME',
+                             'USER_ID', 'USER_IS_ADMIN', 'USER_EMAIL',
+                             'USER_NICKNAME', 'USER_ORGANIZATION',
+                             'REMOTE_ADDR', 'REQUEST_ID_HASH',
+                             'REQUEST_LOG_ID', 'SERVER_NAME', 'SERVER_PORT',
+                             'SERVER_PROTOCOL'])
@@ -0,0 +1,119 @@
+"""Minimal stand-in for devappserver2 instance."""
+import threading
+
+NORMAL_REQUEST = 0
+READY_REQUEST = 1
+BACKGROUND_REQUEST = 2
+SHUTDOWN_REQUEST = 3
+INTERACTIVE_REQUEST = 4
+
+NEVER = 1
+AFTER_FIRST_REQUEST = 2
+ALWAYS = 3
+
+
+class CannotAcceptRequests(Exception):
+  pass
+
+
+class RuntimeProxy(object):
+
+  def start(self):
+    raise NotImplementedError()
+
+  def quit(self):
+    raise NotImplementedError()
+
+  def handle(self, environ, start_response, url_map, match, request_id,
+             request_type):
+    raise NotImplementedError()
+
+
+class Instance(object):
+  """Thin stand-in for instance.Instance sufficient for benchmarks."""
+
+  def __init__(self, request_data, instance_id, runtime_proxy,
+               max_concurrent_requests, max_background_threads=0,
+               expect_ready_request=False):
+    self._request_data = request_data
+    self._instance_id = instance_id
+    self._runtime_proxy = runtime_proxy
+    self._max_concurrent_requests = max_concurrent_requests
+    self._max_background_threads = max_background_threads
+    self._expect_ready_request = expect_ready_request
+    self._condition = threading.Condition()
+    self._num_outstanding_requests = 0
+    self._quitting = False
+
+  @property
+  def instance_id(self):
+    return self._instance_id
+
+  @property
+  def remaining_request_capacity(self):
+    with self._condition:
+      return self._max_concurrent_requests - self._num_outstanding_requests
+
+  def start(self):
+    self._runtime_proxy.start()
+    return True
+
+  def quit(self, allow_async=False, force=False, expect_shutdown=False):
+    del allow_async, force, expect_shutdown
+    self._quitting = True
+    self._runtime_proxy.quit()
+
+  def handle(self, environ, start_response, url_map, match, request_id,
+             request_type):
+    with self._condition:
+      if self._num_outstanding_requests >= self._max_concurrent_requests:
+        raise CannotAcceptRequests('Too many outstanding requests')
+      self._num_outstanding_requests += 1
+    try:
+      for chunk in self._runtime_proxy.handle(environ, start_response,
+                                              url_map, match, request_id,
+                                              request_type):
+        yield chunk
+    finally:
+      with self._condition:
+        self._num_outstanding_requests -= 1
+        self._condition.notify()
+
+
+class InstanceFactory(object):
+  """An abstract factory that creates instances for an InstanceFactory."""
+
+  START_URL_MAP = None
+  WARMUP_URL_MAP = None
+  SUPPORTS_INTERACTIVE_REQUESTS = False
+  FILE_CHANGE_INSTANCE_RESTART_POLICY = None
+
+  def __init__(self, request_data, max_concurrent_requests,
+               max_background_threads=0):
+    self.request_data = request_data
+    self.max_concurrent_requests = max_concurrent_requests
+    self.max_background_threads = max_background_threads
+
+  def get_restart_directories(self):
+    return []
+
+  def files_changed(self):
+    pass
+
+  def configuration_changed(self, config_changes):
+    pass
+
+  def new_instance(self, instance_id, expect_ready_request=False):
+    raise NotImplementedError()
+
+
+class ModernInstanceFactoryMixin(object):
+
+  def get_modern_env_vars(self, instance_id=None):
+    return {
+        'GAE_ENV': 'localdev',
+        'GAE_INSTANCE': str(instance_id),
+        'GAE_SERVICE': self._module_configuration.module_name,
+        'GAE_VERSION': self._module_configuration.major_version or '1',
+        'GAE_RUNTIME': self._module_configuration.runtime,
+    }
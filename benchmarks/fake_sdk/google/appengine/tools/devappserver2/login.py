@@ -0,0 +1,6 @@
+"""Minimal stand-in for devappserver2 login."""
+
+
+def get_user_info(http_cookie, cookie_name=None):
+  del http_cookie, cookie_name
+  return '', False, ''
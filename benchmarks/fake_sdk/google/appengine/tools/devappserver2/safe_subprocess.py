@@ -0,0 +1,33 @@
+"""Minimal stand-in for devappserver2 safe_subprocess."""
+import subprocess
+import tempfile
+import threading
+
+from google.appengine._internal import six
+
+_popen_lock = threading.Lock()
+
+
+def start_process(args, input_string='', env=None, cwd=None, stdout=None,
+                  stderr=None, shell=False):
+  if shell and not isinstance(args, six.string_types):
+    args = ' '.join(args)
+  with _popen_lock:
+    p = subprocess.Popen(args, env=env, cwd=cwd, stdout=stdout,
+                         stderr=stderr, stdin=subprocess.PIPE, shell=shell)
+  p.stdin.write(six.ensure_binary(input_string))
+  p.stdin.close()
+  p.stdin = None
+  return p
+
+
+def start_process_file(args, input_string, env, cwd, stdin=None, stdout=None,
+                       stderr=None):
+  child_in = tempfile.NamedTemporaryFile(delete=False)
+  child_in.write(six.ensure_binary(input_string))
+  child_in.close()
+  child_out = tempfile.NamedTemporaryFile(mode='r', delete=False)
+  p = start_process(list(args) + [child_in.name, child_out.name], env=env,
+                    cwd=cwd, stdout=stdout, stderr=stderr)
+  p.child_out = child_out
+  return p
@@ -0,0 +1,28 @@
+"""Minimal stand-in for devappserver2 tee."""
+import collections
+import threading
+
+
+class Tee(threading.Thread):
+  """A simple line-oriented "tee"."""
+
+  _MAX_LINES = 100
+
+  def __init__(self, in_f, out_f):
+    threading.Thread.__init__(self, name='Tee')
+    self.daemon = True
+    self.__in = in_f
+    self.__out = out_f
+    self.__deque = collections.deque([], self._MAX_LINES)
+
+  def run(self):
+    while True:
+      line = self.__in.readline()
+      if not line:
+        break
+      self.__out.write(line)
+      self.__out.flush()
+      self.__deque.append(line)
+
+  def get_buf(self):
+    return b''.join(self.__deque)
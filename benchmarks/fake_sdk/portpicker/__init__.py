@@ -0,0 +1,10 @@
+"""Minimal stand-in for portpicker."""
+import socket
+
+
+def pick_unused_port():
+  s = socket.socket()
+  s.bind(('', 0))
+  port = s.getsockname()[1]
+  s.close()
+  return port
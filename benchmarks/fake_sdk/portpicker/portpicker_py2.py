@@ -0,0 +1 @@
+from portpicker import pick_unused_port  # pylint: disable=unused-import
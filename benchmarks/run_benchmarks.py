@@ -0,0 +1,624 @@
+"""Benchmarks PythonRuntimeInstanceFactory and HttpRuntimeProxy.
+
+The instance_factory.py and http_runtime.py of one source tree are loaded on
+top of the stand-in SDK modules in fake_sdk/. They then run the stub app in
+stub_app/ against a stub API server and a local package index of generated
+wheels, so a run needs neither the Cloud SDK nor network access, and runs are
+comparable over time.
+
+Usage:
+  python benchmarks/run_benchmarks.py [--variant gcloud_sdk_470.0.0+]
+      [--scenarios cold_start,requests] [--output results.json]
+
+DEVAPPSERVER_* settings in the environment apply as they do when running
+dev_appserver.py, and are recorded in the results. Results are written as
+JSON, see RESULTS_SCHEMA_VERSION for the format.
+"""
+import argparse
+import collections
+import concurrent.futures
+import contextlib
+import datetime
+import gc
+import importlib.util
+import io
+import itertools
+import json
+import logging
+import math
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import stubs
+
+_BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+_REPO_DIR = os.path.dirname(_BENCHMARKS_DIR)
+_FAKE_SDK_DIR = os.path.join(_BENCHMARKS_DIR, 'fake_sdk')
+
+DEFAULT_VARIANT = 'gcloud_sdk_470.0.0+'
+
+# Source trees whose instance_factory.py is only run by Python 2 in the SDK.
+_PYTHON2_VARIANTS = frozenset(['gcloud_sdk_426.0.0-', 'gcloud_sdk_427.0.0+'])
+
+# Version 1 of the results is a JSON object with:
+#   schema, schema_version: 'devappserver-benchmarks', 1.
+#   variant: The name of the source tree benchmarked.
+#   revision: The git commit of the repository, or null.
+#   started_at: UTC start time in ISO 8601 format.
+#   host: platform, machine, python and cpu_count of the machine.
+#   settings: The DEVAPPSERVER_* environment variables that were set.
+#   parameters: The command line parameters of the run.
+#   results: An object with a key for each metric of SCENARIOS that ran. The
+#     value has unit ('s' or 'requests/s'), count, min, max, mean, median,
+#     p90, p99, stdev and the samples in the order they were taken, or only
+#     error (a message) if the scenario failed.
+# New keys may be added without changing the version; renaming or removing
+# keys or changing the meaning of a value requires a new version.
+RESULTS_SCHEMA = 'devappserver-benchmarks'
+RESULTS_SCHEMA_VERSION = 1
+
+# The scenarios in the order they run, and the metrics each one reports.
+SCENARIOS = collections.OrderedDict([
+    # Setting up a module with nothing cached and serving its first request.
+    ('cold_start', ('cold_module_start',)),
+    # The same once a previous run set up the module, e.g. a restart of
+    # dev_appserver.py.
+    ('warm_restart', ('warm_restart',)),
+    # Applying a requirements.txt edit and serving a request from an instance
+    # running with it.
+    ('requirements_reload', ('requirements_reload',)),
+    # Starting and quitting an instance of a module that is set up.
+    ('instance_lifecycle', ('instance_start', 'instance_quit')),
+    # Quitting the last instance of a module and dropping its factory, as
+    # dev_appserver.py does when it exits.
+    ('shutdown', ('module_shutdown',)),
+    # Requests through handle(): latency of a plain request and of one making
+    # an API call, and throughput of concurrent plain requests.
+    ('requests', ('request_latency', 'api_request_latency',
+                  'request_throughput')),
+])
+
+METRIC_UNITS = {'request_throughput': 'requests/s'}
+
+# How a restarted dev_appserver.py finds the virtualenv of the last run:
+#   venv_cache:      DEVAPPSERVER_VENV_CACHE_DIR (SetVenvCacheDir).
+#   virtualenv_path: the --python_virtualenv_path flag
+#                    (SetVirtualEnvPythonPath).
+#   none:            it doesn't, a new virtualenv is created every time.
+# 'auto' picks the first one the source tree supports.
+VIRTUALENV_REUSE_MODES = ('venv_cache', 'virtualenv_path', 'none')
+_VIRTUALENV_REUSE_SETTERS = {
+    'venv_cache': 'SetVenvCacheDir',
+    'virtualenv_path': 'SetVirtualEnvPythonPath',
+}
+
+
+class BenchmarkError(Exception):
+  """A scenario could not be completed."""
+
+
+def load_variant(variant_dir):
+  """Loads http_runtime.py and instance_factory.py of a source tree.
+
+  They are imported as the devappserver2 modules they replace in the SDK, on
+  top of the stand-in SDK modules. A process can only load one source tree.
+
+  Args:
+    variant_dir: The source tree directory, e.g. src/gcloud_sdk_470.0.0+.
+
+  Returns:
+    A (http_runtime, instance_factory) tuple of the loaded modules.
+  """
+  if _FAKE_SDK_DIR not in sys.path:
+    sys.path.insert(0, _FAKE_SDK_DIR)
+  # pylint: disable=g-import-not-at-top
+  from google.appengine.tools import devappserver2
+  from google.appengine.tools.devappserver2 import python as devappserver2_python
+
+  modules = []
+  for package, module_name in ((devappserver2, 'http_runtime'),
+                               (devappserver2_python, 'instance_factory')):
+    name = '%s.%s' % (package.__name__, module_name)
+    spec = importlib.util.spec_from_file_location(
+        name, os.path.join(variant_dir, module_name + '.py'))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    if os.path.basename(variant_dir) in _PYTHON2_VARIANTS:
+      module.subprocess = _Python2Subprocess()
+      # They only run on Windows, and pass %SYSTEMROOT% on to pip.
+      os.environ.setdefault('SYSTEMROOT', '')
+    setattr(package, module_name, module)
+    modules.append(module)
+  return tuple(modules)
+
+
+class _Python2Subprocess(object):
+  """The subprocess module as Python 2 code sees it.
+
+  check_output() returns str on Python 2, which the source trees only run by
+  Python 2 compare with str literals.
+  """
+
+  def __getattr__(self, name):
+    return getattr(subprocess, name)
+
+  @staticmethod
+  def check_output(*args, **kwargs):
+    kwargs.setdefault('universal_newlines', True)
+    return subprocess.check_output(*args, **kwargs)
+
+
+class _RuntimeConfig(object):
+  """Stand-in for the runtime_config_pb2.Config of an instance."""
+
+  def __init__(self, api_host, api_port):
+    self.app_id = b'dev~benchmark'
+    self.api_host = api_host
+    self.api_port = api_port
+    self.environ = []
+    self.instance_id = '0'
+    self.server_port = 8080
+    self.threadsafe = True
+    self.vm = False
+
+  def SerializeToString(self):
+    return b''
+
+
+class _ModuleConfiguration(object):
+  """Stand-in for application_configuration.ModuleConfiguration."""
+
+  def __init__(self, app_dir, entrypoint):
+    self.application_external_name = 'benchmark'
+    self.application_root = app_dir
+    self.automatic_scaling_config = None
+    self.basic_scaling_config = None
+    self.build_env_variables = None
+    self.config_path = os.path.join(app_dir, 'app.yaml')
+    self.entrypoint = entrypoint
+    self.inbound_services = None
+    self.instance_class = None
+    self.major_version = '1'
+    self.manual_scaling_config = None
+    self.minor_version = '1'
+    self.module_name = 'default'
+    self.partition = ''
+    self.runtime = 'python312'
+
+
+def _summarize(samples, unit):
+  """Returns the results entry of a metric."""
+  ordered = sorted(samples)
+
+  def percentile(q):
+    return ordered[max(0, int(math.ceil(q * len(ordered))) - 1)]
+
+  return {
+      'unit': unit,
+      'count': len(samples),
+      'min': round(ordered[0], 6),
+      'max': round(ordered[-1], 6),
+      'mean': round(statistics.mean(samples), 6),
+      'median': round(statistics.median(samples), 6),
+      'p90': round(percentile(0.9), 6),
+      'p99': round(percentile(0.99), 6),
+      'stdev': round(statistics.stdev(samples), 6) if len(samples) > 1 else 0,
+      'samples': [round(sample, 6) for sample in samples],
+  }
+
+
+class Benchmarks(object):
+  """Runs the scenarios against a loaded source tree."""
+
+  def __init__(self, http_runtime, instance_factory, work_dir, options):
+    """Initializer for Benchmarks.
+
+    Args:
+      http_runtime: The loaded http_runtime module.
+      instance_factory: The loaded instance_factory module.
+      work_dir: An empty directory for the app, package index and virtualenvs.
+      options: The parsed command line options.
+    """
+    # pylint: disable=g-import-not-at-top
+    from google.appengine.tools.devappserver2 import instance
+
+    self._instance = instance
+    self._http_runtime = http_runtime
+    self._factory_class = instance_factory.PythonRuntimeInstanceFactory
+    self._work_dir = work_dir
+    self._options = options
+    self._app_dir = os.path.join(work_dir, 'app')
+    self._api_server = None
+    self._shared_factory = None
+    self._virtualenv_reuse = self._GetVirtualenvReuse(
+        options.virtualenv_reuse)
+    self._warm_reuse_primed = False
+    self._instance_ids = itertools.count()
+    self._request_ids = itertools.count()
+    self._num_packages = options.packages
+
+  @property
+  def virtualenv_reuse(self):
+    """The VIRTUALENV_REUSE_MODES entry restarts use."""
+    return self._virtualenv_reuse
+
+  def _GetVirtualenvReuse(self, requested):
+    if requested == 'auto':
+      return next(
+          (mode for mode in VIRTUALENV_REUSE_MODES
+           if hasattr(self._factory_class,
+                      _VIRTUALENV_REUSE_SETTERS.get(mode, '-'))),
+          'none')
+    if (requested != 'none' and not hasattr(
+        self._factory_class, _VIRTUALENV_REUSE_SETTERS[requested])):
+      raise BenchmarkError('The source tree does not support %s' % requested)
+    return requested
+
+  def _SetVirtualenvReuseDir(self, name):
+    """Makes new factories keep their virtualenv in a work subdirectory."""
+    if self._virtualenv_reuse != 'none':
+      getattr(self._factory_class,
+              _VIRTUALENV_REUSE_SETTERS[self._virtualenv_reuse])(
+                  os.path.join(self._work_dir, name))
+
+  def _SetUp(self):
+    index_url = stubs.build_package_index(
+        os.path.join(self._work_dir, 'index'),
+        self._options.packages + self._options.iterations)
+    stubs.write_stub_app(self._app_dir, self._num_packages)
+    # Only the local index, whatever pip is configured with on this machine.
+    os.environ['PIP_CONFIG_FILE'] = os.devnull
+    os.environ.pop('PIP_EXTRA_INDEX_URL', None)
+    os.environ.pop('PIP_FIND_LINKS', None)
+    os.environ['PIP_INDEX_URL'] = index_url
+    os.environ['PIP_DISABLE_PIP_VERSION_CHECK'] = '1'
+    # Virtualenvs the factory doesn't clean up end up in the work directory.
+    tempfile.tempdir = os.path.join(self._work_dir, 'tmp')
+    os.makedirs(tempfile.tempdir)
+    self._api_server = stubs.StubApiServer()
+    self._api_server.start()
+    self._factory_class.SetRuntimePythonPath(self._options.python)
+
+  def _TearDown(self):
+    if self._shared_factory is not None:
+      self._DisposeFactory(self._shared_factory)
+      self._shared_factory = None
+    self._api_server.stop()
+    tempfile.tempdir = None
+
+  def Run(self, scenarios):
+    """Runs the given scenarios.
+
+    Args:
+      scenarios: An iterable of keys of SCENARIOS.
+
+    Returns:
+      A dict of the results entry of every metric of the scenarios.
+    """
+    results = {}
+    self._SetUp()
+    try:
+      for scenario in SCENARIOS:
+        if scenario not in scenarios:
+          continue
+        logging.warning('Running %s.', scenario)
+        try:
+          samples = getattr(self, '_Run' + scenario.title().replace('_', ''))()
+        except Exception as e:  # pylint: disable=broad-except
+          logging.exception('Scenario %s failed.', scenario)
+          for metric in SCENARIOS[scenario]:
+            results[metric] = {'error': '%s: %s' % (type(e).__name__, e)}
+          continue
+        for metric in SCENARIOS[scenario]:
+          results[metric] = _summarize(samples[metric],
+                                       METRIC_UNITS.get(metric, 's'))
+    finally:
+      self._TearDown()
+    return results
+
+  def _RuntimeConfig(self):
+    return _RuntimeConfig(self._api_server.host, self._api_server.port)
+
+  def _NewFactory(self):
+    entrypoint = ('python serve.py' if sys.platform == 'win32'
+                  else 'exec python serve.py')
+    return self._factory_class(
+        None, self._RuntimeConfig,
+        _ModuleConfiguration(self._app_dir, entrypoint))
+
+  def _DisposeFactory(self, factory):
+    # Pooled instances would outlive the factory otherwise.
+    drain_instance_pool = getattr(factory, '_DrainInstancePool', None)
+    if drain_instance_pool is not None:
+      drain_instance_pool(wait=True)
+
+  def _StartInstance(self, factory):
+    inst = factory.new_instance(next(self._instance_ids))
+    inst.start()
+    return inst
+
+  def _Request(self, inst, path='/'):
+    """Sends a GET request through inst.handle().
+
+    Returns:
+      The time in seconds until the response was read.
+
+    Raises:
+      BenchmarkError: The response status wasn't 2xx.
+    """
+    environ = {
+        'REQUEST_METHOD': 'GET',
+        'PATH_INFO': path,
+        'QUERY_STRING': '',
+        'SERVER_NAME': 'localhost',
+        'SERVER_PORT': '8080',
+        'SERVER_PROTOCOL': 'HTTP/1.1',
+        'HTTP_HOST': 'localhost:8080',
+        'wsgi.input': io.BytesIO(),
+    }
+    statuses = []
+
+    def start_response(status, headers, exc_info=None):
+      del headers, exc_info
+      statuses.append(status)
+
+    start_time = time.perf_counter()
+    body = b''.join(inst.handle(
+        environ, start_response, None, None, str(next(self._request_ids)),
+        self._instance.NORMAL_REQUEST))
+    elapsed = time.perf_counter() - start_time
+    if not statuses or not statuses[0].startswith('2'):
+      raise BenchmarkError('GET %s returned %s: %r' % (
+          path, statuses[0] if statuses else 'no response', body[:200]))
+    return elapsed
+
+  def _UseWarmVirtualenv(self):
+    """Makes new factories find the virtualenv of the app set up already."""
+    self._SetVirtualenvReuseDir('venvs')
+    if not self._warm_reuse_primed:
+      self._DisposeFactory(self._NewFactory())
+      self._warm_reuse_primed = True
+
+  def _GetSharedFactory(self):
+    if self._shared_factory is None:
+      self._UseWarmVirtualenv()
+      self._shared_factory = self._NewFactory()
+    return self._shared_factory
+
+  def _RunColdStart(self):
+    samples = []
+    for i in range(self._options.cold_iterations):
+      self._SetVirtualenvReuseDir('venvs-cold-%d' % i)
+      start_time = time.perf_counter()
+      factory = self._NewFactory()
+      inst = self._StartInstance(factory)
+      self._Request(inst)
+      samples.append(time.perf_counter() - start_time)
+      inst.quit()
+      self._DisposeFactory(factory)
+    return {'cold_module_start': samples}
+
+  def _RunWarmRestart(self):
+    self._UseWarmVirtualenv()
+    samples = []
+    for _ in range(self._options.iterations):
+      start_time = time.perf_counter()
+      factory = self._NewFactory()
+      inst = self._StartInstance(factory)
+      self._Request(inst)
+      samples.append(time.perf_counter() - start_time)
+      inst.quit()
+      self._DisposeFactory(factory)
+    return {'warm_restart': samples}
+
+  def _RunRequirementsReload(self):
+    factory = self._GetSharedFactory()
+    requirements_path = os.path.join(self._app_dir, 'requirements.txt')
+    samples = []
+    for _ in range(self._options.iterations):
+      # Every iteration requires one more package from the index.
+      self._num_packages += 1
+      stubs.write_requirements(self._app_dir, self._num_packages)
+      start_time = time.perf_counter()
+      factory.dependency_libraries_changed({requirements_path})
+      inst = self._StartInstance(factory)
+      self._Request(inst)
+      samples.append(time.perf_counter() - start_time)
+      inst.quit()
+    return {'requirements_reload': samples}
+
+  def _RunInstanceLifecycle(self):
+    factory = self._GetSharedFactory()
+    start_samples = []
+    quit_samples = []
+    for _ in range(self._options.iterations):
+      inst = factory.new_instance(next(self._instance_ids))
+      start_time = time.perf_counter()
+      inst.start()
+      start_samples.append(time.perf_counter() - start_time)
+      self._Request(inst)
+      start_time = time.perf_counter()
+      inst.quit()
+      quit_samples.append(time.perf_counter() - start_time)
+    return {'instance_start': start_samples, 'instance_quit': quit_samples}
+
+  def _RunShutdown(self):
+    self._UseWarmVirtualenv()
+    samples = []
+    for _ in range(self._options.iterations):
+      factory = self._NewFactory()
+      inst = self._StartInstance(factory)
+      self._Request(inst)
+      start_time = time.perf_counter()
+      inst.quit()
+      self._DisposeFactory(factory)
+      # The factory cleans up its virtualenv when it is garbage collected.
+      del factory, inst
+      gc.collect()
+      samples.append(time.perf_counter() - start_time)
+    return {'module_shutdown': samples}
+
+  def _RunRequests(self):
+    factory = self._GetSharedFactory()
+    inst = self._StartInstance(factory)
+    try:
+      for _ in range(10):
+        self._Request(inst)
+      latency = [self._Request(inst) for _ in range(self._options.requests)]
+      api_latency = [self._Request(inst, '/api')
+                     for _ in range(self._options.requests)]
+      # Instances refuse more concurrent requests than they can take.
+      concurrency = min(self._options.concurrency,
+                        factory.max_concurrent_requests)
+      throughput = []
+      with concurrent.futures.ThreadPoolExecutor(concurrency) as executor:
+        for _ in range(self._options.iterations):
+          start_time = time.perf_counter()
+          list(executor.map(lambda _: self._Request(inst),
+                            range(self._options.requests)))
+          throughput.append(
+              self._options.requests / (time.perf_counter() - start_time))
+    finally:
+      inst.quit()
+    return {'request_latency': latency, 'api_request_latency': api_latency,
+            'request_throughput': throughput}
+
+
+def _GetRevision():
+  try:
+    return subprocess.check_output(
+        ['git', 'rev-parse', 'HEAD'], cwd=_REPO_DIR,
+        stderr=subprocess.DEVNULL).decode('ascii').strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+
+def _ResolveVariant(variant):
+  if os.path.isdir(variant):
+    return os.path.abspath(variant)
+  variant_dir = os.path.join(_REPO_DIR, 'src', variant)
+  if not os.path.isdir(variant_dir):
+    raise SystemExit('No source tree %s' % variant)
+  return variant_dir
+
+
+def _ParseArgs(argv):
+  parser = argparse.ArgumentParser(
+      description='Benchmarks the runtime factory and HTTP runtime proxy of '
+      'a source tree.')
+  parser.add_argument(
+      '--variant', default=DEFAULT_VARIANT,
+      help='The source tree, a directory name under src/ or a path '
+      '(default: %(default)s).')
+  parser.add_argument(
+      '--scenarios', default=','.join(SCENARIOS),
+      help='Comma separated scenarios to run (default: %(default)s).')
+  parser.add_argument(
+      '--output',
+      help='The file to write the results to (default: standard output).')
+  parser.add_argument(
+      '--iterations', type=int, default=5,
+      help='Samples taken by every scenario other than cold_start '
+      '(default: %(default)s).')
+  parser.add_argument(
+      '--cold-iterations', type=int, default=1,
+      help='Samples taken by cold_start (default: %(default)s).')
+  parser.add_argument(
+      '--requests', type=int, default=200,
+      help='Requests per latency and throughput sample '
+      '(default: %(default)s).')
+  parser.add_argument(
+      '--concurrency', type=int, default=8,
+      help='Concurrent requests when measuring throughput '
+      '(default: %(default)s).')
+  parser.add_argument(
+      '--packages', type=int, default=5,
+      help='Packages in the requirements.txt of the stub app '
+      '(default: %(default)s).')
+  parser.add_argument(
+      '--virtualenv-reuse', default='auto',
+      choices=('auto',) + VIRTUALENV_REUSE_MODES,
+      help='How restarts find the virtualenv of the last run, see '
+      'VIRTUALENV_REUSE_MODES (default: %(default)s).')
+  parser.add_argument(
+      '--python', default=sys.executable,
+      help='The Python interpreter of the runtime (default: %(default)s).')
+  parser.add_argument(
+      '--work-dir',
+      help='An empty directory to work in (default: a new temp directory).')
+  parser.add_argument(
+      '--keep-work-dir', action='store_true',
+      help='Keep the work directory, e.g. to look at pip logs.')
+  parser.add_argument('--verbose', '-v', action='store_true',
+                      help='Log what dev_appserver logs.')
+  options = parser.parse_args(argv)
+  options.scenarios = [s for s in options.scenarios.split(',') if s]
+  unknown = set(options.scenarios) - set(SCENARIOS)
+  if unknown:
+    parser.error('unknown scenarios: %s' % ', '.join(sorted(unknown)))
+  return options
+
+
+def main(argv=None):
+  options = _ParseArgs(argv)
+  logging.basicConfig(
+      level=logging.INFO if options.verbose else logging.WARNING,
+      format='%(asctime)s %(levelname)s %(message)s')
+  variant_dir = _ResolveVariant(options.variant)
+  work_dir = options.work_dir or tempfile.mkdtemp(prefix='devappserver-bench-')
+  started_at = datetime.datetime.now(datetime.timezone.utc)
+
+  # pip progress is written to stdout, which may be where the results go.
+  with contextlib.redirect_stdout(sys.stderr):
+    try:
+      http_runtime, instance_factory = load_variant(variant_dir)
+      benchmarks = Benchmarks(
+          http_runtime, instance_factory, work_dir, options)
+      results = benchmarks.Run(options.scenarios)
+    finally:
+      if not options.keep_work_dir:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+  document = {
+      'schema': RESULTS_SCHEMA,
+      'schema_version': RESULTS_SCHEMA_VERSION,
+      'variant': os.path.basename(variant_dir),
+      'revision': _GetRevision(),
+      'started_at': started_at.strftime('%Y-%m-%dT%H:%M:%SZ'),
+      'host': {
+          'platform': sys.platform,
+          'machine': platform.machine(),
+          'python': platform.python_version(),
+          'cpu_count': os.cpu_count(),
+      },
+      'settings': {name: value for name, value in os.environ.items()
+                   if name.startswith('DEVAPPSERVER_')},
+      'parameters': {
+          'scenarios': options.scenarios,
+          'iterations': options.iterations,
+          'cold_iterations': options.cold_iterations,
+          'requests': options.requests,
+          'concurrency': options.concurrency,
+          'packages': options.packages,
+          'virtualenv_reuse': benchmarks.virtualenv_reuse,
+      },
+      'results': results,
+  }
+  output = json.dumps(document, indent=2, sort_keys=True) + '\n'
+  if options.output:
+    with open(options.output, 'w') as f:
+      f.write(output)
+  else:
+    sys.stdout.write(output)
+  return 1 if any('error' in result for result in results.values()) else 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
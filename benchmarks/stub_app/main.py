@@ -0,0 +1,25 @@
+"""Stub WSGI app the benchmarks run as the instance.
+
+  /          returns a short body.
+  /api       makes a call to the API server on API_HOST/API_PORT first.
+  /bytes/<n> returns a body of n bytes.
+"""
+import os
+import urllib.request
+
+_API_URL = 'http://%s:%s/' % (os.environ.get('API_HOST', 'localhost'),
+                              os.environ.get('API_PORT', '80'))
+
+
+def app(environ, start_response):
+  path = environ.get('PATH_INFO', '/')
+  if path == '/api':
+    with urllib.request.urlopen(_API_URL, b'{}') as response:
+      body = response.read()
+  elif path.startswith('/bytes/'):
+    body = b'x' * int(path[len('/bytes/'):])
+  else:
+    body = b'ok'
+  start_response('200 OK', [('Content-Type', 'text/plain'),
+                            ('Content-Length', str(len(body)))])
+  return [body]
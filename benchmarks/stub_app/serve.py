@@ -0,0 +1,29 @@
+"""Serves the stub app on $PORT with the standard library only.
+
+Used as the entrypoint of the stub app so the benchmarks don't need gunicorn
+or waitress in the local package index.
+"""
+import os
+import socketserver
+import wsgiref.simple_server
+
+import main
+
+
+class _ThreadingWSGIServer(socketserver.ThreadingMixIn,
+                           wsgiref.simple_server.WSGIServer):
+  daemon_threads = True
+  request_queue_size = 128  # 5 drops connections of concurrent requests.
+
+
+class _QuietHandler(wsgiref.simple_server.WSGIRequestHandler):
+
+  def log_message(self, *args):
+    pass
+
+
+if __name__ == '__main__':
+  server = wsgiref.simple_server.make_server(
+      '', int(os.environ['PORT']), main.app,
+      server_class=_ThreadingWSGIServer, handler_class=_QuietHandler)
+  server.serve_forever()
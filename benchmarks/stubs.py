@@ -0,0 +1,141 @@
+"""Local stand-ins for what dev_appserver talks to outside the runtime.
+
+  StubApiServer       answers the API calls of the stub app on API_PORT.
+  build_package_index writes tiny wheels into a local PEP 503 index, so pip
+                      installs without network access and always does the
+                      same work.
+  write_stub_app      copies the stub app with a requirements.txt.
+"""
+import base64
+import hashlib
+import http.server
+import os
+import pathlib
+import shutil
+import threading
+import zipfile
+
+_STUB_APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'stub_app')
+
+PACKAGE_NAME_FORMAT = 'devappserver-bench-pkg%d'
+PACKAGE_VERSION = '1.0'
+
+
+class _ApiHandler(http.server.BaseHTTPRequestHandler):
+  """Answers every call with an empty JSON object."""
+
+  protocol_version = 'HTTP/1.1'
+
+  def _respond(self):
+    self.rfile.read(int(self.headers.get('Content-Length') or 0))
+    self.send_response(200)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', '2')
+    self.end_headers()
+    self.wfile.write(b'{}')
+
+  do_GET = _respond
+  do_POST = _respond
+
+  def log_message(self, *args):
+    pass
+
+
+class StubApiServer(object):
+  """An HTTP server standing in for the dev_appserver API server."""
+
+  def __init__(self, host='localhost'):
+    self._server = http.server.ThreadingHTTPServer((host, 0), _ApiHandler)
+    self._server.daemon_threads = True
+    self._thread = threading.Thread(target=self._server.serve_forever,
+                                    name='StubApiServer')
+    self._thread.daemon = True
+
+  @property
+  def host(self):
+    return self._server.server_address[0]
+
+  @property
+  def port(self):
+    return self._server.server_address[1]
+
+  def start(self):
+    self._thread.start()
+
+  def stop(self):
+    self._server.shutdown()
+    self._server.server_close()
+
+
+def _write_wheel(wheel_dir, name, version):
+  """Writes a pure Python wheel with a single module and returns its path."""
+  module = name.replace('-', '_')
+  dist_info = '%s-%s.dist-info' % (module, version)
+  files = [
+      ('%s.py' % module, 'VERSION = %r\n' % version),
+      ('%s/METADATA' % dist_info,
+       'Metadata-Version: 2.1\nName: %s\nVersion: %s\n' % (name, version)),
+      ('%s/WHEEL' % dist_info,
+       'Wheel-Version: 1.0\nGenerator: devappserver-benchmarks\n'
+       'Root-Is-Purelib: true\nTag: py3-none-any\n'),
+  ]
+  record = []
+  for path, content in files:
+    digest = base64.urlsafe_b64encode(
+        hashlib.sha256(content.encode('utf-8')).digest()).rstrip(b'=')
+    record.append('%s,sha256=%s,%d' % (path, digest.decode('ascii'),
+                                       len(content.encode('utf-8'))))
+  record.append('%s/RECORD,,' % dist_info)
+  files.append(('%s/RECORD' % dist_info, '\n'.join(record) + '\n'))
+
+  wheel_path = os.path.join(wheel_dir,
+                            '%s-%s-py3-none-any.whl' % (module, version))
+  with zipfile.ZipFile(wheel_path, 'w') as wheel:
+    for path, content in files:
+      wheel.writestr(path, content)
+  return wheel_path
+
+
+def build_package_index(index_dir, num_packages):
+  """Builds a local package index of stub packages.
+
+  Args:
+    index_dir: The directory to write the index into.
+    num_packages: The number of packages, named after PACKAGE_NAME_FORMAT.
+
+  Returns:
+    The file:// URL of the index, for PIP_INDEX_URL.
+  """
+  simple_dir = os.path.join(index_dir, 'simple')
+  wheel_dir = os.path.join(index_dir, 'files')
+  os.makedirs(wheel_dir)
+  names = [PACKAGE_NAME_FORMAT % i for i in range(num_packages)]
+  for name in names:
+    wheel_path = _write_wheel(wheel_dir, name, PACKAGE_VERSION)
+    project_dir = os.path.join(simple_dir, name)
+    os.makedirs(project_dir)
+    with open(os.path.join(project_dir, 'index.html'), 'w') as f:
+      f.write('<html><body><a href="%s">%s</a></body></html>\n' % (
+          pathlib.Path(wheel_path).as_uri(),
+          os.path.basename(wheel_path)))
+  with open(os.path.join(simple_dir, 'index.html'), 'w') as f:
+    f.write('<html><body>%s</body></html>\n' % ''.join(
+        '<a href="%s/">%s</a>' % (name, name) for name in names))
+  return pathlib.Path(simple_dir).as_uri()
+
+
+def write_requirements(app_dir, num_packages):
+  """Makes requirements.txt of app_dir require the first num_packages."""
+  with open(os.path.join(app_dir, 'requirements.txt'), 'w') as f:
+    for i in range(num_packages):
+      f.write('%s==%s\n' % (PACKAGE_NAME_FORMAT % i, PACKAGE_VERSION))
+
+
+def write_stub_app(app_dir, num_packages):
+  """Copies the stub app into app_dir, requiring num_packages packages."""
+  shutil.copytree(_STUB_APP_DIR, app_dir,
+                  ignore=shutil.ignore_patterns('__pycache__'))
+  with open(os.path.join(app_dir, 'app.yaml'), 'w') as f:
+    f.write('runtime: python312\nentrypoint: python serve.py\n')
+  write_requirements(app_dir, num_packages)
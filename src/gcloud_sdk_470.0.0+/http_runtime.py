@@ -43,13 +43,28 @@ process.
 
 
 
+import atexit
 import base64
+import bisect
+import collections
+import contextlib
+import errno
+import json
 import logging
 import os
+import re
+import select
+import selectors
+import shutil
+import signal
+import socket
+import struct
 import subprocess
 import sys
+import tempfile
 import threading
 import time
+import wsgiref.headers
 
 from portpicker import portpicker_py2 as portpicker
 from google.appengine._internal import six
@@ -58,8 +73,9 @@ from google.appengine.tools.devappserver2 import application_configuration
 from google.appengine.tools.devappserver2 import http_proxy
 from google.appengine.tools.devappserver2 import http_runtime_constants
 from google.appengine.tools.devappserver2 import instance
+from google.appengine.tools.devappserver2 import login
 from google.appengine.tools.devappserver2 import safe_subprocess
-from google.appengine.tools.devappserver2 import tee
+from google.appengine.tools.devappserver2 import util
 
 # These are different approaches to passing configuration into the runtimes
 # and getting configuration back out of the runtime.
@@ -83,6 +99,200 @@ START_PROCESS_REVERSE_NO_FILE = -4
 # User application has an entrypoint defined in app.yaml.
 START_PROCESS_WITH_ENTRYPOINT = -5
 
+# Changes by NoCommandLine - ways of choosing the port of a runtime process.
+# See HttpRuntimeProxy.set_port_mode.
+
+# Pick an unused port with portpicker; it can be taken by someone else before
+# the runtime binds it.
+PORT_MODE_PICK = 'pick'
+
+# Bind the listening socket here and pass it to the runtime as an inherited
+# file descriptor, for entrypoints that can take one (gunicorn, or commands
+# using ${FD}). Other runtimes get a port like with PORT_MODE_RANGE.
+PORT_MODE_FD = 'fd'
+
+# Hand out ports from a range reserved for dev_appserver.
+PORT_MODE_RANGE = 'range'
+
+# Have the runtime listen on a Unix domain socket instead of a port, for
+# entrypoints that can take a socket path (gunicorn, hypercorn, uvicorn,
+# waitress-serve, or commands using ${SOCKET}). Other runtimes get a port like
+# with PORT_MODE_PICK, or PORT_MODE_RANGE with a port range. Not supported on
+# Windows.
+PORT_MODE_UNIX = 'unix'
+
+_PORT_MODE_ENV = 'DEVAPPSERVER_PORT_MODE'
+_PORT_RANGE_ENV = 'DEVAPPSERVER_PORT_RANGE'
+
+# Changes by NoCommandLine - ways for a runtime process to tell it is ready.
+# See HttpRuntimeProxy.set_readiness.
+_READY_NOTIFY_ENV = 'DEVAPPSERVER_READY_NOTIFY'
+_READY_PATH_ENV = 'DEVAPPSERVER_READY_PATH'
+
+# How long to wait for READY=1 before polling the port instead.
+_READY_NOTIFY_TIMEOUT_SECONDS = 10
+
+# How long to wait for the ready path to answer with a 2xx status.
+_READY_PATH_TIMEOUT_SECONDS = 60
+_READY_PATH_INTERVAL_SECONDS = 0.05
+
+# Changes by NoCommandLine - directory the startup timeline is written to. See
+# StartupTimeline.
+_STARTUP_TRACE_DIR_ENV = 'DEVAPPSERVER_STARTUP_TRACE_DIR'
+
+# Changes by NoCommandLine - how much runtime output is kept in memory, and
+# where older output goes. See HttpRuntimeProxy.set_log_buffer.
+_LOG_BUFFER_KB_ENV = 'DEVAPPSERVER_RUNTIME_LOG_BUFFER_KB'
+_LOG_DIR_ENV = 'DEVAPPSERVER_RUNTIME_LOG_DIR'
+_DEFAULT_LOG_BUFFER_KB = 1024
+_LOG_FILE_MAX_BYTES = 10 * 1024 * 1024
+_LOG_FILE_BACKUPS = 3
+
+# The number of output lines shown on error pages, as many as tee.Tee kept.
+_ERROR_PAGE_LOG_LINES = 100
+
+# How long to wait for a runtime process that died to close its stderr.
+_LOG_EOF_TIMEOUT_SECONDS = 1
+
+# The number of requests whose output range is remembered per instance.
+_MAX_TRACKED_REQUESTS = 1000
+
+# How much of a stderr pipe is read at once, and how long an incomplete line
+# is held back before it is written to the console anyway.
+_PIPE_READ_SIZE = 64 * 1024
+_PARTIAL_LINE_DELAY_SECONDS = 0.1
+
+# Changes by NoCommandLine - runtime output is also kept as RuntimeLogRecords,
+# see HttpRuntimeProxy.get_request_log_records.
+_LOG_RECORDS_ENV = 'DEVAPPSERVER_RUNTIME_LOG_RECORDS'
+_DEFAULT_LOG_RECORDS = 10000
+# Longer lines are cut in records (not in the output itself).
+_MAX_LOG_RECORD_BYTES = 16 * 1024
+
+# The severities of Cloud Logging, and their order.
+_LOG_SEVERITIES = collections.OrderedDict([
+    ('DEFAULT', 0), ('DEBUG', 100), ('INFO', 200), ('NOTICE', 300),
+    ('WARNING', 400), ('ERROR', 500), ('CRITICAL', 600), ('ALERT', 700),
+    ('EMERGENCY', 800)])
+_LOG_SEVERITY_ALIASES = {'WARN': 'WARNING', 'FATAL': 'CRITICAL'}
+
+# The level of Python's logging, gunicorn and most other loggers, looked for
+# at the start of a line.
+_LOG_SEVERITY_RE = re.compile(
+    br'\b(DEBUG|INFO|NOTICE|WARNING|WARN|ERROR|CRITICAL|FATAL|ALERT|'
+    br'EMERGENCY)\b')
+_LOG_SEVERITY_SEARCH_BYTES = 80
+
+# Lines that belong to a traceback without being indented.
+_TRACEBACK_START = b'Traceback (most recent call last):'
+_TRACEBACK_CHAIN_PREFIXES = (b'During handling of the above exception',
+                             b'The above exception was the direct cause')
+
+# Changes by NoCommandLine - what happens to runtime output when the console
+# can't keep up. See HttpRuntimeProxy.set_log_forwarding.
+
+# Wait until the console took the output; the runtime process ends up waiting
+# on its writes to stderr. Except on Windows a single thread copies the output
+# of all runtime processes (see _LogPump), so all of them wait for the console
+# then, not only the one writing most.
+LOG_FORWARD_BLOCK = 'block'
+
+# Drop the oldest output that wasn't written to the console yet. The default.
+LOG_FORWARD_DROP_OLDEST = 'drop_oldest'
+
+# Only write one line in _LOG_SAMPLE_RATE to the console until it caught up.
+LOG_FORWARD_SAMPLE = 'sample'
+
+_LOG_FORWARD_POLICY_ENV = 'DEVAPPSERVER_LOG_FORWARD_POLICY'
+_LOG_FORWARD_BUFFER_KB_ENV = 'DEVAPPSERVER_LOG_FORWARD_BUFFER_KB'
+_DEFAULT_LOG_FORWARD_BUFFER_KB = 1024
+_LOG_SAMPLE_RATE = 10
+
+# How long output still waiting for the console may delay exiting.
+_LOG_FORWARD_EXIT_TIMEOUT_SECONDS = 1
+
+# Changes by NoCommandLine - the zygote of a module, see Zygote.
+_ZYGOTE_PRELOAD_ENV = 'DEVAPPSERVER_ZYGOTE_PRELOAD'
+# How long a spawn waits for the zygote to finish preloading.
+_ZYGOTE_READY_TIMEOUT_SECONDS = 60
+_ZYGOTE_STOP_TIMEOUT_SECONDS = 5
+
+# Entrypoints with these need a shell, the zygote doesn't run them.
+_SHELL_METACHARACTERS_RE = re.compile(r'[|&;<>()`$*?!~\n]')
+
+# Quotes and escapes left in arguments that were split on whitespace, as the
+# factories of other runtimes do; only a shell removes them.
+_SHELL_QUOTES_RE = re.compile(r'[\'"\\]')
+
+# Placeholders replaced before the runtime process is started, see
+# needs_shell.
+_ENTRYPOINT_PLACEHOLDER_RE = re.compile(r'\$(\{PORT\}|PORT|\{FD\}|\{SOCKET\})')
+
+# Changes by NoCommandLine - how long a runtime process stopped with SIGTERM
+# may take to exit before its process group is killed.
+_QUIT_KILL_TIMEOUT_SECONDS = 10
+
+# Changes by NoCommandLine - the exit of runtime processes is noticed by the
+# _ProcessReaper, which polls processes it has no pidfd of this often.
+_REAPER_POLL_INTERVAL_SECONDS = 0.1
+# How long the returncode of a process forked by the zygote may take to
+# arrive after the process exited.
+_REAPER_RETURNCODE_TIMEOUT_SECONDS = 1
+
+# Changes by NoCommandLine - a runtime process started with an entrypoint is
+# replaced in the background when it exits without being quit. After a
+# process that ran for less than _RESTART_STABLE_SECONDS, the next one starts
+# after a delay doubling from _RESTART_BACKOFF_BASE_SECONDS up to the maximum.
+_RESTART_ENV = 'DEVAPPSERVER_RUNTIME_RESTART'
+_RESTART_MAX_BACKOFF_SECONDS_ENV = (
+    'DEVAPPSERVER_RUNTIME_RESTART_MAX_BACKOFF_SECONDS')
+_DEFAULT_RESTART_MAX_BACKOFF_SECONDS = 60
+_RESTART_BACKOFF_BASE_SECONDS = 1
+_RESTART_STABLE_SECONDS = 30
+# Requests wait this long for a replacement that is due; they fail at once
+# while it is held back longer.
+_RESTART_WAIT_SECONDS = 30
+
+# Changes by NoCommandLine - requests are forwarded over persistent
+# connections to the runtime process, see _ConnectionPool.
+_KEEP_ALIVE_ENV = 'DEVAPPSERVER_RUNTIME_KEEP_ALIVE'
+_KEEP_ALIVE_IDLE_SECONDS_ENV = 'DEVAPPSERVER_RUNTIME_KEEP_ALIVE_IDLE_SECONDS'
+_DEFAULT_KEEP_ALIVE_IDLE_SECONDS = 15
+# The pool size of instances that don't say how many requests they take.
+_DEFAULT_MAX_CONNECTIONS = 10
+# At most this many idle connections are kept per runtime process, however
+# many requests it takes at once (e.g. 100 for every uvicorn worker). Requests
+# beyond that still get a connection, which is closed after the response.
+_MAX_KEEP_ALIVE_CONNECTIONS = 32
+
+# Changes by NoCommandLine - request and response bodies are forwarded in
+# blocks of this size, and request bodies larger than the spool size are
+# copied to a temporary file first. See HttpRuntimeProxy.set_request_spool.
+_FORWARD_BLOCK_SIZE = 64 * 1024
+_REQUEST_SPOOL_KB_ENV = 'DEVAPPSERVER_REQUEST_SPOOL_KB'
+_DEFAULT_REQUEST_SPOOL_KB = 1024
+
+# Hop-by-hop request headers, they only apply to the connection to
+# dev_appserver and would stop the runtime from keeping its connection open.
+_HOP_BY_HOP_HEADERS = ('Connection', 'Keep-Alive', 'Proxy-Connection')
+
+_PORT_PLACEHOLDER_RE = re.compile(r'\$(\{PORT\}|PORT)')
+
+# A gunicorn bind option with its address in the same argument, e.g.
+# '--bind=:$PORT'.
+_GUNICORN_BIND_WITH_ADDRESS_RE = re.compile(r'^(-b|--bind=)(\S+)$')
+
+# For PORT_MODE_UNIX, the options of each server that take the address bound
+# to $PORT, the option passing the socket path instead, and options that can't
+# be used with it.
+_UNIX_SOCKET_OPTIONS = {
+    'gunicorn': (('-b', '--bind'), '--bind=unix:%s', ()),
+    'hypercorn': (('-b', '--bind'), '--bind=unix:%s', ()),
+    'uvicorn': (('--port',), '--uds=%s', ('--host',)),
+    'waitress-serve': (('--port', '--listen'), '--unix-socket=%s',
+                       ('--host',)),
+}
+
 
 def _sleep_between_retries(attempt, max_attempts, sleep_base):
   """Sleep between retry attempts.
@@ -106,69 +316,1780 @@ def _sleep_between_retries(attempt, max_attempts, sleep_base):
     time.sleep((2**attempt) * sleep_base)
 
 
-def _remove_retry_sharing_violation(path, max_attempts=10, sleep_base=0.125):
-  """Removes a file (with retries on Windows for sharing violations).
+def _remove_retry_sharing_violation(path, max_attempts=10, sleep_base=0.125):
+  """Removes a file (with retries on Windows for sharing violations).
+
+  Args:
+    path: The filesystem path to remove.
+    max_attempts: The maximum number of attempts to try to remove the path
+      before giving up.
+    sleep_base: How long in seconds to sleep between the first and second
+      attempt (the time will be doubled between each successive attempt). The
+      value may be any numeric type that is convertible to float (complex won't
+      work but user types that are sufficiently numeric-like will).
+
+  Raises:
+    WindowsError: When an error other than a sharing violation occurs.
+  """
+  if sys.platform == 'win32':
+    for attempt in range(max_attempts):
+      try:
+        os.remove(path)
+        break
+      except WindowsError as e:
+        import winerror
+        # Sharing violations are expected to occasionally occur when the runtime
+        # instance is context swapped after writing the port but before closing
+        # the file. Ignore these and try again.
+        if e.winerror != winerror.ERROR_SHARING_VIOLATION:
+          raise
+      _sleep_between_retries(attempt, max_attempts, sleep_base)
+    else:
+      logging.warn('Unable to delete %s', path)
+  else:
+    os.remove(path)
+
+
+def _parse_port_range(value):
+  """Returns the (first, last) ports of a 'first-last' range, or None."""
+  match = re.match(r'^\s*(\d+)\s*-\s*(\d+)\s*$', value or '')
+  if not match:
+    if value:
+      logging.warning('Ignoring invalid port range "%s".', value)
+    return None
+  first, last = int(match.group(1)), int(match.group(2))
+  if not 0 < first <= last < 65536:
+    logging.warning('Ignoring invalid port range "%s".', value)
+    return None
+  return first, last
+
+
+def needs_shell(command):
+  """Returns whether an entrypoint needs a shell to run.
+
+  Its placeholders ($PORT, ${PORT}, ${FD} and ${SOCKET}) don't, they are
+  replaced before the runtime process is started.
+  """
+  return bool(_SHELL_METACHARACTERS_RE.search(
+      _ENTRYPOINT_PLACEHOLDER_RE.sub('', command)))
+
+
+def _args_need_shell(args):
+  """Returns whether the arguments of an entrypoint need a shell to run.
+
+  On Windows the command line is passed on as it is, quotes included.
+  """
+  command = ' '.join(args)
+  return bool(_SHELL_METACHARACTERS_RE.search(command) or
+              (sys.platform != 'win32' and _SHELL_QUOTES_RE.search(command)))
+
+
+def _start_process_group(args, input_string, env, cwd, stderr, shell,
+                         pass_fds=()):
+  """Like safe_subprocess.start_process, in a new process group.
+
+  On POSIX the runtime process leads a new session, so it can be stopped with
+  everything it starts (see _stop_process_group), and keeps pass_fds open. On
+  Windows it gets a new process group, and without a shell its executable is
+  looked up in the PATH of env, like the shell did.
+  """
+  kwargs = {}
+  if sys.platform == 'win32':
+    kwargs['creationflags'] = subprocess.CREATE_NEW_PROCESS_GROUP
+    if not shell:
+      path = next((value for name, value in env.items()
+                   if name.upper() == 'PATH'), None)
+      executable = shutil.which(args[0], path=path) or args[0]
+      args = ' '.join([subprocess.list2cmdline([executable])] + args[1:])
+  else:
+    kwargs['start_new_session'] = True
+    kwargs['pass_fds'] = pass_fds
+  if shell and not isinstance(args, six.string_types):
+    args = ' '.join(args)
+  p = subprocess.Popen(args, env=env, cwd=cwd, stderr=stderr,
+                       stdin=subprocess.PIPE, shell=shell, **kwargs)
+  p.stdin.write(six.ensure_binary(input_string))
+  p.stdin.close()
+  p.stdin = None
+  return p
+
+
+def _stop_process_group(process, quit_with_sigterm):
+  """Stops a runtime process with everything it started.
+
+  The runtime process was started by _start_process_group or forked by a
+  Zygote. With quit_with_sigterm, its process group gets SIGTERM first, and
+  SIGKILL once the runtime process exited or _QUIT_KILL_TIMEOUT_SECONDS
+  passed, in a thread. On Windows, the process tree is killed with taskkill.
+  """
+  if sys.platform == 'win32':
+    subprocess.call(['taskkill', '/T', '/F', '/PID', str(process.pid)],
+                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return
+  try:
+    os.killpg(process.pid,
+              signal.SIGTERM if quit_with_sigterm else signal.SIGKILL)
+  except OSError:
+    pass
+
+  def wait_and_kill():
+    try:
+      process.wait(_QUIT_KILL_TIMEOUT_SECONDS if quit_with_sigterm else None)
+    except subprocess.TimeoutExpired:
+      pass
+    if quit_with_sigterm:
+      try:
+        os.killpg(process.pid, signal.SIGKILL)
+      except OSError:
+        pass
+
+  # Waiting also reaps the runtime process. A SIGKILL that is still due keeps
+  # dev_appserver from exiting before it was sent.
+  stopper = threading.Thread(target=wait_and_kill, name='RuntimeProcessStopper')
+  stopper.daemon = not quit_with_sigterm
+  stopper.start()
+
+
+def get_clone_environment_variables(module_configuration, runtime_config):
+  """Returns clone specific environment variables."""
+  keys_values = [
+      ('API_HOST', runtime_config.api_host),
+      ('API_PORT', runtime_config.api_port),
+      (
+          'GAE_LONG_APP_ID',
+          module_configuration.application_external_name
+          if module_configuration.application_external_name
+          else 'defaultappid"',
+      ),
+      ('GAE_PARTITION', module_configuration.partition),
+      ('GAE_MODULE_NAME', module_configuration.module_name),
+      (
+          'GAE_MODULE_VERSION',
+          module_configuration.major_version
+          if module_configuration.major_version
+          else '1',
+      ),
+      ('GAE_MINOR_VERSION', module_configuration.minor_version),
+      ('GAE_MODULE_INSTANCE', runtime_config.instance_id),
+      ('GAE_SERVER_PORT', runtime_config.server_port),
+      ('MODULE_YAML_PATH', os.path.basename(module_configuration.config_path)),
+      ('SERVER_SOFTWARE', http_runtime_constants.SERVER_SOFTWARE),
+  ]
+  for entry in runtime_config.environ:
+    keys_values.append((str(entry.key), str(entry.value)))
+
+  return {key: str(value) for key, value in keys_values}
+
+
+class StartupTimeline(object):
+  """Records how long the phases of module and instance startup take.
+
+  Every phase and event is appended to two files in the trace directory, both
+  named after the start time and pid of dev_appserver:
+   - <name>.jsonl, one JSON object per line with the name, category
+     ("module" or "instance"), start time and duration in seconds, thread and
+     arguments of the phase. Meant for scripts, e.g. to compare runs.
+   - <name>.trace.json, the same in the Chrome trace event format; open it in
+     chrome://tracing or https://ui.perfetto.dev.
+
+  Nothing is recorded unless a trace directory is set.
+  """
+
+  def __init__(self, trace_dir=None):
+    self._lock = threading.Lock()  # Guards the files and _thread_ids.
+    self._jsonl_file = None
+    self._trace_file = None
+    self._thread_ids = set()
+    self.set_trace_dir(trace_dir)
+
+  @property
+  def enabled(self):
+    return self._jsonl_file is not None
+
+  def set_trace_dir(self, trace_dir):
+    """Starts writing the timeline into trace_dir, or stops if it is None."""
+    with self._lock:
+      for f in (self._jsonl_file, self._trace_file):
+        if f is not None:
+          f.close()
+      self._jsonl_file = self._trace_file = None
+      self._thread_ids = set()
+      if not trace_dir:
+        return
+      if not os.path.exists(trace_dir):
+        os.makedirs(trace_dir)
+      name = os.path.join(trace_dir, 'startup-%s-%d' % (
+          time.strftime('%Y%m%d-%H%M%S'), os.getpid()))
+      self._jsonl_file = open(name + '.jsonl', 'a')
+      # The JSON array format of Chrome traces doesn't need the closing ].
+      self._trace_file = open(name + '.trace.json', 'w')
+      self._trace_file.write('[\n')
+    logging.info('Writing the startup timeline to %s.jsonl', name)
+
+  @contextlib.contextmanager
+  def phase(self, name, category, **args):
+    """Records the time spent in the with block as a phase.
+
+    Args:
+      name: The name of the phase.
+      category: "module" or "instance".
+      **args: Details of the phase. More can be added to the yielded dict
+        inside the block.
+
+    Yields:
+      The dict of arguments recorded with the phase.
+    """
+    start = time.time()
+    try:
+      yield args
+    finally:
+      if self.enabled:
+        self.record(name, category, start, time.time() - start, **args)
+
+  def event(self, name, category, **args):
+    """Records something that happened at one point in time."""
+    if self.enabled:
+      self.record(name, category, time.time(), None, **args)
+
+  def record(self, name, category, start, duration, **args):
+    """Records a phase measured elsewhere, or an event if duration is None."""
+    if not self.enabled:
+      return
+    thread = threading.current_thread()
+    entry = {
+        'name': name,
+        'category': category,
+        'start': start,
+        'duration': duration,
+        'thread': thread.name,
+        'args': args,
+    }
+    trace_event = {
+        'name': name,
+        'cat': category,
+        'ph': 'i' if duration is None else 'X',
+        'ts': int(start * 1e6),
+        'pid': os.getpid(),
+        'tid': thread.ident,
+        'args': args,
+    }
+    if duration is None:
+      trace_event['s'] = 't'
+    else:
+      trace_event['dur'] = int(duration * 1e6)
+    with self._lock:
+      if self._jsonl_file is None:
+        return
+      if thread.ident not in self._thread_ids:
+        self._thread_ids.add(thread.ident)
+        self._trace_file.write(json.dumps({
+            'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(),
+            'tid': thread.ident, 'args': {'name': thread.name}}) + ',\n')
+      self._jsonl_file.write(json.dumps(entry, default=str) + '\n')
+      self._trace_file.write(json.dumps(trace_event, default=str) + ',\n')
+      self._jsonl_file.flush()
+      self._trace_file.flush()
+
+
+startup_timeline = StartupTimeline(os.environ.get(_STARTUP_TRACE_DIR_ENV))
+
+
+class _RuntimeLogBuffer(object):
+  """The stderr output of a runtime process.
+
+  Output is numbered with offsets counted in bytes from the start of the
+  process, so readers can ask for everything after an offset they saw before
+  and only get the new output. The last capacity bytes are kept in memory.
+  Older output is appended to a log file if one is given, rotated at
+  _LOG_FILE_MAX_BYTES, and dropped otherwise.
+  """
+
+  def __init__(self, capacity, log_path=None, log_parser=None):
+    """Initializer for _RuntimeLogBuffer.
+
+    Args:
+      capacity: The number of bytes kept in memory.
+      log_path: Optional file older output is appended to.
+      log_parser: Optional _RuntimeLogParser all output is fed to.
+    """
+    self._capacity = capacity
+    self._log_path = log_path
+    self._log_parser = log_parser
+    self._lock = threading.Lock()  # Guards everything below.
+    # The output in memory is self._chunks[self._first:], and self._offsets
+    # has the offset of every chunk. Evicted chunks are only removed from the
+    # lists once they are half of it, so appending stays O(1).
+    self._chunks = []
+    self._offsets = []
+    self._first = 0
+    self._size = 0
+    self._end = 0  # The offset after the last output.
+    self._log_file = None
+    self._log_file_start = None  # The offset of its first byte once written.
+    self._requests = collections.OrderedDict()  # request id: [start, end]
+    self._handled_requests = set()  # Ids of the requests being handled.
+    self._eof = threading.Event()
+
+  def _single_request_id(self):
+    if len(self._handled_requests) == 1:
+      return next(iter(self._handled_requests))
+    return None
+
+  @property
+  def end_offset(self):
+    """The offset the next output will have."""
+    return self._end
+
+  def append(self, data):
+    """Adds output of the runtime process."""
+    if not data:
+      return
+    with self._lock:
+      if self._log_parser is not None:
+        self._log_parser.feed(data, self._single_request_id())
+      self._chunks.append(data)
+      self._offsets.append(self._end)
+      self._end += len(data)
+      self._size += len(data)
+      first = self._first
+      while self._size > self._capacity and first < len(self._chunks) - 1:
+        self._size -= len(self._chunks[first])
+        first += 1
+      if first == self._first:
+        return
+      evicted = self._chunks[self._first:first]
+      evicted_start = self._offsets[self._first]
+      self._first = first
+      if self._first * 2 > len(self._chunks):
+        del self._chunks[:self._first]
+        del self._offsets[:self._first]
+        self._first = 0
+      if self._log_path:
+        self._write_to_log_file(evicted_start, b''.join(evicted))
+
+  def _write_to_log_file(self, start, data):
+    try:
+      if (self._log_file is None or
+          self._log_file.tell() + len(data) > _LOG_FILE_MAX_BYTES):
+        self._rotate_log_file()
+        self._log_file_start = start
+      self._log_file.write(data)
+      self._log_file.flush()
+    except (IOError, OSError) as e:
+      logging.warning('Cannot write runtime output to %s: %s', self._log_path,
+                      e)
+      self._log_path = None
+      self._log_file_start = None
+
+  def _rotate_log_file(self):
+    if self._log_file is not None:
+      self._log_file.close()
+    # A file from before is rotated as well, the log file must start with
+    # the output at self._log_file_start.
+    if os.path.exists(self._log_path):
+      for i in range(_LOG_FILE_BACKUPS - 1, 0, -1):
+        if os.path.exists('%s.%d' % (self._log_path, i)):
+          os.rename('%s.%d' % (self._log_path, i),
+                    '%s.%d' % (self._log_path, i + 1))
+      os.rename(self._log_path, self._log_path + '.1')
+    self._log_file = open(self._log_path, 'wb')
+
+  def read(self, since=0):
+    """Returns the output after an offset.
+
+    Output that was evicted from memory is read from the log file, output
+    that was rotated away (or never written to a file) is skipped.
+
+    Args:
+      since: The offset to read from, e.g. the one returned by the last call.
+
+    Returns:
+      A (data, offset) tuple of the output and the offset to read from next.
+    """
+    with self._lock:
+      parts = []
+      first_offset = (self._offsets[self._first]
+                      if self._first < len(self._chunks) else self._end)
+      if since < first_offset and self._log_file_start is not None:
+        since = max(since, self._log_file_start)
+        with open(self._log_path, 'rb') as log_file:
+          log_file.seek(since - self._log_file_start)
+          parts.append(log_file.read(first_offset - since))
+      since = max(since, first_offset)
+      if since < self._end:
+        i = bisect.bisect_right(self._offsets, since, self._first) - 1
+        parts.append(self._chunks[i][since - self._offsets[i]:])
+        parts.extend(self._chunks[i + 1:])
+      return b''.join(parts), self._end
+
+  def tail(self, max_lines):
+    """Returns up to the last max_lines lines of output in memory."""
+    with self._lock:
+      parts = []
+      newlines = 0
+      for i in range(len(self._chunks) - 1, self._first - 1, -1):
+        parts.append(self._chunks[i])
+        newlines += self._chunks[i].count(b'\n')
+        if newlines > max_lines:
+          break
+    return b''.join(b''.join(reversed(parts)).splitlines(True)[-max_lines:])
+
+  def begin_request(self, request_id):
+    """Remembers where the output written while handling a request starts."""
+    with self._lock:
+      self._requests[request_id] = [self._end, None]
+      self._handled_requests.add(request_id)
+      if len(self._requests) > _MAX_TRACKED_REQUESTS:
+        self._requests.popitem(last=False)
+
+  def end_request(self, request_id):
+    with self._lock:
+      self._handled_requests.discard(request_id)
+      if request_id in self._requests:
+        self._requests[request_id][1] = self._end
+
+  def read_request(self, request_id):
+    """Returns the output written while a request was handled.
+
+    With concurrent requests, this includes the output of the others.
+
+    Args:
+      request_id: The id the request was handled with.
+
+    Returns:
+      The output, or None if the request is not known (any more).
+    """
+    with self._lock:
+      output_range = self._requests.get(request_id)
+      if output_range is None:
+        return None
+      start, end = output_range
+    data, next_offset = self.read(start)
+    if end is not None:
+      data = data[:len(data) - (next_offset - end)]
+    return data
+
+  def mark_eof(self):
+    """Called once the runtime process closed its stderr."""
+    with self._lock:
+      if self._log_parser is not None:
+        self._log_parser.flush(self._single_request_id())
+      if self._log_file is not None:
+        self._log_file.close()
+        self._log_file = None
+    self._eof.set()
+
+  def wait_for_eof(self, timeout):
+    """Waits until the runtime process closed its stderr.
+
+    Returns:
+      True if it did within timeout seconds.
+    """
+    return self._eof.wait(timeout)
+
+
+RuntimeLogRecord = collections.namedtuple(
+    'RuntimeLogRecord',
+    ['timestamp', 'severity', 'instance_id', 'request_id', 'message'])
+
+
+class _RuntimeLogStore(object):
+  """The lines of output of all runtime processes as RuntimeLogRecords.
+
+  Records are only appended, and the oldest are dropped once there are
+  max_records, so memory use stays flat. The records of a request and the
+  records with a severity of ERROR or above are indexed, so finding them
+  doesn't go through the others.
+  """
+
+  def __init__(self, max_records):
+    self._max_records = max_records
+    self._lock = threading.Lock()  # Guards everything below.
+    # The records are self._records[self._first:], numbered from
+    # self._number of self._records[0]. Dropped records are only removed from
+    # the list once they are half of it, so appending stays O(1).
+    self._records = []
+    self._first = 0
+    self._number = 0
+    self._by_request = collections.OrderedDict()  # request id: [numbers]
+    self._errors = collections.deque()  # numbers
+
+  def _end(self):
+    return self._number + len(self._records)
+
+  def add(self, record):
+    with self._lock:
+      number = self._end()
+      self._records.append(record)
+      if record.request_id is not None:
+        numbers = self._by_request.pop(record.request_id, None) or []
+        numbers.append(number)
+        self._by_request[record.request_id] = numbers
+        if len(self._by_request) > _MAX_TRACKED_REQUESTS:
+          self._by_request.popitem(last=False)
+      if _LOG_SEVERITIES[record.severity] >= _LOG_SEVERITIES['ERROR']:
+        self._errors.append(number)
+      if len(self._records) - self._first > self._max_records:
+        self._drop_oldest()
+
+  def _drop_oldest(self):
+    dropped = self._records[self._first]
+    self._records[self._first] = None
+    self._first += 1
+    first_number = self._number + self._first
+    if self._errors and self._errors[0] < first_number:
+      self._errors.popleft()
+    numbers = self._by_request.get(dropped.request_id)
+    if numbers is not None and numbers[0] < first_number:
+      # Numbers of a request increase, so its dropped records come first.
+      del numbers[0]
+      if not numbers:
+        del self._by_request[dropped.request_id]
+    if self._first * 2 > len(self._records):
+      del self._records[:self._first]
+      self._number += self._first
+      self._first = 0
+
+  def _get(self, number):
+    return self._records[number - self._number]
+
+  def get_request_records(self, request_id):
+    with self._lock:
+      return [self._get(n) for n in self._by_request.get(request_id, ())]
+
+  def get_errors(self, seconds):
+    """Returns the records of errors of the last seconds, oldest first."""
+    since = time.time() - seconds
+    with self._lock:
+      records = []
+      for number in reversed(self._errors):
+        record = self._get(number)
+        if record.timestamp < since:
+          break
+        records.append(record)
+    records.reverse()
+    return records
+
+
+_runtime_log_store = None
+_runtime_log_store_lock = threading.Lock()  # Guards _runtime_log_store.
+
+
+def _get_runtime_log_store():
+  global _runtime_log_store
+  with _runtime_log_store_lock:
+    if _runtime_log_store is None:
+      _runtime_log_store = _RuntimeLogStore(
+          HttpRuntimeProxy._log_records)
+    return _runtime_log_store
+
+
+class _RuntimeLogParser(object):
+  """Turns the output of a runtime process into RuntimeLogRecords.
+
+  The severity is taken from JSON lines (Cloud Logging structured logs) or
+  from a level near the start of a line, and lines of a traceback are
+  ERRORs. The request id is only known while a single request is handled by
+  the runtime process.
+  """
+
+  def __init__(self, instance_id, log_store):
+    self.instance_id = instance_id  # See HttpRuntimeProxy.set_instance_id.
+    self._log_store = log_store
+    self._partial_line = b''
+    self._in_traceback = False
+
+  def feed(self, data, request_id):
+    """Adds the records of the complete lines in data."""
+    lines = (self._partial_line + data).split(b'\n')
+    self._partial_line = lines.pop()
+    for line in lines:
+      self._add(line, request_id)
+
+  def flush(self, request_id):
+    """Adds the record of a line that wasn't completed."""
+    if self._partial_line:
+      self._add(self._partial_line, request_id)
+      self._partial_line = b''
+
+  def _add(self, line, request_id):
+    line = line.rstrip(b'\r')
+    if not line:
+      return
+    message = line[:_MAX_LOG_RECORD_BYTES].decode('utf-8', 'replace')
+    severity, message = self._parse(line, message)
+    self._log_store.add(RuntimeLogRecord(
+        time.time(), severity, self.instance_id, request_id, message))
+
+  def _parse(self, line, message):
+    if line.startswith(_TRACEBACK_START):
+      self._in_traceback = True
+      return 'ERROR', message
+    if self._in_traceback:
+      # The exception line ends a traceback, unless another one is chained.
+      if (not line[:1].isspace() and
+          not line.startswith(_TRACEBACK_CHAIN_PREFIXES)):
+        self._in_traceback = False
+      return 'ERROR', message
+    if line.startswith(b'{'):
+      try:
+        entry = json.loads(message)
+      except ValueError:
+        entry = None
+      if isinstance(entry, dict):
+        severity = str(entry.get('severity', '')).upper()
+        severity = _LOG_SEVERITY_ALIASES.get(severity, severity)
+        if 'message' in entry:
+          message = u'%s' % (entry['message'],)
+        if severity in _LOG_SEVERITIES:
+          return severity, message
+        return 'DEFAULT', message
+    match = _LOG_SEVERITY_RE.search(line, 0, _LOG_SEVERITY_SEARCH_BYTES)
+    if match is None:
+      return 'DEFAULT', message
+    severity = match.group(1).decode('ascii')
+    return _LOG_SEVERITY_ALIASES.get(severity, severity), message
+
+
+class _LogTee(threading.Thread):
+  """Copies the stderr of a runtime process to the console and its buffer."""
+
+  def __init__(self, in_f, out_f, log_buffer):
+    super(_LogTee, self).__init__(name='Tee')
+    self.daemon = True
+    self._in = in_f
+    self._out = out_f
+    self._log_buffer = log_buffer
+
+  def run(self):
+    try:
+      for line in iter(self._in.readline, b''):
+        self._out.write(line)
+        self._out.flush()
+        self._log_buffer.append(line)
+    finally:
+      self._log_buffer.mark_eof()
+
+
+class _PumpedPipe(object):
+  """A stderr pipe serviced by the _LogPump."""
+
+  def __init__(self, pipe, out, log_buffer):
+    self.pipe = pipe
+    self.out = out
+    self.log_buffer = log_buffer
+    self.partial_line = b''
+    self.partial_line_time = None
+
+
+class _LogPump(object):
+  """Copies the stderr of every runtime process, with a single thread.
+
+  Pipes are read without blocking as they become readable, and the complete
+  lines read in a round are written to the console with one write, so lines
+  of different instances don't get mixed up. An incomplete line is written
+  when it is completed, or after _PARTIAL_LINE_DELAY_SECONDS. A pipe is
+  closed and removed when the runtime process (and all its children) closed
+  it, nobody has to wait for that.
+
+  Selectors don't support pipes on Windows, where _LogTee threads are used.
+  """
+
+  def __init__(self):
+    self._selector = selectors.DefaultSelector()
+    self._lock = threading.Lock()  # Guards _new_pipes.
+    self._new_pipes = []
+    self._partial_lines = set()  # _PumpedPipes with a partial line.
+    # Writing to this pipe wakes the thread up to pick up _new_pipes.
+    self._wake_up_r, self._wake_up_w = os.pipe()
+    os.set_blocking(self._wake_up_r, False)
+    self._selector.register(self._wake_up_r, selectors.EVENT_READ)
+    self._thread = threading.Thread(target=self._run, name='RuntimeLogPump')
+    self._thread.daemon = True
+    self._thread.start()
+
+  def add(self, pipe, out, log_buffer):
+    """Starts copying pipe to out and log_buffer."""
+    os.set_blocking(pipe.fileno(), False)
+    with self._lock:
+      self._new_pipes.append(_PumpedPipe(pipe, out, log_buffer))
+    os.write(self._wake_up_w, b'\0')
+
+  def _run(self):
+    while True:
+      timeout = _PARTIAL_LINE_DELAY_SECONDS if self._partial_lines else None
+      console_output = collections.OrderedDict()  # out: [bytes]
+      for key, _ in self._selector.select(timeout):
+        if key.data is None:
+          self._add_new_pipes()
+          continue
+        try:
+          self._read(key.data, console_output)
+        except Exception:  # pylint: disable=broad-except
+          logging.exception('Failed copying runtime output.')
+          self._remove(key.data, console_output)
+      self._flush_partial_lines(console_output)
+      for out, data in console_output.items():
+        try:
+          out.write(b''.join(data))
+          out.flush()
+        except (IOError, OSError, ValueError):
+          pass
+
+  def _add_new_pipes(self):
+    try:
+      while os.read(self._wake_up_r, _PIPE_READ_SIZE):
+        pass
+    except BlockingIOError:
+      pass
+    with self._lock:
+      new_pipes, self._new_pipes = self._new_pipes, []
+    for pumped_pipe in new_pipes:
+      self._selector.register(pumped_pipe.pipe, selectors.EVENT_READ,
+                              pumped_pipe)
+
+  def _read(self, pumped_pipe, console_output):
+    try:
+      data = os.read(pumped_pipe.pipe.fileno(), _PIPE_READ_SIZE)
+    except BlockingIOError:
+      return
+    if not data:
+      self._remove(pumped_pipe, console_output)
+      return
+    pumped_pipe.log_buffer.append(data)
+    data = pumped_pipe.partial_line + data
+    end_of_lines = data.rfind(b'\n') + 1
+    if end_of_lines:
+      console_output.setdefault(pumped_pipe.out, []).append(
+          data[:end_of_lines])
+    if end_of_lines == len(data):
+      pumped_pipe.partial_line = b''
+      self._partial_lines.discard(pumped_pipe)
+    else:
+      if not pumped_pipe.partial_line or end_of_lines:
+        pumped_pipe.partial_line_time = time.time()
+      pumped_pipe.partial_line = data[end_of_lines:]
+      self._partial_lines.add(pumped_pipe)
+
+  def _flush_partial_lines(self, console_output, force_pipe=None):
+    now = time.time()
+    for pumped_pipe in list(self._partial_lines):
+      if (pumped_pipe is force_pipe or now - pumped_pipe.partial_line_time >=
+          _PARTIAL_LINE_DELAY_SECONDS):
+        console_output.setdefault(pumped_pipe.out, []).append(
+            pumped_pipe.partial_line)
+        pumped_pipe.partial_line = b''
+        self._partial_lines.discard(pumped_pipe)
+
+  def _remove(self, pumped_pipe, console_output):
+    self._flush_partial_lines(console_output, force_pipe=pumped_pipe)
+    self._selector.unregister(pumped_pipe.pipe)
+    pumped_pipe.pipe.close()
+    pumped_pipe.log_buffer.mark_eof()
+
+
+_log_pump = None
+_log_pump_lock = threading.Lock()  # Guards _log_pump.
+
+
+def _get_log_pump():
+  global _log_pump
+  with _log_pump_lock:
+    if _log_pump is None:
+      _log_pump = _LogPump()
+    return _log_pump
+
+
+class _ConsoleForwarder(object):
+  """Writes runtime output to the console from a thread of its own.
+
+  write() only queues the output, so a slow console doesn't hold up copying
+  the output into the log buffers. The forwarding thread writes everything
+  queued at once. When more than capacity bytes are queued, the policy
+  decides between waiting (LOG_FORWARD_BLOCK), dropping the oldest queued
+  output (LOG_FORWARD_DROP_OLDEST) or only taking some lines
+  (LOG_FORWARD_SAMPLE, which can queue up to twice capacity). Dropped output
+  is only missing from the console, and a line telling how much is written
+  in its place.
+
+  With LOG_FORWARD_BLOCK, write() waits on the thread of the _LogPump, which
+  then stops copying the output of every runtime process until the console
+  caught up.
+  """
+
+  def __init__(self, out, policy, capacity):
+    self._out = out
+    self._policy = policy
+    self._capacity = capacity
+    self._lock = threading.Lock()  # Guards everything below.
+    self._queued = threading.Condition(self._lock)
+    self._written = threading.Condition(self._lock)
+    self._queue = collections.deque()
+    self._size = 0  # Bytes queued or being written.
+    self._sampled_lines = 0
+    self._forwarded_bytes = 0
+    self._dropped_bytes = 0
+    self._reported_dropped_bytes = 0
+    self._delayed_bytes = 0
+    self._blocked_seconds = 0.0
+    self._thread = threading.Thread(target=self._run,
+                                    name='RuntimeLogForwarder')
+    self._thread.daemon = True
+    self._thread.start()
+    atexit.register(self.drain, _LOG_FORWARD_EXIT_TIMEOUT_SECONDS)
+
+  def configure(self, policy, capacity):
+    with self._lock:
+      self._policy = policy
+      self._capacity = capacity
+      self._written.notify_all()
+
+  def write(self, data):
+    """Queues output to be written to the console."""
+    if not data:
+      return
+    with self._lock:
+      if self._size + len(data) > self._capacity:
+        if self._policy == LOG_FORWARD_BLOCK:
+          self._delayed_bytes += len(data)
+          start = time.time()
+          while self._size and self._size + len(data) > self._capacity:
+            self._written.wait()
+          self._blocked_seconds += time.time() - start
+        elif self._policy == LOG_FORWARD_DROP_OLDEST:
+          while self._queue and self._size + len(data) > self._capacity:
+            dropped = self._queue.popleft()
+            self._size -= len(dropped)
+            self._dropped_bytes += len(dropped)
+        else:
+          data = self._sample(data)
+      if data:
+        self._queue.append(data)
+        self._size += len(data)
+        self._queued.notify()
+
+  def _sample(self, data):
+    kept = []
+    for line in data.splitlines(True):
+      self._sampled_lines += 1
+      if (self._sampled_lines % _LOG_SAMPLE_RATE == 0 and
+          self._size + len(line) <= 2 * self._capacity):
+        kept.append(line)
+      else:
+        self._dropped_bytes += len(line)
+    return b''.join(kept)
+
+  def flush(self):
+    """Does nothing, the forwarding thread flushes the console."""
+
+  def _run(self):
+    while True:
+      with self._lock:
+        while not self._queue:
+          self._queued.wait()
+        data = b''.join(self._queue)
+        self._queue.clear()
+        dropped = self._dropped_bytes - self._reported_dropped_bytes
+        self._reported_dropped_bytes = self._dropped_bytes
+      notice = b''
+      if dropped:
+        notice = (b'[dev_appserver] %d bytes of runtime output were not '
+                  b'shown, the console could not keep up.\n' % dropped)
+      try:
+        self._out.write(notice + data)
+        self._out.flush()
+      except (IOError, OSError, ValueError):
+        pass
+      with self._lock:
+        self._forwarded_bytes += len(data)
+        self._size -= len(data)
+        self._written.notify_all()
+
+  def drain(self, timeout):
+    """Waits until everything queued was written to the console."""
+    deadline = time.time() + timeout
+    with self._lock:
+      while self._size > 0 and time.time() < deadline:
+        self._written.wait(deadline - time.time())
+
+  def get_stats(self):
+    """Returns a dict of counters of the output forwarded so far."""
+    with self._lock:
+      return {
+          'forwarded_bytes': self._forwarded_bytes,
+          'dropped_bytes': self._dropped_bytes,
+          'delayed_bytes': self._delayed_bytes,
+          'blocked_seconds': self._blocked_seconds,
+          'queued_bytes': self._size,
+      }
+
+
+_console_forwarder = None
+_console_forwarder_lock = threading.Lock()  # Guards _console_forwarder.
+
+
+def _get_console_forwarder():
+  global _console_forwarder
+  with _console_forwarder_lock:
+    if _console_forwarder is None:
+      _console_forwarder = _ConsoleForwarder(
+          sys.stderr if six.PY2 else sys.stderr.buffer,
+          HttpRuntimeProxy._log_forward_policy,
+          HttpRuntimeProxy._log_forward_buffer_bytes)
+    return _console_forwarder
+
+
+class _WatchedProcess(object):
+  """A runtime process watched by the _ProcessReaper."""
+
+  def __init__(self, process, callback, pidfd):
+    self.process = process
+    self.callback = callback
+    self.pidfd = pidfd
+    self.registered = False
+
+
+class _ProcessReaper(object):
+  """Notices the exit of every runtime process, with a single thread.
+
+  On Linux the thread selects on a pidfd of each process, which becomes
+  readable the moment the process exits, whether dev_appserver started it or
+  a Zygote forked it. Elsewhere, and for processes that were gone before they
+  were watched, the processes are polled every _REAPER_POLL_INTERVAL_SECONDS.
+  A SIGCHLD handler can only be installed by the main thread, and wouldn't
+  see the processes of a Zygote.
+
+  An exited process is reaped, then the callback it was watched with is
+  called on the thread of the reaper.
+  """
+
+  def __init__(self):
+    self._selector = selectors.DefaultSelector()
+    self._lock = threading.Lock()  # Guards _watched.
+    self._watched = {}  # process: _WatchedProcess
+    # Writing to this socket wakes the thread up to pick up new processes;
+    # selectors support sockets everywhere.
+    self._wake_up_r, self._wake_up_w = socket.socketpair()
+    self._wake_up_r.setblocking(False)
+    self._selector.register(self._wake_up_r, selectors.EVENT_READ)
+    self._thread = threading.Thread(target=self._run,
+                                    name='RuntimeProcessReaper')
+    self._thread.daemon = True
+    self._thread.start()
+
+  def watch(self, process, callback):
+    """Calls callback(process) once process exited."""
+    pidfd = None
+    if hasattr(os, 'pidfd_open'):
+      try:
+        pidfd = os.pidfd_open(process.pid)
+      except OSError:
+        pass  # The process is gone already, or the kernel is too old.
+    with self._lock:
+      self._watched[process] = _WatchedProcess(process, callback, pidfd)
+    self._wake_up_w.send(b'\0')
+
+  def _run(self):
+    while True:
+      with self._lock:
+        watched = list(self._watched.values())
+      polled = [w for w in watched if w.pidfd is None]
+      for watched_process in watched:
+        if watched_process.pidfd is not None and not watched_process.registered:
+          self._selector.register(watched_process.pidfd, selectors.EVENT_READ,
+                                  watched_process)
+          watched_process.registered = True
+      exited = []
+      timeout = _REAPER_POLL_INTERVAL_SECONDS if polled else None
+      for key, _ in self._selector.select(timeout):
+        if key.data is None:
+          try:
+            while self._wake_up_r.recv(_PIPE_READ_SIZE):
+              pass
+          except BlockingIOError:
+            pass
+        else:
+          exited.append(key.data)
+      exited.extend(w for w in polled if w.process.poll() is not None)
+      for watched_process in exited:
+        self._reap(watched_process)
+
+  def _reap(self, watched_process):
+    with self._lock:
+      del self._watched[watched_process.process]
+    if watched_process.pidfd is not None:
+      self._selector.unregister(watched_process.pidfd)
+      os.close(watched_process.pidfd)
+      try:
+        watched_process.process.wait(_REAPER_RETURNCODE_TIMEOUT_SECONDS)
+      except subprocess.TimeoutExpired:
+        pass
+    try:
+      watched_process.callback(watched_process.process)
+    except Exception:  # pylint: disable=broad-except
+      logging.exception('Failed handling the exit of a runtime process.')
+
+
+_process_reaper = None
+_process_reaper_lock = threading.Lock()  # Guards _process_reaper.
+
+
+def _get_process_reaper():
+  global _process_reaper
+  with _process_reaper_lock:
+    if _process_reaper is None:
+      _process_reaper = _ProcessReaper()
+    return _process_reaper
+
+
+# Runs in the virtualenv of a module as:
+#   python -c _ZYGOTE_SCRIPT <socket path> [<module to preload>...]
+# It imports the modules given, or else the installed packages in _PRELOADED,
+# then forks a runtime process for every request on the socket. A request is
+# a 4 byte length and a JSON object with argv, env, cwd and listen_fd, sent
+# with the stderr of the process and optionally a listening socket as
+# SCM_RIGHTS. The answer is a JSON line with the pid, and another one with
+# the returncode once the process exited. The zygote and its processes exit
+# when stdin is closed.
+_ZYGOTE_SCRIPT = r'''
+import array, errno, json, os, runpy, select, signal, socket, struct
+import sys, threading, traceback
+
+# Packages known to be safe to fork after they were imported: they start no
+# threads and open no connections on import. Others, e.g. grpc, are only
+# preloaded when listed in DEVAPPSERVER_ZYGOTE_PRELOAD.
+_PRELOADED = {
+    'anyio', 'click', 'dateutil', 'django', 'fastapi', 'flask', 'gunicorn',
+    'itsdangerous', 'jinja2', 'markupsafe', 'pydantic', 'pytz', 'requests',
+    'six', 'sqlalchemy', 'starlette', 'urllib3', 'werkzeug', 'yaml',
+}
+
+
+def installed_modules():
+  try:
+    from importlib import metadata
+  except ImportError:
+    return []
+  names = set()
+  for dist in metadata.distributions():
+    top_level = dist.read_text('top_level.txt')
+    if top_level:
+      names.update(top_level.split())
+      continue
+    for path in dist.files or ():
+      parts = path.parts
+      if len(parts) > 1 and not parts[0].endswith(('.dist-info', '.data')):
+        names.add(parts[0])
+      elif len(parts) == 1 and parts[0].endswith('.py'):
+        names.add(parts[0][:-3])
+  return sorted(names & _PRELOADED)
+
+
+def preload(modules):
+  for name in modules:
+    try:
+      __import__(name)
+    except Exception:
+      pass
+  if threading.active_count() > 1:
+    sys.stderr.write('zygote: preloaded modules started threads, which '
+                     'forked runtime processes will not have.\n')
+
+
+def recv_request(conn):
+  fds = array.array('i')
+  data, ancdata, _, _ = conn.recvmsg(65536, socket.CMSG_LEN(2 * fds.itemsize))
+  for level, kind, cmsg in ancdata:
+    if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+      fds.frombytes(cmsg[:len(cmsg) - len(cmsg) % fds.itemsize])
+  while len(data) < 4 or len(data) < 4 + struct.unpack('!I', data[:4])[0]:
+    chunk = conn.recv(65536)
+    if not chunk:
+      raise EOFError()
+    data += chunk
+  return json.loads(data[4:].decode('utf-8')), list(fds)
+
+
+def which(name, path):
+  if os.sep in name:
+    return name
+  for directory in path.split(os.pathsep):
+    candidate = os.path.join(directory, name)
+    if os.path.isfile(candidate) and os.access(candidate, os.X_OK):
+      return candidate
+  return None
+
+
+def run(argv):
+  if argv and argv[0] == 'exec':
+    argv = argv[1:]
+  if not argv:
+    return 0
+  if os.path.basename(argv[0]).startswith('python'):
+    if argv[1:2] == ['-m'] and len(argv) > 2:
+      sys.argv = argv[2:]
+      sys.path.insert(0, os.getcwd())
+      runpy.run_module(argv[2], run_name='__main__', alter_sys=True)
+      return 0
+    if len(argv) > 1 and not argv[1].startswith('-'):
+      sys.argv = argv[1:]
+      sys.path.insert(0, os.path.dirname(os.path.abspath(argv[1])))
+      runpy.run_path(argv[1], run_name='__main__')
+      return 0
+  path = which(argv[0], os.environ.get('PATH', os.defpath))
+  if path is not None:
+    with open(path, 'rb') as f:
+      first_line = f.readline()
+    if first_line.startswith(b'#!') and b'python' in first_line:
+      sys.argv = [path] + argv[1:]
+      sys.path.insert(0, os.path.dirname(path))
+      runpy.run_path(path, run_name='__main__')
+      return 0
+  os.execvp(argv[0], argv)
+
+
+def child(request, fds, closed):
+  for fd in closed:
+    os.close(fd)
+  signal.set_wakeup_fd(-1)
+  signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+  signal.signal(signal.SIGINT, signal.default_int_handler)
+  os.setsid()
+  null = os.open(os.devnull, os.O_RDONLY)
+  os.dup2(null, 0)
+  os.dup2(fds[0], 2)
+  if request.get('listen_fd') is not None and len(fds) > 1:
+    os.dup2(fds[1], request['listen_fd'])
+    os.set_inheritable(request['listen_fd'], True)
+  for fd in set(fds + [null]) - {0, 2, request.get('listen_fd')}:
+    os.close(fd)
+  os.environ.clear()
+  os.environ.update(request['env'])
+  os.chdir(request['cwd'])
+  if 'random' in sys.modules:
+    sys.modules['random'].seed()
+  code = 1
+  try:
+    code = run(request['argv'])
+  except SystemExit as e:
+    code = e.code
+    if code is not None and not isinstance(code, int):
+      sys.stderr.write('%s\n' % code)
+      code = 1
+  except BaseException:
+    traceback.print_exc()
+  finally:
+    for stream in (sys.stdout, sys.stderr):
+      try:
+        stream.flush()
+      except Exception:
+        pass
+    os._exit(code or 0)
+
+
+def main():
+  socket_path = sys.argv[1]
+  # Only packages are preloaded, never the app in the working directory.
+  del sys.path[0]
+  preload(sys.argv[2:] or installed_modules())
+  server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  server.bind(socket_path)
+  server.listen(16)
+  wake_up_r, wake_up_w = os.pipe()
+  os.set_blocking(wake_up_w, False)
+  signal.set_wakeup_fd(wake_up_w)
+  signal.signal(signal.SIGCHLD, lambda *_: None)
+  # Ctrl+C is for dev_appserver, which stops the zygote.
+  signal.signal(signal.SIGINT, signal.SIG_IGN)
+  conns = {}  # pid: connection waiting for the returncode.
+  while True:
+    try:
+      readable, _, _ = select.select([server, wake_up_r, sys.stdin], [], [])
+    except (OSError, select.error) as e:
+      if e.args[0] == errno.EINTR:
+        continue
+      raise
+    if sys.stdin in readable and not os.read(sys.stdin.fileno(), 1024):
+      for pid in conns:
+        try:
+          os.killpg(pid, signal.SIGKILL)
+        except OSError:
+          pass
+      return
+    if wake_up_r in readable:
+      os.read(wake_up_r, 1024)
+      while conns:
+        try:
+          pid, status = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+          break
+        if not pid:
+          break
+        code = (-os.WTERMSIG(status) if os.WIFSIGNALED(status)
+                else os.WEXITSTATUS(status))
+        conn = conns.pop(pid, None)
+        if conn is not None:
+          try:
+            conn.sendall(json.dumps({'returncode': code}).encode() + b'\n')
+          except OSError:
+            pass
+          conn.close()
+    if server in readable:
+      conn, _ = server.accept()
+      try:
+        request, fds = recv_request(conn)
+      except (OSError, EOFError, ValueError):
+        conn.close()
+        continue
+      pid = os.fork()
+      if pid == 0:
+        child(request, fds, [server.fileno(), conn.fileno(), wake_up_r,
+                             wake_up_w] + [c.fileno() for c in conns.values()])
+      for fd in fds:
+        os.close(fd)
+      conns[pid] = conn
+      conn.sendall(json.dumps({'pid': pid}).encode() + b'\n')
+
+
+main()
+'''
+
+
+class _ZygoteProcess(object):
+  """A runtime process forked by a Zygote, used like a subprocess.Popen."""
+
+  def __init__(self, pid, conn, stderr):
+    self.pid = pid
+    self.stderr = stderr
+    self.returncode = None
+    self._conn = conn
+    # Guards _conn and _received; the reaper polls while quit() waits.
+    self._lock = threading.Lock()
+    self._received = b''
+
+  def poll(self):
+    if self.returncode is None:
+      self._receive_returncode(0)
+    return self.returncode
+
+  def wait(self, timeout=None):
+    if (self.returncode is None and
+        not self._receive_returncode(timeout)):
+      raise subprocess.TimeoutExpired(str(self.pid), timeout)
+    return self.returncode
+
+  def _receive_returncode(self, timeout):
+    """Reads the returncode the zygote sends once the process exited.
+
+    Args:
+      timeout: Seconds to wait for the returncode, None to wait without one.
+
+    Returns:
+      False if the timeout passed, True otherwise.
+    """
+    deadline = None if timeout is None else time.time() + timeout
+    # A poll doesn't wait for a wait in another thread.
+    if not self._lock.acquire(timeout=-1 if timeout is None else timeout):
+      return False
+    try:
+      while self.returncode is None:
+        if b'\n' in self._received:
+          self.returncode = json.loads(
+              self._received.decode('utf-8'))['returncode']
+          self._conn.close()
+          break
+        remaining = (None if deadline is None else
+                     max(0, deadline - time.time()))
+        readable, _, _ = select.select([self._conn], [], [], remaining)
+        if not readable:
+          return False
+        data = self._conn.recv(1024)
+        if not data:
+          # The zygote is gone, and with it the knowledge of the returncode.
+          if self._gone():
+            self.returncode = -signal.SIGKILL
+          break
+        self._received += data
+      return True
+    finally:
+      self._lock.release()
+
+  def _gone(self):
+    try:
+      os.kill(self.pid, 0)
+    except OSError:
+      return True
+    return False
+
+  def send_signal(self, sig):
+    if self.poll() is not None:
+      return
+    # The process is the leader of its own process group.
+    try:
+      os.killpg(self.pid, sig)
+    except OSError:
+      os.kill(self.pid, sig)
+
+  def terminate(self):
+    self.send_signal(signal.SIGTERM)
+
+  def kill(self):
+    self.send_signal(signal.SIGKILL)
+
+
+class Zygote(object):
+  """Forks the runtime processes of a module from a preloaded interpreter.
+
+  The zygote is a Python process in the virtualenv of the module that
+  imported the modules in DEVAPPSERVER_ZYGOTE_PRELOAD (or else the installed
+  packages known to be safe to fork, like flask) before it forks a runtime process, which then
+  runs the entrypoint in itself. A runtime process only imports the app, and
+  shares the memory of the packages with the zygote. The app is never
+  imported by the zygote, so it serves code changes; a change of the
+  virtualenv needs a new zygote.
+
+  Only supported on POSIX. Entrypoints that need a shell, or anything the
+  zygote can't do, are started as usual.
+  """
+
+  def __init__(self, python_path, env, cwd):
+    """Initializer for Zygote.
+
+    Args:
+      python_path: The Python interpreter of the virtualenv.
+      env: The environment variables of the zygote.
+      cwd: The working directory of the zygote.
+    """
+    self._dir = tempfile.mkdtemp(prefix='devappserver-zygote-')
+    self._socket_path = os.path.join(self._dir, 'zygote')
+    preload = (os.environ.get(_ZYGOTE_PRELOAD_ENV) or '').split(',')
+    self._process = subprocess.Popen(
+        [python_path, '-c', _ZYGOTE_SCRIPT, self._socket_path] +
+        [name.strip() for name in preload if name.strip()],
+        stdin=subprocess.PIPE, env=env, cwd=cwd, close_fds=True)
+
+  def _connect(self):
+    deadline = time.time() + _ZYGOTE_READY_TIMEOUT_SECONDS
+    while True:
+      if self._process.poll() is not None:
+        raise IOError('the zygote exited with %d' % self._process.returncode)
+      conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+      try:
+        conn.connect(self._socket_path)
+        return conn
+      except (IOError, OSError):
+        conn.close()
+        if time.time() > deadline:
+          raise
+      time.sleep(0.01)
+
+  def spawn(self, args, env, cwd, listen_fd=None):
+    """Forks a runtime process.
+
+    Args:
+      args: The arguments of the entrypoint.
+      env: The environment variables of the runtime process.
+      cwd: The working directory of the runtime process.
+      listen_fd: Optional listening socket the runtime process gets with the
+        same file descriptor.
+
+    Returns:
+      A _ZygoteProcess whose stderr is a pipe.
+
+    Raises:
+      IOError: The zygote isn't running.
+    """
+    request = json.dumps({'argv': args, 'env': env, 'cwd': cwd,
+                          'listen_fd': listen_fd}).encode('utf-8')
+    conn = self._connect()
+    stderr_r, stderr_w = os.pipe()
+    try:
+      fds = [stderr_w] + ([listen_fd] if listen_fd is not None else [])
+      conn.sendmsg([struct.pack('!I', len(request)) + request],
+                   [(socket.SOL_SOCKET, socket.SCM_RIGHTS,
+                     struct.pack('%di' % len(fds), *fds))])
+      answer = b''
+      while not answer.endswith(b'\n'):
+        data = conn.recv(1)
+        if not data:
+          raise IOError('the zygote did not fork')
+        answer += data
+    except Exception:
+      conn.close()
+      os.close(stderr_r)
+      raise
+    finally:
+      os.close(stderr_w)
+    return _ZygoteProcess(json.loads(answer.decode('utf-8'))['pid'], conn,
+                          os.fdopen(stderr_r, 'rb'))
+
+  def stop(self):
+    """Stops the zygote.
+
+    The runtime processes it forked keep running until they are quit, unlike
+    when dev_appserver exits without stopping the zygote.
+    """
+    try:
+      self._process.terminate()
+      self._process.wait(_ZYGOTE_STOP_TIMEOUT_SECONDS)
+    except (IOError, OSError, subprocess.TimeoutExpired):
+      self._process.kill()
+    self._process.stdin.close()
+    shutil.rmtree(self._dir, ignore_errors=True)
+
+
+def _is_connection_usable(connection):
+  """Returns whether an idle connection can send another request.
+
+  Nothing is sent on an idle connection, so one that is readable was closed by
+  the runtime process, or has data on it no request asked for.
+  """
+  if connection.sock is None:
+    return False
+  try:
+    readable, _, _ = select.select([connection.sock], [], [], 0)
+  except (ValueError, socket.error):
+    return False
+  return not readable
+
+
+class _ConnectionPool(object):
+  """Persistent HTTP/1.1 connections to a runtime process.
+
+  Idle connections are reused last in, first out, so the ones left idle are
+  the ones to expire. A connection is checked before it is reused, and closed
+  once it was idle for longer than max_idle_seconds; at most max_size are kept.
+  """
+
+  def __init__(self, connection_factory, max_size, max_idle_seconds):
+    self._connection_factory = connection_factory
+    self._max_size = max_size
+    self._max_idle_seconds = max_idle_seconds
+    self._lock = threading.Lock()  # Guards the values below.
+    self._idle = collections.deque()  # (connection, idle since), oldest first.
+    self._closed = False
+
+  def get(self):
+    """Returns a (connection, reused) tuple.
+
+    A reused connection served a request before, and may still be closed by
+    the runtime process before it sees the next one.
+    """
+    now = time.time()
+    stale = []
+    connection = None
+    with self._lock:
+      while (self._idle and
+             now - self._idle[0][1] > self._max_idle_seconds):
+        stale.append(self._idle.popleft()[0])
+      while self._idle:
+        candidate, _ = self._idle.pop()
+        if _is_connection_usable(candidate):
+          connection = candidate
+          break
+        stale.append(candidate)
+    for stale_connection in stale:
+      stale_connection.close()
+    if connection is not None:
+      return connection, True
+    return self.connect(), False
+
+  def connect(self):
+    """Returns a new connection."""
+    return self._connection_factory()
+
+  def put(self, connection):
+    """Takes back a connection whose response was read completely."""
+    with self._lock:
+      if (not self._closed and connection.sock is not None and
+          len(self._idle) < self._max_size):
+        self._idle.append((connection, time.time()))
+        return
+    connection.close()
+
+  def close(self):
+    """Closes the idle connections, and the ones taken back from now on."""
+    with self._lock:
+      self._closed = True
+      idle, self._idle = self._idle, collections.deque()
+    for connection, _ in idle:
+      connection.close()
+
+
+class _UnixHTTPConnection(six.moves.http_client.HTTPConnection):
+  """An HTTP connection over a Unix domain socket."""
+
+  def __init__(self, path, blocksize=8192):
+    super(_UnixHTTPConnection, self).__init__('localhost',
+                                              blocksize=blocksize)
+    self._path = path
+
+  def connect(self):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+      if isinstance(self.timeout, (int, float)):
+        sock.settimeout(self.timeout)
+      sock.connect(self._path)
+    except socket.error:
+      sock.close()
+      raise
+    self.sock = sock
+
+
+class _ForwardingHttpProxy(http_proxy.HttpProxy):
+  """Forwards requests to a runtime process over a _ConnectionPool.
+
+  Requests are forwarded like http_proxy.HttpProxy does, except that the
+  connection is kept open for the next request when the runtime process
+  allows it, and can be a Unix domain socket. Bodies are forwarded in blocks
+  of _FORWARD_BLOCK_SIZE: a response block is passed on as soon as the
+  runtime process sent it, and a request body larger than request_spool_bytes
+  is read into a temporary file rather than into memory.
+
+  HttpProxy.handle creates its connection itself, there is no hook to hand it
+  one from the pool. _get_request_headers and handle are therefore a copy of
+  it as of Cloud SDK 470.0.0, reduced to building the request headers and
+  turning the response into a WSGI one; compare them with that method when
+  moving to a newer SDK. Everything else, prior errors and waiting for a TCP
+  port, is left to HttpProxy.
+  """
+
+  def __init__(self, connection_pool, host, port, instance_died_unexpectedly,
+               instance_logs_getter, error_handler_file, prior_error=None,
+               request_id_header_name=None, unix_socket=None,
+               request_spool_bytes=_DEFAULT_REQUEST_SPOOL_KB * 1024):
+    super(_ForwardingHttpProxy, self).__init__(
+        host=host,
+        port=port,
+        instance_died_unexpectedly=instance_died_unexpectedly,
+        instance_logs_getter=instance_logs_getter,
+        error_handler_file=error_handler_file,
+        prior_error=prior_error,
+        request_id_header_name=request_id_header_name,
+    )
+    self._connection_pool = connection_pool
+    self._instance_port = port
+    self._unix_socket = unix_socket
+    self._request_spool_bytes = request_spool_bytes
+    self._is_instance_dead = instance_died_unexpectedly
+    self._error_file = error_handler_file
+    self._request_id_header = (
+        request_id_header_name or http_runtime_constants.REQUEST_ID_HEADER)
+
+  def wait_for_connection(self, process=None):
+    """Waits until the runtime process accepts connections.
+
+    Args:
+      process: The runtime process; if it exits, waiting stops.
+    """
+    if self._unix_socket is None:
+      super(_ForwardingHttpProxy, self).wait_for_connection(process)
+      return
+    if self._prior_error:
+      return
+    while process is None or process.poll() is None:
+      connection = self._connection_pool.connect()
+      try:
+        connection.connect()
+      except socket.error:
+        time.sleep(.1)
+      else:
+        self._connection_pool.put(connection)
+        return
+    self._prior_error = 'the runtime process exited with code %r' % (
+        process.poll(),)
+
+  def _get_request_headers(self, environ, url_map, match, request_id,
+                           request_type):
+    """Returns the headers to send to the runtime process, as the SDK does."""
+    if match is not None and url_map is not None and url_map.script:
+      environ[http_runtime_constants.SCRIPT_HEADER] = match.expand(
+          url_map.script)
+    if request_type == instance.BACKGROUND_REQUEST:
+      environ[http_runtime_constants.REQUEST_TYPE_HEADER] = 'background'
+    elif request_type == instance.SHUTDOWN_REQUEST:
+      environ[http_runtime_constants.REQUEST_TYPE_HEADER] = 'shutdown'
+    elif request_type == instance.INTERACTIVE_REQUEST:
+      environ[http_runtime_constants.REQUEST_TYPE_HEADER] = 'interactive'
+    for name in http_runtime_constants.ENVIRONS_TO_PROPAGATE:
+      if http_runtime_constants.APPENGINE_ENVIRON_PREFIX + name not in environ:
+        value = environ.get(name, None)
+        if value is not None:
+          environ[http_runtime_constants.APPENGINE_ENVIRON_PREFIX + name] = (
+              value)
+    headers = util.get_headers_from_environ(environ)
+    for name in _HOP_BY_HOP_HEADERS:
+      del headers[name]
+
+    user_email, admin, user_id = login.get_user_info(
+        environ.get('HTTP_COOKIE'))
+    if user_email:
+      nickname, organization = user_email.split('@', 1)
+    else:
+      nickname = ''
+      organization = ''
+    prefix = http_runtime_constants.APPENGINE_HEADER_PREFIX
+    headers[self._request_id_header] = request_id
+    headers[prefix + 'User-Id'] = user_id
+    headers[prefix + 'User-Email'] = user_email
+    headers[prefix + 'User-Is-Admin'] = str(int(admin))
+    headers[prefix + 'User-Nickname'] = nickname
+    headers[prefix + 'User-Organization'] = organization
+    headers['X-AppEngine-Country'] = 'ZZ'
+    return headers
 
-  Args:
-    path: The filesystem path to remove.
-    max_attempts: The maximum number of attempts to try to remove the path
-      before giving up.
-    sleep_base: How long in seconds to sleep between the first and second
-      attempt (the time will be doubled between each successive attempt). The
-      value may be any numeric type that is convertible to float (complex won't
-      work but user types that are sufficiently numeric-like will).
+  def _read_request_body(self, wsgi_input, length):
+    """Reads a request body of length bytes.
 
-  Raises:
-    WindowsError: When an error other than a sharing violation occurs.
-  """
-  if sys.platform == 'win32':
-    for attempt in range(max_attempts):
+    Returns:
+      A (body, length) tuple of the body and the number of bytes read, which
+      is less than length if the client sent less than it announced. The body
+      is bytes, or a file positioned at its start if it is larger than the
+      spool size.
+    """
+    if length <= self._request_spool_bytes:
+      body = wsgi_input.read(length)
+      return body, len(body)
+    spool = tempfile.TemporaryFile(prefix='devappserver-request-')
+    try:
+      remaining = length
+      while remaining > 0:
+        block = wsgi_input.read(min(remaining, _FORWARD_BLOCK_SIZE))
+        if not block:
+          break
+        spool.write(block)
+        remaining -= len(block)
+      spool.seek(0)
+    except BaseException:
+      spool.close()
+      raise
+    return spool, length - remaining
+
+  def _send(self, method, url, body, headers):
+    """Sends a request, and returns the (connection, response) tuple.
+
+    A request that fails on a reused connection before it got a response is
+    sent once more on a new connection.
+    """
+    connection, reused = self._connection_pool.get()
+    while True:
+      if hasattr(body, 'seek'):
+        body.seek(0)
       try:
-        os.remove(path)
-        break
-      except WindowsError as e:
-        import winerror
-        # Sharing violations are expected to occasionally occur when the runtime
-        # instance is context swapped after writing the port but before closing
-        # the file. Ignore these and try again.
-        if e.winerror != winerror.ERROR_SHARING_VIOLATION:
+        connection.request(method, url, body, headers)
+        return connection, connection.getresponse()
+      except ConnectionError:
+        connection.close()
+        if not reused:
           raise
-      _sleep_between_retries(attempt, max_attempts, sleep_base)
+      except Exception:
+        connection.close()
+        raise
+      connection, reused = self._connection_pool.connect(), False
+
+  def handle(self, environ, start_response, url_map, match, request_id,
+             request_type):
+    """Serves a request by forwarding it to the runtime process.
+
+    Args:
+      environ: An environ dict for the request as defined in PEP-333.
+      start_response: A function with semantics defined in PEP-333.
+      url_map: An appinfo.URLMap instance containing the configuration for the
+        handler matching this request.
+      match: A re.MatchObject containing the result of the matched URL pattern.
+      request_id: A unique string id associated with the request.
+      request_type: The type of the request. See instance.*_REQUEST module
+        constants.
+
+    Yields:
+      A sequence of strings containing the body of the HTTP response.
+    """
+    if self._prior_error:
+      for block in super(_ForwardingHttpProxy, self).handle(
+          environ, start_response, url_map, match, request_id, request_type):
+        yield block
+      return
+
+    headers = self._get_request_headers(environ, url_map, match, request_id,
+                                        request_type)
+    if environ.get('QUERY_STRING'):
+      url = '%s?%s' % (six.moves.urllib.parse.quote(environ['PATH_INFO']),
+                       environ['QUERY_STRING'])
     else:
-      logging.warn('Unable to delete %s', path)
-  else:
-    os.remove(path)
+      url = six.moves.urllib.parse.quote(environ['PATH_INFO'])
 
+    data = None
+    connection = None
+    response_read = False
+    try:
+      if environ.get('CONTENT_LENGTH'):
+        data, length = self._read_request_body(environ['wsgi.input'],
+                                               int(environ['CONTENT_LENGTH']))
+        headers['CONTENT-LENGTH'] = str(length)
+      try:
+        connection, response = self._send(
+            environ.get('REQUEST_METHOD', 'GET'), url, data,
+            dict(headers.items()))
+      except six.moves.http_client.HTTPException as e:
+        # The runtime process has written a bad HTTP response.
+        yield self._respond_with_error(
+            'the runtime process gave a bad HTTP response: %s' % e,
+            start_response)
+        return
 
-def get_clone_environment_variables(module_configuration, runtime_config):
-  """Returns clone specific environment variables."""
-  keys_values = [
-      ('API_HOST', runtime_config.api_host),
-      ('API_PORT', runtime_config.api_port),
-      (
-          'GAE_LONG_APP_ID',
-          module_configuration.application_external_name
-          if module_configuration.application_external_name
-          else 'defaultappid"',
-      ),
-      ('GAE_PARTITION', module_configuration.partition),
-      ('GAE_MODULE_NAME', module_configuration.module_name),
-      (
-          'GAE_MODULE_VERSION',
-          module_configuration.major_version
-          if module_configuration.major_version
-          else '1',
-      ),
-      ('GAE_MINOR_VERSION', module_configuration.minor_version),
-      ('GAE_MODULE_INSTANCE', runtime_config.instance_id),
-      ('GAE_SERVER_PORT', runtime_config.server_port),
-      ('MODULE_YAML_PATH', os.path.basename(module_configuration.config_path)),
-      ('SERVER_SOFTWARE', http_runtime_constants.SERVER_SOFTWARE),
-  ]
-  for entry in runtime_config.environ:
-    keys_values.append((str(entry.key), str(entry.value)))
+      # Keeps repeated headers, e.g. several Set-Cookie headers, apart.
+      response_headers = wsgiref.headers.Headers(list(response.msg.items()))
+      if (self._error_file and
+          http_runtime_constants.ERROR_CODE_HEADER in response_headers):
+        try:
+          with open(self._error_file) as f:
+            content = f.read()
+        except IOError:
+          content = 'Failed to load error handler'
+          logging.exception('failed to load error file: %s', self._error_file)
+        start_response('500 Internal Server Error',
+                       [('Content-Type', 'text/html'),
+                        ('Content-Length', str(len(content)))])
+        yield content
+        return
+      del response_headers[http_runtime_constants.ERROR_CODE_HEADER]
+      start_response('%s %s' % (response.status, response.reason),
+                     list(response_headers.items()))
 
-  return {key: str(value) for key, value in keys_values}
+      # Yield the response body as the runtime process sends it, e.g. for
+      # server-sent events, without waiting for a full block.
+      while True:
+        try:
+          block = response.read1(_FORWARD_BLOCK_SIZE)
+        except six.moves.http_client.IncompleteRead:
+          break
+        if not block:
+          response.close()
+          response_read = True
+          break
+        yield block
+    except Exception:  # pylint: disable=broad-except
+      if self._is_instance_dead():
+        if self._unix_socket is not None:
+          where = 'on socket %s' % self._unix_socket
+        else:
+          where = 'on port %d' % self._instance_port
+        yield self._respond_with_error(
+            'the runtime process for the instance running %s has '
+            'unexpectedly quit' % where, start_response)
+      else:
+        raise
+    finally:
+      # The connection can take the next request once the whole response was
+      # read, unless the runtime process closes it.
+      if connection is not None:
+        if response_read:
+          self._connection_pool.put(connection)
+        else:
+          connection.close()
+      # Also a spooled body, whether the request failed or was retried.
+      if hasattr(data, 'close'):
+        data.close()
 
 
 class HttpRuntimeProxy(instance.RuntimeProxy):
@@ -190,6 +2111,217 @@ class HttpRuntimeProxy(instance.RuntimeProxy):
 
   _quit_with_sigterm = False
 
+  _port_mode = os.environ.get(_PORT_MODE_ENV) or PORT_MODE_PICK
+  _port_range = _parse_port_range(os.environ.get(_PORT_RANGE_ENV))
+  _reserved_ports = set()  # Ports of the port range in use.
+  _reserved_ports_lock = threading.Lock()  # Guards the two values below.
+  _next_port_in_range = None
+
+  _ready_notify = os.environ.get(_READY_NOTIFY_ENV, '').lower() in (
+      '1', 'true', 'yes', 'on')
+  _ready_path = os.environ.get(_READY_PATH_ENV) or None
+  # Commands that did not send READY=1 before; they are not waited for again.
+  _args_without_notify = set()
+
+  _log_buffer_bytes = 1024 * int(
+      os.environ.get(_LOG_BUFFER_KB_ENV) or _DEFAULT_LOG_BUFFER_KB)
+  _log_dir = os.environ.get(_LOG_DIR_ENV) or None
+  _log_records = int(os.environ.get(_LOG_RECORDS_ENV) or _DEFAULT_LOG_RECORDS)
+  _log_forward_policy = (
+      os.environ.get(_LOG_FORWARD_POLICY_ENV) or LOG_FORWARD_DROP_OLDEST)
+  _log_forward_buffer_bytes = 1024 * int(
+      os.environ.get(_LOG_FORWARD_BUFFER_KB_ENV) or
+      _DEFAULT_LOG_FORWARD_BUFFER_KB)
+
+  _keep_alive = os.environ.get(_KEEP_ALIVE_ENV, '').lower() not in (
+      '0', 'false', 'no', 'off')
+  _keep_alive_idle_seconds = float(
+      os.environ.get(_KEEP_ALIVE_IDLE_SECONDS_ENV) or
+      _DEFAULT_KEEP_ALIVE_IDLE_SECONDS)
+  _request_spool_bytes = 1024 * int(
+      os.environ.get(_REQUEST_SPOOL_KB_ENV) or _DEFAULT_REQUEST_SPOOL_KB)
+  _restart = os.environ.get(_RESTART_ENV, '').lower() not in (
+      '0', 'false', 'no', 'off')
+  _restart_max_backoff_seconds = float(
+      os.environ.get(_RESTART_MAX_BACKOFF_SECONDS_ENV) or
+      _DEFAULT_RESTART_MAX_BACKOFF_SECONDS)
+
+  @classmethod
+  def set_log_buffer(cls, buffer_kb, log_dir=None):
+    """Configures how much runtime output is kept.
+
+    Args:
+      buffer_kb: The size in KB of the stderr output of each runtime process
+        kept in memory.
+      log_dir: Optional directory older output is written to, in a file named
+        <module>-<instance>.log for each instance.
+    """
+    HttpRuntimeProxy._log_buffer_bytes = 1024 * buffer_kb
+    HttpRuntimeProxy._log_dir = log_dir
+    if log_dir and not os.path.exists(log_dir):
+      os.makedirs(log_dir)
+
+  @classmethod
+  def set_log_records(cls, max_records):
+    """Sets how many RuntimeLogRecords of all runtime processes are kept.
+
+    Must be called before the first runtime process is started.
+    """
+    HttpRuntimeProxy._log_records = max_records
+
+  @classmethod
+  def get_request_log_records(cls, request_id):
+    """Returns the RuntimeLogRecords known to be written for a request.
+
+    Output is only attributed to a request while it is the only one handled
+    by its runtime process.
+
+    Args:
+      request_id: The id the request was handled with.
+
+    Returns:
+      A list of RuntimeLogRecords, oldest first.
+    """
+    return _get_runtime_log_store().get_request_records(request_id)
+
+  @classmethod
+  def get_error_log_records(cls, seconds):
+    """Returns the RuntimeLogRecords of errors of the last seconds.
+
+    Args:
+      seconds: How far back to look.
+
+    Returns:
+      A list of RuntimeLogRecords with a severity of ERROR or above, of all
+      runtime processes, oldest first.
+    """
+    return _get_runtime_log_store().get_errors(seconds)
+
+  @classmethod
+  def set_log_forwarding(cls, policy, buffer_kb=None):
+    """Configures what happens when the console can't keep up with output.
+
+    Runtime output is queued and written to the console by a thread of its
+    own, the policy applies once the queue is full.
+
+    Args:
+      policy: One of LOG_FORWARD_BLOCK, LOG_FORWARD_DROP_OLDEST or
+        LOG_FORWARD_SAMPLE.
+      buffer_kb: Optional size in KB of the queue.
+
+    Raises:
+      ValueError: An unknown policy was used.
+    """
+    if policy not in (LOG_FORWARD_BLOCK, LOG_FORWARD_DROP_OLDEST,
+                      LOG_FORWARD_SAMPLE):
+      raise ValueError('Invalid log forwarding policy.')
+    HttpRuntimeProxy._log_forward_policy = policy
+    if buffer_kb is not None:
+      HttpRuntimeProxy._log_forward_buffer_bytes = 1024 * buffer_kb
+    with _console_forwarder_lock:
+      if _console_forwarder is not None:
+        _console_forwarder.configure(
+            policy, HttpRuntimeProxy._log_forward_buffer_bytes)
+
+  @classmethod
+  def get_log_forwarding_stats(cls):
+    """Returns counters of the runtime output written to the console.
+
+    Returns:
+      A dict with forwarded_bytes, dropped_bytes (not shown because of the
+      policy), delayed_bytes (that had to wait for the console with
+      LOG_FORWARD_BLOCK), blocked_seconds (time spent waiting) and
+      queued_bytes, or None if no runtime process was started.
+    """
+    with _console_forwarder_lock:
+      if _console_forwarder is None:
+        return None
+      return _console_forwarder.get_stats()
+
+  @classmethod
+  def set_keep_alive(cls, keep_alive, idle_seconds=None):
+    """Configures the connections requests are forwarded over.
+
+    Args:
+      keep_alive: True to keep connections to the runtime processes open
+        between requests, up to the number of requests an instance handles
+        at once; False to open one per request.
+      idle_seconds: Optional number of seconds after which an idle connection
+        is closed.
+    """
+    HttpRuntimeProxy._keep_alive = keep_alive
+    if idle_seconds is not None:
+      HttpRuntimeProxy._keep_alive_idle_seconds = idle_seconds
+
+  @classmethod
+  def set_request_spool(cls, spool_kb):
+    """Configures when request bodies are copied to a temporary file.
+
+    Args:
+      spool_kb: Request bodies larger than this many KB are copied to a
+        temporary file before they are forwarded, instead of being read into
+        memory.
+    """
+    HttpRuntimeProxy._request_spool_bytes = 1024 * spool_kb
+
+  @classmethod
+  def set_restart(cls, restart, max_backoff_seconds=None):
+    """Configures what happens when a runtime process exits by itself.
+
+    Args:
+      restart: True to start a new runtime process in the background when one
+        started with an entrypoint exits without being quit; False to let
+        requests to the instance fail.
+      max_backoff_seconds: Optional longest delay before a new runtime
+        process is started, after processes that kept exiting right away.
+    """
+    HttpRuntimeProxy._restart = restart
+    if max_backoff_seconds is not None:
+      HttpRuntimeProxy._restart_max_backoff_seconds = max_backoff_seconds
+
+  @classmethod
+  def set_readiness(cls, notify, path=None):
+    """Configures how runtime processes tell that they are ready.
+
+    Without either, a runtime is ready once its port accepts connections,
+    which is polled.
+
+    Args:
+      notify: True to pass runtime processes a NOTIFY_SOCKET, the datagram
+        socket of the sd_notify protocol (supported by e.g. gunicorn), and to
+        consider them ready when they send READY=1. Not supported on Windows.
+      path: Optional URL path that is requested once the runtime accepts
+        connections; the runtime is ready when it answers with a 2xx status.
+    """
+    HttpRuntimeProxy._ready_notify = notify
+    HttpRuntimeProxy._ready_path = path
+
+  @classmethod
+  def set_port_mode(cls, port_mode, port_range=None):
+    """Configures how the port of the runtime processes is chosen.
+
+    Args:
+      port_mode: One of PORT_MODE_PICK, PORT_MODE_FD, PORT_MODE_RANGE or
+        PORT_MODE_UNIX.
+      port_range: Optional (first, last) tuple of the ports reserved for
+        runtime processes, used by PORT_MODE_RANGE, and by PORT_MODE_FD and
+        PORT_MODE_UNIX for the runtimes that get a port. With PORT_MODE_FD and
+        no range, the operating system picks the port of the passed socket.
+
+    Raises:
+      ValueError: An unknown port_mode was used, or PORT_MODE_RANGE without a
+        port_range.
+    """
+    if port_mode not in (PORT_MODE_PICK, PORT_MODE_FD, PORT_MODE_RANGE,
+                         PORT_MODE_UNIX):
+      raise ValueError('Invalid port_mode.')
+    if port_mode == PORT_MODE_RANGE and not port_range:
+      raise ValueError('PORT_MODE_RANGE needs a port_range.')
+    with cls._reserved_ports_lock:
+      HttpRuntimeProxy._port_mode = port_mode
+      HttpRuntimeProxy._port_range = port_range
+      HttpRuntimeProxy._next_port_in_range = None
+
   @classmethod
   def stop_runtimes_with_sigterm(cls, quit_with_sigterm):
     """Configures the http_runtime module to kill the runtimes with SIGTERM.
@@ -213,6 +2345,8 @@ class HttpRuntimeProxy(instance.RuntimeProxy):
       start_process_flavor=START_PROCESS,
       extra_args_getter=None,
       request_id_header_name=None,
+      zygote=None,
+      max_connections=None,
   ):
     """Initializer for HttpRuntimeProxy.
 
@@ -233,6 +2367,11 @@ class HttpRuntimeProxy(instance.RuntimeProxy):
         refers to the port number.
       request_id_header_name: Optional string name used to pass request ID to
         API server.  Defaults to http_runtime_constants.REQUEST_ID_HEADER.
+      zygote: Optional Zygote to fork the runtime process from, with
+        START_PROCESS_WITH_ENTRYPOINT.
+      max_connections: Optional number of connections to the runtime process
+        kept open between requests, usually the number of requests the
+        instance handles at once; at most _MAX_KEEP_ALIVE_CONNECTIONS.
 
     Raises:
       ValueError: An unknown value for start_process_flavor was used.
@@ -240,7 +2379,12 @@ class HttpRuntimeProxy(instance.RuntimeProxy):
     super(HttpRuntimeProxy, self).__init__()
     self._process = None
     self._process_lock = threading.Lock()  # Lock to guard self._process.
+    # Whether self._process leads a process group, see _stop_process_group.
+    self._process_group = False
+    self._zygote = zygote
     self._stderr_tee = None
+    self._stderr_log = None
+    self._log_parser = None
     self._runtime_config_getter = runtime_config_getter
     self._extra_args_getter = extra_args_getter
     self._args = args
@@ -254,18 +2398,326 @@ class HttpRuntimeProxy(instance.RuntimeProxy):
             self._module_configuration, runtime_config
         )
     )
+    self._trace_args = {
+        'module': self._module_configuration.module_name,
+        'instance': str(runtime_config.instance_id),
+    }
+    self._first_request_pending = True
 
     if start_process_flavor not in self._VALID_START_PROCESS_FLAVORS:
       raise ValueError('Invalid start_process_flavor.')
     self._start_process_flavor = start_process_flavor
     self._request_id_header_name = request_id_header_name
     self._proxy = None
+    self._max_connections = min(max_connections or _DEFAULT_MAX_CONNECTIONS,
+                                _MAX_KEEP_ALIVE_CONNECTIONS)
+    self._connection_pool = None
+    self._reserved_port = None
+    self._unix_socket = None
+    self._unix_socket_dir = None
+    self._notify_socket = None
+    self._notify_dir = None
+    self._notified_ready = False
+    # Changes by NoCommandLine - replacing a runtime process that exited, see
+    # _process_exited. _start_lock keeps a replacement from starting while
+    # the process is still being started.
+    self._start_lock = threading.Lock()
+    self._quit_requested = threading.Event()
+    # Cleared from the exit of the runtime process until a new one is ready.
+    self._available = threading.Event()
+    self._available.set()
+    self._restart_time = 0
+    self._process_start_time = None
+    self._restarts = 0
+    self._crashes = 0  # Processes in a row that exited soon after starting.
+
+  def _pick_port(self):
+    """Returns the port the runtime process should listen on."""
+    if (HttpRuntimeProxy._port_mode == PORT_MODE_PICK or
+        not HttpRuntimeProxy._port_range):
+      if HttpRuntimeProxy._port_mode == PORT_MODE_RANGE:
+        logging.warning('No port range configured, picking an unused port.')
+      return portpicker.pick_unused_port()
+    port = self._reserve_port_in_range()
+    if port is None:
+      logging.warning('All ports of the range %d-%d are in use, picking an '
+                      'unused port.', *HttpRuntimeProxy._port_range)
+      return portpicker.pick_unused_port()
+    return port
+
+  def _reserve_port_in_range(self, listen_socket=None):
+    """Reserves the next free port of the port range.
+
+    Ports are handed out round robin so a port that was just released isn't
+    reused right away while the old runtime may still hold it.
+
+    Args:
+      listen_socket: Optional socket to bind to the port; without it, the port
+        is only checked to be free.
+
+    Returns:
+      The port, or None if every port of the range is in use.
+    """
+    with HttpRuntimeProxy._reserved_ports_lock:
+      first, last = HttpRuntimeProxy._port_range
+      start = HttpRuntimeProxy._next_port_in_range or first
+      if not first <= start <= last:
+        start = first
+      for offset in range(last - first + 1):
+        port = first + (start - first + offset) % (last - first + 1)
+        if port in HttpRuntimeProxy._reserved_ports:
+          continue
+        probe = listen_socket or socket.socket(socket.AF_INET,
+                                               socket.SOCK_STREAM)
+        try:
+          probe.bind(('', port))
+        except socket.error:
+          continue
+        finally:
+          if probe is not listen_socket:
+            probe.close()
+        HttpRuntimeProxy._reserved_ports.add(port)
+        HttpRuntimeProxy._next_port_in_range = port + 1
+        self._reserved_port = port
+        return port
+    return None
+
+  def _release_port(self):
+    if self._reserved_port is not None:
+      with HttpRuntimeProxy._reserved_ports_lock:
+        HttpRuntimeProxy._reserved_ports.discard(self._reserved_port)
+      self._reserved_port = None
+
+  def _bind_listening_socket(self):
+    """Returns a listening socket for the runtime process, or None."""
+    listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+      listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+      if HttpRuntimeProxy._port_range:
+        if self._reserve_port_in_range(listen_socket) is None:
+          listen_socket.close()
+          return None
+      else:
+        listen_socket.bind(('', 0))
+      listen_socket.listen(socket.SOMAXCONN)
+    except socket.error:
+      logging.exception('Failed creating a listening socket.')
+      listen_socket.close()
+      self._release_port()
+      return None
+    return listen_socket
+
+  def _get_args_with_fd(self, fd):
+    """Returns the entrypoint arguments using the listening socket fd.
+
+    ${FD} is replaced with the file descriptor, and a gunicorn bind of $PORT
+    becomes fd://<fd>.
+
+    Args:
+      fd: The file descriptor of the listening socket.
+
+    Returns:
+      The arguments, or None if the entrypoint can't take a file descriptor.
+    """
+    uses_fd = False
+    is_gunicorn = False
+    args = []
+    for arg in self._args:
+      if os.path.basename(arg) == 'gunicorn':
+        is_gunicorn = True
+      if '${FD}' in arg:
+        uses_fd = True
+        arg = arg.replace('${FD}', str(fd))
+      args.append(arg)
+    for i, arg in enumerate(args if is_gunicorn else []):
+      match = _GUNICORN_BIND_WITH_ADDRESS_RE.match(arg)
+      if match and _PORT_PLACEHOLDER_RE.search(match.group(2)):
+        args[i] = '%sfd://%d' % (match.group(1), fd)
+        uses_fd = True
+      elif (arg in ('-b', '--bind') and i + 1 < len(args) and
+            _PORT_PLACEHOLDER_RE.search(args[i + 1])):
+        args[i + 1] = 'fd://%d' % fd
+        uses_fd = True
+    return args if uses_fd else None
+
+  def _get_args_with_unix_socket(self, path):
+    """Returns the entrypoint arguments using a Unix domain socket.
+
+    ${SOCKET} is replaced with the path of the socket, and the address bound
+    to $PORT is replaced with the socket, see _UNIX_SOCKET_OPTIONS.
+
+    Args:
+      path: The path of the socket the runtime process should listen on.
+
+    Returns:
+      The arguments, or None if the entrypoint can't take a socket path, or
+      uses $PORT in another way.
+    """
+    uses_socket = False
+    server = None
+    args = []
+    for arg in self._args:
+      if server is None and os.path.basename(arg) in _UNIX_SOCKET_OPTIONS:
+        server = os.path.basename(arg)
+      if '${SOCKET}' in arg:
+        uses_socket = True
+        arg = arg.replace('${SOCKET}', path)
+      args.append(arg)
+    address_options, socket_option, dropped_options = _UNIX_SOCKET_OPTIONS.get(
+        server, ((), None, ()))
+    socket_args = []
+    i = 0
+    while i < len(args):
+      option, equals, value = args[i].partition('=')
+      width = 1
+      if (not equals and option in address_options + dropped_options and
+          i + 1 < len(args)):
+        value = args[i + 1]
+        width = 2
+      elif not equals and option.startswith('-b') and '-b' in address_options:
+        option, value = '-b', option[2:]  # e.g. '-b:$PORT'.
+      if option in dropped_options:
+        pass
+      elif option in address_options and _PORT_PLACEHOLDER_RE.search(value):
+        socket_args.append(socket_option % path)
+        uses_socket = True
+      else:
+        socket_args.extend(args[i:i + width])
+      i += width
+    if not uses_socket or any(
+        _PORT_PLACEHOLDER_RE.search(arg) for arg in socket_args):
+      return None
+    return socket_args
+
+  def _remove_unix_socket(self):
+    if self._unix_socket_dir is not None:
+      shutil.rmtree(self._unix_socket_dir, ignore_errors=True)
+      self._unix_socket_dir = None
+      self._unix_socket = None
+
+  def _create_notify_socket(self):
+    """Creates the socket the runtime process sends READY=1 to."""
+    if (not HttpRuntimeProxy._ready_notify or
+        not hasattr(socket, 'AF_UNIX') or
+        tuple(self._args) in HttpRuntimeProxy._args_without_notify):
+      return
+    self._notify_dir = tempfile.mkdtemp(prefix='devappserver-')
+    path = os.path.join(self._notify_dir, 'notify')
+    self._notify_socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    self._notify_socket.bind(path)
+    self._env['NOTIFY_SOCKET'] = path
+
+  def _close_notify_socket(self):
+    if self._notify_socket is not None:
+      self._notify_socket.close()
+      self._notify_socket = None
+      shutil.rmtree(self._notify_dir, ignore_errors=True)
+      self._env.pop('NOTIFY_SOCKET', None)
+
+  def _wait_for_notification(self, timeout):
+    """Waits up to timeout seconds for the runtime process to send READY=1.
+
+    Returns:
+      True if READY=1 was received.
+    """
+    deadline = time.time() + timeout
+    while True:
+      remaining = deadline - time.time()
+      if remaining <= 0:
+        return False
+      readable, _, _ = select.select([self._notify_socket], [], [], remaining)
+      if not readable:
+        return False
+      message = self._notify_socket.recv(4096)
+      if b'READY=1' in message.split(b'\n'):
+        self._notified_ready = True
+        return True
+
+  def _wait_for_ready_notification(self):
+    """Blocks until the runtime process sends READY=1, exits or times out."""
+    if self._notify_socket is None:
+      return
+    start_time = time.time()
+    try:
+      # START_PROCESS_FILE may have received it already.
+      if self._notified_ready:
+        return
+      while time.time() - start_time < _READY_NOTIFY_TIMEOUT_SECONDS:
+        if self._wait_for_notification(0.1):
+          logging.debug('Runtime process reported ready after %.3fs.',
+                        time.time() - start_time)
+          return
+        if self._process.poll() is not None:
+          return
+      logging.warning(
+          'Runtime process "%s" did not send READY=1 within %ds, checking '
+          'its port instead.', ' '.join(self._args),
+          _READY_NOTIFY_TIMEOUT_SECONDS)
+      HttpRuntimeProxy._args_without_notify.add(tuple(self._args))
+    finally:
+      self._close_notify_socket()
+
+  def _wait_for_ready_path(self):
+    """Blocks until the ready path answers with a 2xx status."""
+    path = HttpRuntimeProxy._ready_path
+    if not path or self._instance_died_unexpectedly():
+      return
+    start_time = time.time()
+    while time.time() - start_time < _READY_PATH_TIMEOUT_SECONDS:
+      connection = self._connection_pool.connect()
+      connection.timeout = _READY_PATH_TIMEOUT_SECONDS
+      try:
+        connection.request('GET', path)
+        status = connection.getresponse().status
+        if 200 <= status < 300:
+          logging.debug('Runtime process answered %s after %.3fs.', path,
+                        time.time() - start_time)
+          return
+      except (socket.error, six.moves.http_client.HTTPException):
+        pass
+      finally:
+        connection.close()
+      if self._instance_died_unexpectedly():
+        return
+      time.sleep(_READY_PATH_INTERVAL_SECONDS)
+    logging.warning('Runtime process did not answer %s with a 2xx status '
+                    'within %ds.', path, _READY_PATH_TIMEOUT_SECONDS)
 
   def _get_instance_logs(self):
-    # Give the runtime process a bit of time to write to stderr.
-    time.sleep(0.1)
-    assert self._stderr_tee is not None
-    return self._stderr_tee.get_buf()
+    # Changes by NoCommandLine - instead of sleeping in the hope the runtime
+    # process wrote everything, wait until a process that died closed its
+    # stderr. A process that is still running keeps writing anyway.
+    assert self._stderr_log is not None
+    if self._instance_died_unexpectedly():
+      self._stderr_log.wait_for_eof(_LOG_EOF_TIMEOUT_SECONDS)
+    return self._stderr_log.tail(_ERROR_PAGE_LOG_LINES)
+
+  def get_logs(self, since=0):
+    """Returns the stderr output of the runtime process after an offset.
+
+    Args:
+      since: The offset to read from, e.g. the one returned by the last call.
+
+    Returns:
+      A (data, offset) tuple of the output and the offset to read from next.
+    """
+    if self._stderr_log is None:
+      return b'', 0
+    return self._stderr_log.read(since)
+
+  def get_request_logs(self, request_id):
+    """Returns the stderr output written while a request was handled.
+
+    Args:
+      request_id: The id the request was handled with.
+
+    Returns:
+      The output (including that of concurrent requests), or None if the
+      request is not known (any more).
+    """
+    if self._stderr_log is None:
+      return None
+    return self._stderr_log.read_request(request_id)
 
   def _instance_died_unexpectedly(self):
     with self._process_lock:
@@ -293,11 +2745,61 @@ class HttpRuntimeProxy(instance.RuntimeProxy):
     Yields:
       A sequence of strings containing the body of the HTTP response.
     """
+    # Changes by NoCommandLine - wait for the replacement of a runtime process
+    # that exited, unless it is held back after repeated crashes; the dead
+    # process then fails the request with its logs.
+    if (not self._available.is_set() and
+        self._restart_time - time.time() < _RESTART_WAIT_SECONDS):
+      self._available.wait(_RESTART_WAIT_SECONDS)
 
     assert self._proxy is not None
-    return self._proxy.handle(
+    response = self._proxy.handle(
         environ, start_response, url_map, match, request_id, request_type
     )
+    # Changes by NoCommandLine - time the first request for the startup
+    # timeline.
+    if self._first_request_pending and startup_timeline.enabled:
+      self._first_request_pending = False
+      response = self._trace_first_request(response, environ.get('PATH_INFO'))
+    return self._track_request_logs(response, request_id)
+
+  def _trace_first_request(self, response, path):
+    with startup_timeline.phase('first_request', 'instance', path=path,
+                                **self._trace_args):
+      for chunk in response:
+        yield chunk
+
+  def _track_request_logs(self, response, request_id):
+    # Changes by NoCommandLine - remember which output was written while the
+    # request was handled, see get_request_logs.
+    self._stderr_log.begin_request(request_id)
+    try:
+      for chunk in response:
+        yield chunk
+    finally:
+      self._stderr_log.end_request(request_id)
+
+  def _spawn_from_zygote(self, args, listen_socket):
+    """Forks the runtime process from the zygote of the module.
+
+    Returns:
+      The _ZygoteProcess, or None if the runtime process has to be started
+      as usual.
+    """
+    if _args_need_shell(args):
+      logging.debug('Entrypoint "%s" needs a shell, not using the zygote.',
+                    ' '.join(args))
+      return None
+    try:
+      with startup_timeline.phase('zygote_fork', 'instance',
+                                  **self._trace_args):
+        return self._zygote.spawn(
+            args, self._env, self._module_configuration.application_root,
+            listen_socket.fileno() if listen_socket is not None else None)
+    except (IOError, OSError) as e:
+      logging.warning('Cannot fork the runtime process from the zygote, '
+                      'starting it as usual: %s', e)
+      return None
 
   def _read_start_process_file(self, max_attempts=10, sleep_base=0.125):
     """Read the single line response expected in the start process file.
@@ -335,19 +2837,142 @@ class HttpRuntimeProxy(instance.RuntimeProxy):
         line = self._process.child_out.read()  # pytype: disable=attribute-error  # dynamic-method-lookup
         if '\n' in line:
           return line
-        _sleep_between_retries(attempt, max_attempts, sleep_base)
+        # Changes by NoCommandLine - stop sleeping once the runtime reports
+        # ready, it has written the file by then.
+        if self._notify_socket is not None:
+          if attempt < max_attempts - 1:
+            self._wait_for_notification((2**attempt) * sleep_base)
+        else:
+          _sleep_between_retries(attempt, max_attempts, sleep_base)
     finally:
       self._process.child_out.close()  # pytype: disable=attribute-error  # dynamic-method-lookup
     return ''
 
   def start(self):
     """Starts the runtime process and waits until it is ready to serve."""
+    # Changes by NoCommandLine - time the start for the startup timeline.
+    with self._start_lock, startup_timeline.phase('start', 'instance',
+                                                  **self._trace_args):
+      self._start()
+
+  def set_instance_id(self, instance_id):
+    """Changes the id of the instance the runtime process belongs to.
+
+    For a runtime process started before the id of its instance was known.
+    The environment of the running process keeps the id it started with,
+    processes started after it exited get the new one.
+
+    Args:
+      instance_id: The id of the instance.
+    """
+    runtime_config_getter = self._runtime_config_getter
+
+    def instance_config_getter():
+      runtime_config = runtime_config_getter()
+      runtime_config.instance_id = str(instance_id)
+      return runtime_config
+
+    self._runtime_config_getter = instance_config_getter
+    for name in ('GAE_INSTANCE', 'GAE_MODULE_INSTANCE'):
+      if name in self._env:
+        self._env[name] = str(instance_id)
+    self._trace_args['instance'] = str(instance_id)
+    if self._log_parser is not None:
+      self._log_parser.instance_id = str(instance_id)
+
+  def _get_restart_delay(self):
+    """Returns the crash loop backoff before the next runtime process starts.
+
+    Must be called with _process_lock held, once a runtime process exited or
+    couldn't be started.
+    """
+    if time.time() - self._process_start_time >= _RESTART_STABLE_SECONDS:
+      self._crashes = 0
+    self._crashes += 1
+    delay = 0
+    if self._crashes > 1:
+      delay = min(_RESTART_BACKOFF_BASE_SECONDS * 2 ** (self._crashes - 2),
+                  HttpRuntimeProxy._restart_max_backoff_seconds)
+    self._restart_time = time.time() + delay
+    return delay
+
+  def _process_exited(self, process):
+    """Called by the _ProcessReaper once a runtime process exited."""
+    with self._process_lock:
+      if process is not self._process or self._quit_requested.is_set():
+        return  # quit() stopped it.
+      self._available.clear()
+      uptime = time.time() - self._process_start_time
+      restart = (HttpRuntimeProxy._restart and self._start_process_flavor ==
+                 START_PROCESS_WITH_ENTRYPOINT)
+      if restart:
+        delay = self._get_restart_delay()
+        threading.Thread(
+            target=self._restart_process, args=(delay,),
+            name='RuntimeRestart-%s-%s' % (self._trace_args['module'],
+                                           self._trace_args['instance']),
+            daemon=True).start()
+    if restart:
+      logging.warning(
+          'The runtime process of instance %s of module "%s" exited with code '
+          '%s after %.1fs, starting a new one in %ds.',
+          self._trace_args['instance'], self._trace_args['module'],
+          process.returncode, uptime, delay)
+    else:
+      logging.warning(
+          'The runtime process of instance %s of module "%s" exited with code '
+          '%s after %.1fs.', self._trace_args['instance'],
+          self._trace_args['module'], process.returncode, uptime)
+
+  def _restart_process(self, delay):
+    """Starts a runtime process in place of the one that exited.
+
+    Args:
+      delay: The number of seconds to wait first. Attempts that fail to start
+        a process are repeated with the crash loop backoff; the exit of a
+        process that started is handled by _process_exited again.
+    """
+    while not self._quit_requested.wait(delay):
+      with self._start_lock:
+        with self._process_lock:
+          if self._quit_requested.is_set():
+            return
+          self._stop_process(False)
+          self._notified_ready = False
+          if isinstance(self._stderr_tee, _LogTee):
+            self._stderr_tee = None
+          self._process_start_time = time.time()
+          self._restarts += 1
+        try:
+          with startup_timeline.phase('restart', 'instance',
+                                      **self._trace_args):
+            self._start()
+        except Exception:  # pylint: disable=broad-except
+          logging.exception(
+              'Failed restarting the runtime process of instance %s of module '
+              '"%s".', self._trace_args['instance'],
+              self._trace_args['module'])
+        with self._process_lock:
+          if self._quit_requested.is_set():
+            # quit() was called while the process was starting.
+            if self._process is not None:
+              self._stop_process(HttpRuntimeProxy._quit_with_sigterm)
+            return
+          if self._process is not None:
+            if self._process.poll() is None:
+              self._available.set()
+            return
+          delay = self._get_restart_delay()
+
+  def _start(self):
     runtime_config = self._runtime_config_getter()
     # TODO: Use a different process group to isolate the child process
     # from signals sent to the parent. Only available in subprocess in
     # Python 2.7.
     assert self._start_process_flavor in self._VALID_START_PROCESS_FLAVORS
     host = 'localhost'
+    self._create_notify_socket()
+    spawn_start = time.time()
     if self._start_process_flavor == START_PROCESS:
       serialized_config = base64.b64encode(runtime_config.SerializeToString())
       with self._process_lock:
@@ -379,9 +3004,10 @@ class HttpRuntimeProxy(instance.RuntimeProxy):
       _remove_retry_sharing_violation(self._process.child_out.name)  # pytype: disable=attribute-error
     elif self._start_process_flavor == START_PROCESS_REVERSE:
       serialized_config = runtime_config.SerializeToString()
+      # Changes by NoCommandLine - choose the port before taking the lock.
+      port = self._pick_port()
       with self._process_lock:
         assert not self._process, 'start() can only be called once'
-        port = portpicker.pick_unused_port()
         self._env['PORT'] = str(port)
 
         # If any of the strings in args contain {port}, replace that substring
@@ -398,27 +3024,88 @@ class HttpRuntimeProxy(instance.RuntimeProxy):
         )
     elif self._start_process_flavor == START_PROCESS_WITH_ENTRYPOINT:
       serialized_config = runtime_config.SerializeToString()
-      with self._process_lock:
-        assert not self._process, 'start() can only be called once'
-        port = portpicker.pick_unused_port()
-        self._env['PORT'] = str(port)
+      # Changes by NoCommandLine - pass a listening socket where possible, and
+      # choose the port before taking the lock.
+      listen_socket = None
+      args = None
+      if (HttpRuntimeProxy._port_mode == PORT_MODE_UNIX and
+          sys.platform != 'win32'):
+        self._unix_socket_dir = tempfile.mkdtemp(prefix='devappserver-')
+        self._unix_socket = os.path.join(self._unix_socket_dir, 'runtime.sock')
+        args = self._get_args_with_unix_socket(self._unix_socket)
+        if args is None:
+          logging.debug('Entrypoint "%s" cannot take a Unix domain socket.',
+                        ' '.join(self._args))
+          self._remove_unix_socket()
+      if (HttpRuntimeProxy._port_mode == PORT_MODE_FD and
+          sys.platform != 'win32'):
+        listen_socket = self._bind_listening_socket()
+      if listen_socket is not None:
+        args = self._get_args_with_fd(listen_socket.fileno())
+        if args is None:
+          logging.debug('Entrypoint "%s" cannot take a listening socket.',
+                        ' '.join(self._args))
+          listen_socket.close()
+          self._release_port()
+          listen_socket = None
+      if self._unix_socket is not None:
+        port = None
+      elif listen_socket is not None:
+        port = listen_socket.getsockname()[1]
+      else:
+        port = self._pick_port()
         # For windows, replace ${PORT} used in PHP and not escaped.
         args = []
         for arg in self._args:
           args.append(arg.replace('${PORT}', str(port)).replace('$PORT', str(port))) # Changes by NoCommandLine
-        self._process = safe_subprocess.start_process(
-            args=args,
-            input_string=serialized_config,
-            env=self._env,
-            cwd=self._module_configuration.application_root,
-            stderr=subprocess.PIPE,
-            shell=True,
-        )
+      with self._process_lock:
+        assert not self._process, 'start() can only be called once'
+        if port is not None:
+          self._env['PORT'] = str(port)
+        if listen_socket is not None:
+          self._env['LISTEN_FD'] = str(listen_socket.fileno())
+        try:
+          # Changes by NoCommandLine - fork the runtime process from the
+          # zygote of the module if there is one.
+          if self._zygote is not None:
+            self._process = self._spawn_from_zygote(args, listen_socket)
+          # Changes by NoCommandLine - start the server itself rather than a
+          # shell running it, unless the entrypoint needs one, in a process
+          # group of its own that quit() stops as a whole.
+          if self._process is None:
+            shell = _args_need_shell(args)
+            if shell:
+              logging.debug('Entrypoint "%s" needs a shell.', ' '.join(args))
+            start_args = dict(
+                args=args,
+                input_string=serialized_config,
+                env=self._env,
+                cwd=self._module_configuration.application_root,
+                stderr=subprocess.PIPE,
+                pass_fds=((listen_socket.fileno(),)
+                          if listen_socket is not None else ()),
+            )
+            try:
+              self._process = _start_process_group(shell=shell, **start_args)
+            except OSError as e:
+              if shell or e.errno not in (errno.ENOENT, errno.ENOEXEC):
+                raise
+              # Let the shell report it, e.g. a command that isn't installed,
+              # or run it, e.g. a script without a #! line.
+              logging.warning('Cannot start "%s", using a shell: %s',
+                              ' '.join(args), e)
+              self._process = _start_process_group(shell=True, **start_args)
+          self._process_group = True
+        finally:
+          # The runtime process has its own copy now.
+          if listen_socket is not None:
+            listen_socket.close()
     elif self._start_process_flavor == START_PROCESS_REVERSE_NO_FILE:
       serialized_config = runtime_config.SerializeToString()
+      # Changes by NoCommandLine - choose the port before taking the lock.
+      port = self._pick_port()
       with self._process_lock:
         assert not self._process, 'start() can only be called once'
-        port = portpicker.pick_unused_port()
         if self._extra_args_getter:
           self._args.append(self._extra_args_getter(port))
 
@@ -443,22 +3130,58 @@ class HttpRuntimeProxy(instance.RuntimeProxy):
             cwd=self._module_configuration.application_root,
         )
 
+    # Changes by NoCommandLine - notice the moment the runtime process exits.
+    self._process_start_time = time.time()
+    _get_process_reaper().watch(self._process, self._process_exited)
+
+    # Changes by NoCommandLine - keep the output in a _RuntimeLogBuffer.
+    log_path = None
+    if HttpRuntimeProxy._log_dir:
+      log_path = os.path.join(HttpRuntimeProxy._log_dir, '%s-%s.log' % (
+          self._trace_args['module'], self._trace_args['instance']))
+    self._log_parser = _RuntimeLogParser(self._trace_args['instance'],
+                                         _get_runtime_log_store())
+    self._stderr_log = _RuntimeLogBuffer(
+        HttpRuntimeProxy._log_buffer_bytes, log_path, self._log_parser)
     # _stderr_tee may be pre-set by unit tests.
     if self._stderr_tee is None:
       assert self._process is not None
-      self._stderr_tee = tee.Tee(
-          self._process.stderr, sys.stderr if six.PY2 else sys.stderr.buffer
-      )
-      self._stderr_tee.start()
+      console = _get_console_forwarder()
+      # Changes by NoCommandLine - one thread copies the output of all
+      # instances, except on Windows.
+      if sys.platform == 'win32':
+        self._stderr_tee = _LogTee(self._process.stderr, console,
+                                   self._stderr_log)
+        self._stderr_tee.start()
+      else:
+        _get_log_pump().add(self._process.stderr, console, self._stderr_log)
+    startup_timeline.record('spawn', 'instance', spawn_start,
+                            time.time() - spawn_start, **self._trace_args)
 
     error = None
     try:
-      port = int(port)
+      if self._unix_socket is None:
+        port = int(port)
     except ValueError:
       error = 'bad runtime process port [%r]' % six.ensure_str(port)
       logging.error(error)
     finally:
-      self._proxy = http_proxy.HttpProxy(
+      # Changes by NoCommandLine - forward requests over persistent
+      # connections.
+      # Changes by NoCommandLine - or over a Unix domain socket.
+      unix_socket = self._unix_socket
+      if unix_socket is not None:
+        connection_factory = lambda: _UnixHTTPConnection(
+            unix_socket, blocksize=_FORWARD_BLOCK_SIZE)
+      else:
+        connection_factory = lambda: six.moves.http_client.HTTPConnection(
+            host, port, blocksize=_FORWARD_BLOCK_SIZE)
+      self._connection_pool = _ConnectionPool(
+          connection_factory,
+          self._max_connections if HttpRuntimeProxy._keep_alive else 0,
+          HttpRuntimeProxy._keep_alive_idle_seconds)
+      self._proxy = _ForwardingHttpProxy(
+          self._connection_pool,
           host=host,
           port=port,
           instance_died_unexpectedly=self._instance_died_unexpectedly,
@@ -468,23 +3191,52 @@ class HttpRuntimeProxy(instance.RuntimeProxy):
           ),
           prior_error=error,
           request_id_header_name=self._request_id_header_name,
+          unix_socket=unix_socket,
+          request_spool_bytes=HttpRuntimeProxy._request_spool_bytes,
       )
-      self._proxy.wait_for_connection(self._process)
+      # Changes by NoCommandLine - let the runtime report when it is ready
+      # instead of only polling its port.
+      with startup_timeline.phase('wait_for_ready', 'instance',
+                                  port=port or unix_socket,
+                                  notify=self._notify_socket is not None,
+                                  **self._trace_args):
+        self._wait_for_ready_notification()
+        self._proxy.wait_for_connection(self._process)
+        if error is None:
+          self._wait_for_ready_path()
+
+  def _stop_process(self, quit_with_sigterm):
+    """Stops the runtime process, must be called with _process_lock held."""
+    try:
+      # Changes by NoCommandLine - stop everything the runtime process
+      # started, e.g. the workers of gunicorn.
+      if self._process_group:
+        _stop_process_group(self._process, quit_with_sigterm)
+      elif quit_with_sigterm:
+        logging.debug('Calling process.terminate on child runtime.')
+        self._process.terminate()
+      else:
+        self._process.kill()
+    except OSError:
+      pass
+    # Changes by NoCommandLine - the stderr pipe is closed once the runtime
+    # process closed its end, without joining a thread for up to 5 seconds.
+    self._process = None
+    self._process_group = False
+    self._release_port()
+    self._remove_unix_socket()
+    if self._connection_pool is not None:
+      self._connection_pool.close()
 
   def quit(self):
     """Causes the runtime process to exit."""
-    with self._process_lock:
+    self._quit_requested.set()
+    self._available.set()
+    with self._process_lock, startup_timeline.phase(
+        'quit', 'instance', **self._trace_args):
+      # Changes by NoCommandLine - the process that exited may just be
+      # replaced, _restart_process stops the new one.
+      if self._process is None and self._restarts:
+        return
       assert self._process, 'module was not running'
-      try:
-        if HttpRuntimeProxy._quit_with_sigterm:
-          logging.debug('Calling process.terminate on child runtime.')
-          self._process.terminate()
-        else:
-          self._process.kill()
-      except OSError:
-        pass
-      # Mac leaks file descriptors without call to join. Suspect a race
-      # condition where the interpreter is unable to close the subprocess pipe
-      # as the thread hasn't returned from the readline call.
-      self._stderr_tee.join(5)
-      self._process = None
+      self._stop_process(HttpRuntimeProxy._quit_with_sigterm)
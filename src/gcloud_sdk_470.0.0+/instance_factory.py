@@ -24,13 +24,25 @@ from __future__ import print_function
 
 
 
+import ast
+import atexit
+import concurrent.futures
+import errno
+import hashlib
+import io
+import json
 import logging
 import os
+import re
+import shlex
 import shutil
+import socket
 import subprocess
 import sys
 import tempfile
+import threading
 import time
+import weakref
 
 import google
 from google.appengine._internal import six
@@ -46,7 +58,37 @@ from google.appengine.tools.devappserver2 import errors
 from google.appengine.tools.devappserver2 import http_runtime
 from google.appengine.tools.devappserver2 import instance
 
-_MODERN_DEFAULT_ENTRYPOINT = 'gunicorn -b :${PORT} main:app'
+# Changes by NoCommandLine - the default entrypoint is sized like App Engine
+# sizes gunicorn for the instance class, see _GetDefaultEntrypoint.
+_MODERN_DEFAULT_ENTRYPOINT = (
+    'gunicorn -b :${PORT} -w %(workers)d -k gthread --threads %(threads)d '
+    '--preload --timeout %(timeout)d --graceful-timeout %(graceful_timeout)d '
+    'main:app')
+_WINDOWS_DEFAULT_ENTRYPOINT = (
+    'waitress-serve --listen=*:${PORT} --threads=%(threads)d '
+    '--channel-timeout=%(timeout)d main:app')
+# The default entrypoints of ASGI apps, see _is_asgi_app.
+_ASGI_DEFAULT_ENTRYPOINT = (
+    'gunicorn -b :${PORT} -w %(workers)d -k uvicorn.workers.UvicornWorker '
+    '--preload --timeout %(timeout)d --graceful-timeout %(graceful_timeout)d '
+    'main:app')
+_WINDOWS_ASGI_DEFAULT_ENTRYPOINT = (
+    'uvicorn --host 0.0.0.0 --port ${PORT} --workers %(workers)d '
+    '--timeout-graceful-shutdown %(graceful_timeout)d main:app')
+# Callables that return an ASGI app.
+_ASGI_APP_FACTORIES = frozenset([
+    'FastAPI', 'Starlette', 'Quart', 'Litestar', 'Sanic',
+    'get_asgi_application'])
+_INSTANCE_CLASS_WORKERS = {
+    'F1': 2, 'B1': 2,
+    'F2': 4, 'B2': 4,
+    'F4': 8, 'F4_1G': 8, 'B4': 8, 'B4_1G': 8, 'B8': 8,
+}
+_DEFAULT_ENTRYPOINT_THREADS_PER_WORKER = 4
+# The request timeouts of automatic, and of basic and manual scaling.
+_AUTOMATIC_SCALING_TIMEOUT_SECONDS = 10 * 60
+_BASIC_SCALING_TIMEOUT_SECONDS = 24 * 60 * 60
+_DEFAULT_ENTRYPOINT_GRACEFUL_TIMEOUT_SECONDS = 5
 
 _DEFAULT_REQUIREMENT_FILE_NAME = 'requirements.txt'
 
@@ -57,6 +99,624 @@ _RECREATE_MODERN_INSTANCE_FACTORY_CONFIG_CHANGES = frozenset([
 
 _MODERN_REQUEST_ID_HEADER_NAME = 'X-Appengine-Api-Ticket'
 
+# Changes by NoCommandLine - settings for the persistent virtualenv cache. See
+# PythonRuntimeInstanceFactory.SetVenvCacheDir.
+_VENV_CACHE_DIR_ENV = 'DEVAPPSERVER_VENV_CACHE_DIR'
+_VENV_CACHE_MAX_ENTRIES_ENV = 'DEVAPPSERVER_VENV_CACHE_MAX_ENTRIES'
+_VENV_CACHE_MAX_AGE_DAYS_ENV = 'DEVAPPSERVER_VENV_CACHE_MAX_AGE_DAYS'
+_VENV_CACHE_MAX_SIZE_MB_ENV = 'DEVAPPSERVER_VENV_CACHE_MAX_SIZE_MB'
+
+# Written into a cached virtualenv once it is fully built. Its presence marks
+# the entry as usable and its mtime records when the entry was last used.
+_VENV_CACHE_METADATA_FILE_NAME = '.devappserver_venv_cache.json'
+
+# Cache entries without metadata that are older than this are leftovers from
+# an interrupted build and are removed during eviction.
+_VENV_CACHE_ABANDONED_BUILD_SECONDS = 24 * 60 * 60
+
+# Every process using a cache entry touches this file in it every
+# _VENV_CACHE_LEASE_REFRESH_SECONDS; eviction skips entries whose lease was
+# touched within _VENV_CACHE_LEASE_SECONDS, as another dev_appserver sharing
+# the cache directory may run from them.
+_VENV_CACHE_LEASE_FILE_NAME = '.devappserver_venv_cache.lease'
+_VENV_CACHE_LEASE_SECONDS = 5 * 60
+_VENV_CACHE_LEASE_REFRESH_SECONDS = 60
+
+# How often a process waits for an entry another process is building.
+_VENV_CACHE_BUILD_POLL_SECONDS = 1
+
+# Changes by NoCommandLine - when set, requirements.txt edits are applied to the
+# existing virtualenv instead of recreating it. See
+# PythonRuntimeInstanceFactory.SetVenvSyncEnabled.
+_VENV_SYNC_ENV = 'DEVAPPSERVER_VENV_SYNC'
+
+# Changes by NoCommandLine - number of modules whose virtualenvs are set up at
+# the same time. See PythonRuntimeInstanceFactory.SetVenvProvisioningWorkers.
+_VENV_WORKERS_ENV = 'DEVAPPSERVER_VENV_WORKERS'
+
+# Written into a virtualenv after pip install with the requirements it was
+# installed from, so a later edit of requirements.txt can be diffed against it.
+_REQUIREMENTS_SNAPSHOT_FILE_NAME = '.devappserver_requirements.json'
+
+# A requirement that names a single project, e.g. 'Flask[async]>=2.0;
+# python_version>"3.8"'. Anything else (pip options, URLs, paths) can't be
+# synced and forces the virtualenv to be recreated.
+_SIMPLE_REQUIREMENT_RE = re.compile(
+    r'^([A-Za-z0-9][A-Za-z0-9._-]*)\s*(\[[^\]]*\])?\s*([<>=!~][^;@]*)?(;.*)?$')
+
+# Prints the distributions installed in the python it is run with, as json.
+_LIST_INSTALLED_DISTRIBUTIONS_SCRIPT = (
+    'import json, importlib.metadata as m; '
+    'print(json.dumps({d.metadata["Name"]: d.version '
+    'for d in m.distributions() if d.metadata["Name"]}))')
+
+# Changes by NoCommandLine - shared store of unpacked distributions that
+# virtualenvs link their packages from. See
+# PythonRuntimeInstanceFactory.SetPackageStoreDir.
+_PACKAGE_STORE_DIR_ENV = 'DEVAPPSERVER_PACKAGE_STORE_DIR'
+
+# Generates the console and gui scripts of the distributions whose
+# entry_points.txt files are passed after the target directory. Run with the
+# virtualenv's python so the scripts point at it.
+_MAKE_SCRIPTS_SCRIPT = '''
+import configparser, sys
+from pip._vendor.distlib.scripts import ScriptMaker
+maker = ScriptMaker(None, sys.argv[1])
+maker.clobber = True
+maker.variants = set([''])
+maker.executable = sys.executable
+for path in sys.argv[2:]:
+  parser = configparser.ConfigParser(delimiters=('=',))
+  parser.optionxform = str
+  parser.read(path)
+  for section, options in (('console_scripts', None),
+                           ('gui_scripts', {'gui': True})):
+    if parser.has_section(section):
+      maker.make_multiple(
+          ['%s = %s' % item for item in parser.items(section)], options)
+'''
+
+# Changes by NoCommandLine - local directory of wheels that pip installs from
+# without the package index, and a switch forcing installs to never use the
+# index. See PythonRuntimeInstanceFactory.SetWheelhouseDir.
+_WHEELHOUSE_DIR_ENV = 'DEVAPPSERVER_WHEELHOUSE_DIR'
+_OFFLINE_ENV = 'DEVAPPSERVER_OFFLINE'
+
+# Changes by NoCommandLine - directory of pristine virtualenvs, one per python
+# interpreter, that module virtualenvs are cloned from. See
+# PythonRuntimeInstanceFactory.SetVenvTemplateDir.
+_VENV_TEMPLATE_DIR_ENV = 'DEVAPPSERVER_VENV_TEMPLATE_DIR'
+
+# Written into a template virtualenv once it is fully built, with the path it
+# was built at. Files of a clone that contain this path are rewritten.
+_VENV_TEMPLATE_METADATA_FILE_NAME = '.devappserver_venv_template.json'
+
+# Changes by NoCommandLine - number of started and warmed up instances each
+# module keeps ready. See PythonRuntimeInstanceFactory.SetInstancePoolSize.
+_INSTANCE_POOL_SIZE_ENV = 'DEVAPPSERVER_INSTANCE_POOL_SIZE'
+# After a change of the code or configuration the pool is refilled once no
+# other change came for this long, so saving several files in a row starts the
+# pooled instances only once.
+_INSTANCE_POOL_REFILL_DELAY_SECONDS = 2
+
+# Changes by NoCommandLine - fork runtime processes from a zygote, for all
+# modules, or for one when set in the env_variables of its app.yaml. See
+# PythonRuntimeInstanceFactory.SetZygoteEnabled.
+_ZYGOTE_ENV = 'DEVAPPSERVER_ZYGOTE'
+
+# Changes by NoCommandLine - adjust the concurrent requests of each instance
+# to its latency. See PythonRuntimeInstanceFactory.SetAdaptiveConcurrency.
+_ADAPTIVE_CONCURRENCY_ENV = 'DEVAPPSERVER_ADAPTIVE_CONCURRENCY'
+# The limit is cut when the smoothed latency exceeds this multiple of the
+# lowest latency seen in the last _ADAPTIVE_WINDOW_REQUESTS requests.
+_ADAPTIVE_LATENCY_TOLERANCE = 2.0
+_ADAPTIVE_WINDOW_REQUESTS = 100
+_ADAPTIVE_DECREASE_FACTOR = 0.75
+_ADAPTIVE_SMOOTHING = 0.2
+
+# Concurrent requests of an instance whose server isn't known.
+_DEFAULT_MAX_CONCURRENT_REQUESTS = 8
+# Concurrent requests of a worker of an async server, unless the entrypoint
+# has a lower limit.
+_MAX_ASYNC_CONCURRENT_REQUESTS_PER_WORKER = 100
+_ASYNC_GUNICORN_WORKER_CLASSES_RE = re.compile(
+    r'gevent|eventlet|tornado|uvicorn|aiohttp', re.IGNORECASE)
+
+# A line of a pip log file, e.g. '2024-05-01T10:00:00,123 Collecting flask'.
+_PIP_LOG_LINE_RE = re.compile(
+    r'^(\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d),(\d{3}) (.*)$')
+
+_DEFAULT_INDEX_URL = 'https://pypi.org/simple'
+_INDEX_PROBE_TIMEOUT_SECONDS = 1.5
+_INDEX_PROBE_INTERVAL_SECONDS = 60
+
+
+def _get_bool_from_env(name):
+  """Returns True if an environment variable is set to a true value."""
+  return os.environ.get(name, '').lower() in ('1', 'true', 'yes', 'on')
+
+
+def _get_number_from_env(name, default, convert=int):
+  """Returns the numeric value of an environment variable or a default."""
+  value = os.environ.get(name)
+  if not value:
+    return default
+  try:
+    return convert(value)
+  except ValueError:
+    logging.warning('Ignoring invalid value "%s" for %s.', value, name)
+    return default
+
+
+def _read_normalized_requirements(requirements_file_name, seen=None):
+  """Returns the meaningful lines of a requirements file.
+
+  Comments, blank lines and line continuations are dropped so that cosmetic
+  edits don't change the result. Files pulled in with -r/-c are expanded in
+  place because their content affects what gets installed.
+
+  Args:
+    requirements_file_name: Path to a pip requirements file.
+    seen: Set of already expanded paths, used to stop include cycles.
+
+  Returns:
+    A list of strings, one per requirement or pip option.
+  """
+  seen = set() if seen is None else seen
+  path = os.path.abspath(requirements_file_name)
+  if path in seen or not os.path.exists(path):
+    return []
+  seen.add(path)
+  with open(path, 'r') as f:
+    content = f.read().replace('\\\n', '')
+  lines = []
+  for line in content.splitlines():
+    line = re.sub(r'(^|\s)#.*$', '', line).strip()
+    if not line:
+      continue
+    include = re.match(r'^(-r|--requirement|-c|--constraint)[\s=]+(\S+)$', line)
+    if include:
+      lines.extend(_read_normalized_requirements(
+          os.path.join(os.path.dirname(path), include.group(2)), seen))
+    else:
+      lines.append(line)
+  return lines
+
+
+def _normalize_project_name(name):
+  """Returns the PEP 503 normalized form of a project name."""
+  return re.sub(r'[-_.]+', '-', name).lower()
+
+
+def _parse_simple_requirements(lines):
+  """Maps project names to their requirement line.
+
+  Args:
+    lines: Normalized requirement lines, see _read_normalized_requirements.
+
+  Returns:
+    A dict of normalized project name to requirement line, or None if a line
+    is not a plain project requirement.
+  """
+  requirements = {}
+  for line in lines:
+    match = _SIMPLE_REQUIREMENT_RE.match(line)
+    if not match:
+      return None
+    requirements[_normalize_project_name(match.group(1))] = line
+  return requirements
+
+
+def _record_pip_log_phases(pip_log_file_name, module_name):
+  """Adds the time pip spent on each package to the startup timeline.
+
+  pip doesn't report durations, but its log file has a timestamp per line.
+  A package takes from the line pip starts collecting it (downloading or
+  building it) until the next package; installing all of them is one phase.
+
+  Args:
+    pip_log_file_name: The file pip wrote with --log.
+    module_name: The module pip ran for.
+  """
+  marks = []
+  with open(pip_log_file_name, 'r') as f:
+    for line in f:
+      match = _PIP_LOG_LINE_RE.match(line)
+      if not match:
+        continue
+      timestamp = time.mktime(time.strptime(
+          match.group(1), '%Y-%m-%dT%H:%M:%S')) + int(match.group(2)) / 1000.0
+      message = match.group(3).strip()
+      package = re.match(r'^(Collecting|Processing|Obtaining) (\S+)', message)
+      if package:
+        marks.append((timestamp, 'pip_collect', package.group(2)))
+      elif message.startswith('Requirement already satisfied'):
+        marks.append((timestamp, None, None))
+      elif message.startswith('Installing collected packages:'):
+        marks.append((timestamp, 'pip_install_packages',
+                      message.split(':', 1)[1].strip()))
+      elif message.startswith(('Successfully installed', 'Would install')):
+        marks.append((timestamp, None, None))
+  for (start, name, package), (end, _, _) in zip(marks, marks[1:]):
+    if name is not None:
+      http_runtime.startup_timeline.record(
+          name, 'module', start, end - start, module=module_name,
+          package=package)
+
+
+def _link_tree(src, dst, skip=()):
+  """Recreates the directory tree src in dst with hardlinks to its files.
+
+  Files are copied where a hardlink can't be made, e.g. across drives.
+
+  Args:
+    src: The directory to link from.
+    dst: The directory to link into. Existing files are replaced.
+    skip: Names of top level entries of src that are left out.
+  """
+  for root, dirs, files in os.walk(src):
+    if root == src:
+      dirs[:] = [d for d in dirs if d not in skip]
+      files = [f for f in files if f not in skip]
+    dst_root = os.path.join(dst, os.path.relpath(root, src))
+    if not os.path.exists(dst_root):
+      os.makedirs(dst_root)
+    for name in files:
+      src_file = os.path.join(root, name)
+      dst_file = os.path.join(dst_root, name)
+      if os.path.lexists(dst_file):
+        os.remove(dst_file)
+      try:
+        os.link(src_file, dst_file)
+      except OSError:
+        shutil.copy2(src_file, dst_file)
+
+
+def _get_dir_size(path):
+  """Returns the total size in bytes of the files below path."""
+  total = 0
+  for root, _, files in os.walk(path):
+    for name in files:
+      try:
+        total += os.lstat(os.path.join(root, name)).st_size
+      except OSError:
+        pass
+  return total
+
+
+def _get_option_values(args, short_options, long_options):
+  """Returns the values of the options of a command line.
+
+  Args:
+    args: The arguments, without the program.
+    short_options: Short options that take a value, e.g. ['-w'].
+    long_options: Long options that take a value, e.g. ['--workers'].
+
+  Returns:
+    A dict of option to its last value, with '-w4', '-w 4', '--workers=4'
+    and '--workers 4' all giving {'--workers': '4'} when -w is listed at the
+    same index as --workers.
+  """
+  names = dict(zip(short_options, long_options))
+  names.update((name, name) for name in long_options)
+  values = {}
+  i = 0
+  while i < len(args):
+    arg = args[i]
+    i += 1
+    if arg.startswith('--') and '=' in arg:
+      name, value = arg.split('=', 1)
+    elif arg in names:
+      name = arg
+      if i == len(args):
+        break
+      value = args[i]
+      i += 1
+    elif arg[:2] in short_options and len(arg) > 2:
+      name, value = arg[:2], arg[2:]
+    else:
+      continue
+    if name in names:
+      values[names[name]] = value
+  return values
+
+
+def _get_server_concurrency(entrypoint, env):
+  """Returns how many requests the server of an entrypoint handles at once.
+
+  Knows the options of gunicorn, waitress-serve, uvicorn, hypercorn and
+  daphne; gunicorn configuration files are not read.
+
+  Args:
+    entrypoint: The entrypoint of the module.
+    env: The environment variables of the runtime process.
+
+  Returns:
+    A (concurrent requests, description) tuple, or None if the server isn't
+    known.
+  """
+  try:
+    args = shlex.split(entrypoint, posix=os.name != 'nt')
+  except ValueError:
+    return None
+  while args and (args[0] == 'exec' or re.match(r'^\w+=', args[0])):
+    args = args[1:]
+  if (len(args) > 2 and
+      os.path.basename(args[0]).startswith('python') and args[1] == '-m'):
+    args = args[2:]
+  if not args:
+    return None
+  server = re.split(r'[\\/]', args[0])[-1].lower()
+  if server.endswith('.exe'):
+    server = server[:-len('.exe')]
+  try:
+    if server == 'gunicorn':
+      values = _get_option_values(
+          args[1:], ['-w', '-k'],
+          ['--workers', '--worker-class', '--threads', '--worker-connections'])
+      workers = int(values.get('--workers') or
+                    env.get('WEB_CONCURRENCY') or 1)
+      threads = int(values.get('--threads') or 1)
+      worker_class = values.get('--worker-class', 'sync')
+      if _ASYNC_GUNICORN_WORKER_CLASSES_RE.search(worker_class):
+        connections = min(int(values.get('--worker-connections') or 1000),
+                          _MAX_ASYNC_CONCURRENT_REQUESTS_PER_WORKER)
+        return workers * connections, 'gunicorn, %d x %s' % (workers,
+                                                               worker_class)
+      return workers * threads, 'gunicorn, %d workers x %d threads' % (
+          workers, threads)
+    if server == 'waitress-serve':
+      threads = int(
+          _get_option_values(args[1:], [], ['--threads']).get('--threads') or
+          4)
+      return threads, 'waitress, %d threads' % threads
+    if server in ('uvicorn', 'hypercorn', 'daphne'):
+      values = _get_option_values(args[1:], ['-w'],
+                                  ['--workers', '--limit-concurrency'])
+      workers = int(values.get('--workers') or
+                    (server == 'uvicorn' and env.get('WEB_CONCURRENCY')) or 1)
+      connections = min(int(values.get('--limit-concurrency') or
+                            _MAX_ASYNC_CONCURRENT_REQUESTS_PER_WORKER),
+                        _MAX_ASYNC_CONCURRENT_REQUESTS_PER_WORKER)
+      return workers * connections, '%s, %d workers' % (server, workers)
+  except ValueError:
+    return None
+  return None
+
+
+def _is_asgi_app(main_file_name, app_name='app'):
+  """Returns whether a main.py defines its app as an ASGI app.
+
+  Only the source is looked at, as the app can't be imported before its
+  dependencies are installed: app has to be assigned the result of one of
+  _ASGI_APP_FACTORIES (e.g. app = FastAPI()), possibly wrapped in middleware
+  afterwards, or be an async function.
+
+  Args:
+    main_file_name: The path of main.py.
+    app_name: The name of the app in main.py.
+
+  Returns:
+    True if app is an ASGI app, False if it isn't or it can't be told.
+  """
+  try:
+    with open(main_file_name, 'rb') as f:
+      tree = ast.parse(f.read(), main_file_name)
+  except (IOError, OSError, SyntaxError, ValueError):
+    return False
+  is_asgi = False
+  for node in tree.body:
+    if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+      if node.name == app_name:
+        is_asgi = isinstance(node, ast.AsyncFunctionDef)
+    elif isinstance(node, (ast.Assign, ast.AnnAssign)):
+      targets = node.targets if isinstance(node, ast.Assign) else [node.target]
+      if not any(isinstance(target, ast.Name) and target.id == app_name
+                 for target in targets):
+        continue
+      func = getattr(node.value, 'func', None)
+      name = getattr(func, 'attr', None) or getattr(func, 'id', None)
+      wrapped = any(isinstance(arg, ast.Name) and arg.id == app_name
+                    for arg in getattr(node.value, 'args', ()))
+      # Middleware wrapping the app, e.g. app = Middleware(app), keeps its
+      # kind.
+      if not wrapped:
+        is_asgi = name in _ASGI_APP_FACTORIES
+  return is_asgi
+
+
+class _PooledRuntimeProxy(instance.RuntimeProxy):
+  """A runtime proxy started in the background before it is needed.
+
+  prestart() starts the wrapped proxy and sends it the warmup request; it
+  runs on its own thread while the proxy waits in the instance pool. start()
+  only waits for that to finish, so an instance created with a pooled proxy
+  is ready as soon as the background start is.
+  """
+
+  def __init__(self, proxy, warmup_url_map, instance_id):
+    """Initializer for _PooledRuntimeProxy.
+
+    Args:
+      proxy: The http_runtime.HttpRuntimeProxy to start.
+      warmup_url_map: The appinfo.URLMap of the warmup request, or None to not
+        send one.
+      instance_id: The id the proxy was created with.
+    """
+    super(_PooledRuntimeProxy, self).__init__()
+    self._proxy = proxy
+    self.instance_id = instance_id
+    self._warmup_url_map = warmup_url_map
+    self._warmed_up = False
+    self._started = threading.Event()
+    self._start_error = None
+    # Whether the runtime process started, even if the warmup request failed.
+    self._proxy_started = False
+
+  def prestart(self):
+    """Starts the runtime process and warms it up."""
+    try:
+      self._proxy.start()
+      self._proxy_started = True
+      if self._warmup_url_map is not None:
+        self._WarmUp()
+    except Exception as e:  # pylint: disable=broad-except
+      logging.exception('Failed starting a pooled runtime instance.')
+      self._start_error = e
+    finally:
+      self._started.set()
+
+  def _WarmUp(self):
+    environ = {
+        'REQUEST_METHOD': 'GET',
+        'PATH_INFO': self._warmup_url_map.url,
+        'QUERY_STRING': '',
+        'SERVER_NAME': 'localhost',
+        'SERVER_PORT': '80',
+        'SERVER_PROTOCOL': 'HTTP/1.1',
+        'REMOTE_ADDR': '0.1.0.3',
+        'HTTP_HOST': 'localhost',
+        'HTTP_X_APPENGINE_FAKE_IS_ADMIN': '1',
+        'wsgi.url_scheme': 'http',
+        'wsgi.input': io.BytesIO(),
+        'wsgi.errors': sys.stderr,
+    }
+    statuses = []
+    start_response = lambda status, headers, exc_info=None: statuses.append(
+        status)
+    # Consume the response so the request is complete.
+    for _ in self._proxy.handle(environ, start_response, self._warmup_url_map,
+                                None, 'warmup', instance.READY_REQUEST):
+      pass
+    logging.info('Warmup request of a pooled runtime instance returned "%s".',
+                 statuses[0] if statuses else 'no response')
+    self._warmed_up = True
+
+  def set_instance_id(self, instance_id):
+    """Hands the proxy to an instance with an id other than predicted."""
+    self.instance_id = instance_id
+    self._proxy.set_instance_id(instance_id)
+
+  def start(self):
+    self._started.wait()
+    if self._start_error is not None:
+      raise self._start_error
+
+  def quit(self):
+    self._started.wait()
+    if self._proxy_started:
+      self._proxy.quit()
+
+  def handle(self, environ, start_response, url_map, match, request_id,
+             request_type):
+    # The instance got its warmup request in the pool already; /_ah/start is
+    # still forwarded.
+    if (self._warmed_up and request_type == instance.READY_REQUEST and
+        environ.get('PATH_INFO') == self._warmup_url_map.url):
+      start_response('200 OK', [('Content-Type', 'text/plain'),
+                                ('Content-Length', '0')])
+      return [b'']
+    return self._proxy.handle(environ, start_response, url_map, match,
+                              request_id, request_type)
+
+
+class _AdaptiveInstance(instance.Instance):
+  """An instance whose concurrent requests follow its latency (AIMD).
+
+  The limit starts at, and never exceeds, the concurrent requests of the
+  server. While the instance is full and the smoothed latency stays within
+  _ADAPTIVE_LATENCY_TOLERANCE of the lowest recent latency, the limit grows
+  by one per limit requests; when latency rises above that (requests queue
+  in the server, or the app runs out of CPU), it is cut by
+  _ADAPTIVE_DECREASE_FACTOR, at most once per limit requests.
+
+  The limit is applied through private attributes of instance.Instance; with
+  an SDK whose Instance lacks them, the instance behaves like a plain one.
+  """
+
+  _INSTANCE_ATTRIBUTES = ('_condition', '_num_outstanding_requests',
+                          '_max_concurrent_requests')
+  _logged_unsupported = False
+
+  def __init__(self, request_data, instance_id, runtime_proxy,
+               max_concurrent_requests, max_background_threads=0,
+               expect_ready_request=False):
+    super(_AdaptiveInstance, self).__init__(
+        request_data, instance_id, runtime_proxy, max_concurrent_requests,
+        max_background_threads, expect_ready_request)
+    self._max_limit = max_concurrent_requests
+    self._limit = float(max_concurrent_requests)
+    self._smoothed_latency = None
+    self._baseline_latency = None
+    self._window_min_latency = None
+    self._window_requests = 0
+    self._requests_since_decrease = 0
+    missing = [name for name in self._INSTANCE_ATTRIBUTES
+               if not hasattr(self, name)]
+    self._adaptive = not missing
+    if missing and not _AdaptiveInstance._logged_unsupported:
+      _AdaptiveInstance._logged_unsupported = True
+      logging.warning('Adaptive concurrency is turned off, the Instance of '
+                      'this SDK has no %s.', ', '.join(missing))
+
+  def handle(self, environ, start_response, url_map, match, request_id,
+             request_type):
+    if not self._adaptive:
+      return super(_AdaptiveInstance, self).handle(
+          environ, start_response, url_map, match, request_id, request_type)
+    start_time = time.time()
+    with self._condition:
+      saturated = self._num_outstanding_requests + 1 >= int(self._limit)
+    response = super(_AdaptiveInstance, self).handle(
+        environ, start_response, url_map, match, request_id, request_type)
+    return self._ObserveLatency(response, start_time, saturated)
+
+  def _ObserveLatency(self, response, start_time, saturated):
+    # Also when the request failed, or the server stopped reading the response
+    # early and closed this generator.
+    try:
+      for chunk in response:
+        yield chunk
+    finally:
+      try:
+        if hasattr(response, 'close'):
+          response.close()
+      finally:
+        self._Adapt(time.time() - start_time, saturated)
+
+  def _Adapt(self, latency, saturated):
+    with self._condition:
+      if self._smoothed_latency is None:
+        self._smoothed_latency = self._baseline_latency = latency
+      self._smoothed_latency += _ADAPTIVE_SMOOTHING * (
+          latency - self._smoothed_latency)
+      self._window_min_latency = min(latency, self._window_min_latency or
+                                     latency)
+      self._window_requests += 1
+      self._baseline_latency = min(self._baseline_latency, latency)
+      if self._window_requests >= _ADAPTIVE_WINDOW_REQUESTS:
+        # Let the baseline rise again when the app got slower for good.
+        self._baseline_latency = self._window_min_latency
+        self._window_min_latency = None
+        self._window_requests = 0
+      self._requests_since_decrease += 1
+      limit = self._limit
+      if (self._smoothed_latency >
+          self._baseline_latency * _ADAPTIVE_LATENCY_TOLERANCE):
+        if self._requests_since_decrease >= int(self._limit):
+          limit = max(1.0, self._limit * _ADAPTIVE_DECREASE_FACTOR)
+          self._requests_since_decrease = 0
+      elif saturated:
+        limit = min(float(self._max_limit), self._limit + 1.0 / self._limit)
+      if int(limit) != int(self._limit):
+        logging.debug('Instance %s of %d concurrent requests now takes %d '
+                      '(latency %.3fs, baseline %.3fs).', self.instance_id,
+                      self._max_limit, int(limit), self._smoothed_latency,
+                      self._baseline_latency)
+      self._limit = limit
+      self._max_concurrent_requests = int(limit)
+      self._condition.notify_all()
+
 
 # TODO: Refactor this factory class for modern runtimes.
 class PythonRuntimeInstanceFactory(instance.InstanceFactory,
@@ -99,6 +759,191 @@ class PythonRuntimeInstanceFactory(instance.InstanceFactory,
 
   _runtime_python_path = {}
   _virtualenv_python_path = None
+  # Changes by NoCommandLine - persistent virtualenv cache, off unless a cache
+  # directory is configured.
+  _venv_cache_dir = os.environ.get(_VENV_CACHE_DIR_ENV) or None
+  _venv_cache_max_entries = _get_number_from_env(
+      _VENV_CACHE_MAX_ENTRIES_ENV, 10)
+  _venv_cache_max_age_days = _get_number_from_env(
+      _VENV_CACHE_MAX_AGE_DAYS_ENV, 30, float)
+  _venv_cache_max_size_mb = _get_number_from_env(
+      _VENV_CACHE_MAX_SIZE_MB_ENV, 4096, float)
+  # Cache entries used by factories of this process, once per factory; these
+  # are never evicted, and their leases are kept fresh for other processes.
+  _venv_cache_in_use = []
+  # Guards _venv_cache_build_locks and _venv_cache_lease_thread.
+  _venv_cache_lock = threading.Lock()
+  _venv_cache_build_locks = {}
+  _venv_cache_lease_thread = None
+  _venv_sync_enabled = _get_bool_from_env(_VENV_SYNC_ENV)
+  _logged_venv_sync_with_cache = False
+  _venv_workers = _get_number_from_env(_VENV_WORKERS_ENV, 1)
+  _package_store_dir = os.environ.get(_PACKAGE_STORE_DIR_ENV) or None
+  _wheelhouse_dir = os.environ.get(_WHEELHOUSE_DIR_ENV) or None
+  _offline = _get_bool_from_env(_OFFLINE_ENV)
+  _venv_template_dir = os.environ.get(_VENV_TEMPLATE_DIR_ENV) or None
+  _venv_template_lock = threading.Lock()  # Serializes template builds.
+  _instance_pool_size = _get_number_from_env(_INSTANCE_POOL_SIZE_ENV, 0)
+  _zygote_enabled = _get_bool_from_env(_ZYGOTE_ENV)
+  _adaptive_concurrency = _get_bool_from_env(_ADAPTIVE_CONCURRENCY_ENV)
+  _index_reachable = None
+  _index_probe_time = 0
+  _venv_executor = None
+  _venv_executor_lock = threading.Lock()  # Lock to guard _venv_executor.
+  _progress_lock = threading.Lock()  # Serializes pip progress output.
+  # Factories with pooled instances or a zygote, stopped by _StopAllAtExit.
+  # Weak references let replaced factories be collected.
+  _live_factories = weakref.WeakSet()
+  _live_factories_lock = threading.Lock()  # Guards the two values.
+  _stop_all_registered = False
+
+  @classmethod
+  def SetPackageStoreDir(cls, package_store_dir):
+    """Set the shared store virtualenvs link their packages from.
+
+    Each distribution is unpacked into the store once, keyed by name, version
+    and wheel tag, and hardlinked into the site-packages of every virtualenv
+    that needs it. Requirements that can't be shared (local directories, VCS
+    checkouts) make pip install everything as usual.
+
+    Args:
+      package_store_dir: The store directory, or None to disable the store.
+    """
+    PythonRuntimeInstanceFactory._package_store_dir = package_store_dir
+
+  @classmethod
+  def SetWheelhouseDir(cls, wheelhouse_dir, offline=None):
+    """Set the local directory of wheels pip installs from.
+
+    The first time a set of requirements is installed while the package index
+    is reachable, wheels for all of them are built or downloaded into the
+    wheelhouse. Later installs of the same requirements only use the
+    wheelhouse and never look up the package index.
+
+    Args:
+      wheelhouse_dir: The wheelhouse directory, or None to always install from
+        the package index.
+      offline: Optional bool, True to never use the package index even if it
+        is reachable.
+    """
+    PythonRuntimeInstanceFactory._wheelhouse_dir = wheelhouse_dir
+    if wheelhouse_dir and not os.path.exists(wheelhouse_dir):
+      os.makedirs(wheelhouse_dir)
+    if offline is not None:
+      PythonRuntimeInstanceFactory._offline = offline
+
+  @classmethod
+  def SetInstancePoolSize(cls, instance_pool_size):
+    """Set how many ready instances each module keeps in the background.
+
+    Pooled instances are started, and sent /_ah/warmup if the module has the
+    warmup inbound service, before anything asks for them. Creating an
+    instance takes one from the pool, which is then refilled. The pool is
+    emptied and refilled when code, configuration or dependencies change.
+
+    Args:
+      instance_pool_size: The number of pooled instances per module; 0
+        disables the pool.
+    """
+    PythonRuntimeInstanceFactory._instance_pool_size = instance_pool_size
+
+  @classmethod
+  def SetAdaptiveConcurrency(cls, adaptive_concurrency):
+    """Set whether instances adjust their concurrent requests to latency.
+
+    Instances then take fewer requests at once while their latency is well
+    above the lowest recent one, and more (up to what the server handles)
+    while it isn't.
+
+    Args:
+      adaptive_concurrency: True to adjust the concurrent requests.
+    """
+    PythonRuntimeInstanceFactory._adaptive_concurrency = adaptive_concurrency
+
+  @classmethod
+  def SetZygoteEnabled(cls, zygote_enabled):
+    """Set whether runtime processes are forked from a zygote.
+
+    The zygote of a module is a Python process in its virtualenv that
+    imported the installed packages, so starting an instance or restarting it
+    after a code change only imports the app. Only supported on POSIX, and
+    only for entrypoints that don't need a shell. A module can turn it on or
+    off for itself with DEVAPPSERVER_ZYGOTE in the env_variables of its
+    app.yaml.
+
+    Args:
+      zygote_enabled: True to fork runtime processes from a zygote.
+    """
+    PythonRuntimeInstanceFactory._zygote_enabled = zygote_enabled
+
+  @classmethod
+  def SetVenvTemplateDir(cls, venv_template_dir):
+    """Set the directory holding the template virtualenvs.
+
+    A pristine virtualenv with an up to date pip is built there once per
+    python interpreter. New virtualenvs are cloned from it with hardlinks
+    (copies where hardlinks aren't possible) instead of being created with
+    `python -m venv`, which installs pip into every one of them again.
+
+    Args:
+      venv_template_dir: The template directory, or None to create every
+        virtualenv from scratch.
+    """
+    PythonRuntimeInstanceFactory._venv_template_dir = venv_template_dir
+    if venv_template_dir and not os.path.exists(venv_template_dir):
+      os.makedirs(venv_template_dir)
+
+  @classmethod
+  def SetVenvProvisioningWorkers(cls, venv_workers):
+    """Set how many modules can set up their virtualenv concurrently.
+
+    With more than one worker, the python check and virtualenv setup of each
+    module run in a shared thread pool instead of in __init__, and a module
+    only waits for its own virtualenv when it first creates an instance.
+
+    Args:
+      venv_workers: The maximum number of concurrent setups; 1 keeps the
+        setup synchronous.
+    """
+    PythonRuntimeInstanceFactory._venv_workers = venv_workers
+
+  @classmethod
+  def SetVenvSyncEnabled(cls, venv_sync_enabled):
+    """Set whether requirements.txt edits are applied in place.
+
+    When enabled, an edit of requirements.txt installs, upgrades or uninstalls
+    only the distributions whose requirement changed. The virtualenv is
+    recreated if the edit can't be applied that way.
+
+    Args:
+      venv_sync_enabled: True to sync the virtualenv in place.
+    """
+    PythonRuntimeInstanceFactory._venv_sync_enabled = venv_sync_enabled
+
+  @classmethod
+  def SetVenvCacheDir(cls, venv_cache_dir, max_entries=None, max_age_days=None,
+                      max_size_mb=None):
+    """Set the directory holding virtualenvs reused across restarts.
+
+    Each entry is keyed by the module's requirements, the packages added for
+    the default entrypoint, build_env_variables and the python interpreter, so
+    a restart with unchanged dependencies reuses the entry without running
+    pip. The cache is not used together with SetVirtualEnvPythonPath.
+
+    Args:
+      venv_cache_dir: The cache directory, or None to disable the cache.
+      max_entries: Optional maximum number of cached virtualenvs.
+      max_age_days: Optional number of days after which an unused virtualenv
+        is removed.
+      max_size_mb: Optional maximum total size of the cache in megabytes.
+    """
+    PythonRuntimeInstanceFactory._venv_cache_dir = venv_cache_dir
+    if max_entries is not None:
+      PythonRuntimeInstanceFactory._venv_cache_max_entries = max_entries
+    if max_age_days is not None:
+      PythonRuntimeInstanceFactory._venv_cache_max_age_days = max_age_days
+    if max_size_mb is not None:
+      PythonRuntimeInstanceFactory._venv_cache_max_size_mb = max_size_mb
 
   @classmethod
   def SetVirtualEnvPythonPath(cls, virtualenv_python_path):
@@ -132,6 +977,7 @@ class PythonRuntimeInstanceFactory(instance.InstanceFactory,
     try:
       version_str = subprocess.check_output(
           [python_interpreter_path, '--version'])
+      self._python_version = six.ensure_str(version_str).strip()
       logging.info(
           'Detected python version "%s" for runtime "%s" at "%s".',
           version_str,
@@ -161,11 +1007,89 @@ class PythonRuntimeInstanceFactory(instance.InstanceFactory,
         8 if runtime_config_getter().threadsafe else 1, 10)
     self._runtime_config_getter = runtime_config_getter
     self._module_configuration = module_configuration
+    self._logged_default_entrypoint = None
+    self._asgi = self._IsAsgiApp()
+    # Changes by NoCommandLine - take as many concurrent requests as the
+    # server of the entrypoint handles.
+    self.max_concurrent_requests = self._GetMaxConcurrentRequests()
     self._venv_dir = ''
-    self._CheckPythonExecutable()
+    self._python_version = ''
+    self._venv_future = None
+    self._venv_provisioned = False  # Whether _ProvisionVirtualenv finished.
+    self._instance_pool = []
+    self._instance_pool_lock = threading.Lock()  # Guards _instance_pool.
+    # The id the SDK is expected to give the next instance, see new_instance.
+    self._next_instance_id = 0
+    self._instance_pool_fill_timer = None  # Guarded by _instance_pool_lock.
+    self._zygote = None
+    self._zygote_lock = threading.Lock()  # Guards _zygote.
+    if (PythonRuntimeInstanceFactory._instance_pool_size > 0 or
+        self._UseZygote()):
+      self._RegisterForExit()
+    # Changes by NoCommandLine - set up virtualenvs of several modules at once.
+    if PythonRuntimeInstanceFactory._venv_workers > 1:
+      self._venv_future = self._GetVenvExecutor().submit(
+          self._ProvisionVirtualenv)
+      self._venv_future.add_done_callback(self._LogProvisioningFailure)
+    else:
+      self._ProvisionVirtualenv()
+
+  def _RegisterForExit(self):
+    with PythonRuntimeInstanceFactory._live_factories_lock:
+      PythonRuntimeInstanceFactory._live_factories.add(self)
+      if not PythonRuntimeInstanceFactory._stop_all_registered:
+        atexit.register(PythonRuntimeInstanceFactory._StopAllAtExit)
+        PythonRuntimeInstanceFactory._stop_all_registered = True
+
+  @classmethod
+  def _StopAllAtExit(cls):
+    """Stops the pooled instances and zygotes of the live factories."""
+    with PythonRuntimeInstanceFactory._live_factories_lock:
+      factories = list(PythonRuntimeInstanceFactory._live_factories)
+    for factory in factories:
+      factory._DrainInstancePool(wait=True)
+      factory._StopZygote()
+
+  @classmethod
+  def _GetVenvExecutor(cls):
+    with PythonRuntimeInstanceFactory._venv_executor_lock:
+      if PythonRuntimeInstanceFactory._venv_executor is None:
+        PythonRuntimeInstanceFactory._venv_executor = (
+            concurrent.futures.ThreadPoolExecutor(
+                max_workers=PythonRuntimeInstanceFactory._venv_workers,
+                thread_name_prefix='VenvProvisioning'))
+      return PythonRuntimeInstanceFactory._venv_executor
+
+  def _ProvisionVirtualenv(self):
+    with http_runtime.startup_timeline.phase(
+        'check_python', 'module',
+        module=self._module_configuration.module_name):
+      self._CheckPythonExecutable()
     self._SetupVirtualenvFromConfiguration()
+    self._venv_provisioned = True
+    self._StartZygote()
+    self._FillInstancePool()
+
+  def _LogProvisioningFailure(self, future):
+    if not future.cancelled() and future.exception() is not None:
+      logging.error('Failed setting up the virtualenv for module "%s": %s',
+                    self._module_configuration.module_name, future.exception())
+
+  def _WaitForVirtualenv(self):
+    """Blocks until the virtualenv set up in the background is ready.
+
+    Raises:
+      Whatever exception the background setup raised.
+    """
+    if self._venv_future is not None:
+      self._venv_future.result()
 
   def __del__(self):
+    # Changes by NoCommandLine - a factory replaced on a configuration reload
+    # stops what it started.
+    self._DrainInstancePool()
+    self._StopZygote()
+    self._ReleaseCachedVirtualenv(self._venv_dir)
     self._CleanUpVenv(self._venv_dir)
 
   def _CleanUpVenv(self, venv_dir):
@@ -198,29 +1122,52 @@ class PythonRuntimeInstanceFactory(instance.InstanceFactory,
     return self._module_configuration.entrypoint
 
   def _SetupVirtualenvFromConfiguration(self):
-    self._CleanUpVenv(self._venv_dir)
-    # Create one only if it is not user provided
-    virtualenv_python_path = (
-        PythonRuntimeInstanceFactory._virtualenv_python_path
-    )
-    if virtualenv_python_path is None:
-      self._venv_dir = tempfile.mkdtemp()
-    else:
-      self._venv_dir = os.path.join(
-          virtualenv_python_path, self._module_configuration.module_name
+    # Changes by NoCommandLine - time it for the startup timeline.
+    with http_runtime.startup_timeline.phase(
+        'setup_virtualenv', 'module',
+        module=self._module_configuration.module_name):
+      self._ReleaseCachedVirtualenv(self._venv_dir)
+      self._CleanUpVenv(self._venv_dir)
+      # Create one only if it is not user provided
+      virtualenv_python_path = (
+          PythonRuntimeInstanceFactory._virtualenv_python_path
       )
-      if not os.path.exists(self._venv_dir):
-        os.makedirs(self._venv_dir)
+      # Changes by NoCommandLine - reuse a cached virtualenv if the dependencies
+      # did not change since it was built.
+      if (virtualenv_python_path is None and
+          PythonRuntimeInstanceFactory._venv_cache_dir):
+        self._venv_dir = self._GetCachedVirtualenv()
+        self.venv_env_vars = self._GetVirtualenvEnvVars(self._venv_dir)
+        return
+
+      if virtualenv_python_path is None:
+        self._venv_dir = tempfile.mkdtemp()
+      else:
+        self._venv_dir = os.path.join(
+            virtualenv_python_path, self._module_configuration.module_name
+        )
+        if not os.path.exists(self._venv_dir):
+          os.makedirs(self._venv_dir)
+
+      self.venv_env_vars = self._InstallVirtualenv(self._venv_dir)
+
+  def _InstallVirtualenv(self, venv_dir):
+    """Creates the virtualenv in venv_dir and installs the requirements."""
+    requirements_snapshot = self._GetRequirementsSnapshot()
+    venv_env_vars = self._InstallRequirements(venv_dir)
+    with open(os.path.join(
+        venv_dir, _REQUIREMENTS_SNAPSHOT_FILE_NAME), 'w') as f:
+      json.dump(requirements_snapshot, f)
+    return venv_env_vars
 
+  def _InstallRequirements(self, venv_dir):
     if self._entrypoint:
-      self.venv_env_vars = self._SetupVirtualenv(
-          self._venv_dir, self._OrigRequirementsFile)
+      return self._SetupVirtualenv(venv_dir, self._OrigRequirementsFile)
     else:  # use default entrypoint
       # Changes by NoCommandLine
       # For windows, pass self._OrigRequirementsFile because in Windows, the temporary file created as requirements_file (see else clause below) isn't accessible
       if (self._is_windows()):
-        self.venv_env_vars = self._SetupVirtualenv(
-            self._venv_dir, self._OrigRequirementsFile)
+        return self._SetupVirtualenv(venv_dir, self._OrigRequirementsFile)
       else:
         # Copy requirements.txt into a temporary file. It will be destroyed once
         # the life of self._requirements_file ends. It is created in a directory
@@ -233,12 +1180,328 @@ class PythonRuntimeInstanceFactory(instance.InstanceFactory,
 
           # Similar to production, append gunicorn to requirements.txt
           # as default entrypoint needs it.
-          requirements_file.write(six.b('\ngunicorn'))
+          for requirement in self._GetExtraRequirements():
+            requirements_file.write(six.b('\n' + requirement))
 
           # flushing it because _SetupVirtualenv uses it in a separate process.
           requirements_file.flush()
-          self.venv_env_vars = self._SetupVirtualenv(
-              self._venv_dir, requirements_file.name)
+          return self._SetupVirtualenv(venv_dir, requirements_file.name)
+
+  def _GetExtraRequirements(self):
+    """Returns the packages installed in addition to requirements.txt."""
+    # Changes by NoCommandLine - waitress is always installed on Windows, see
+    # _RunPipInstall.
+    if self._is_windows():
+      if self._asgi and not self._entrypoint:
+        return ['waitress', 'uvicorn']
+      return ['waitress']
+    if self._entrypoint:
+      return []
+    return ['gunicorn', 'uvicorn'] if self._asgi else ['gunicorn']
+
+  def _IsAsgiApp(self):
+    # Changes by NoCommandLine - only the default entrypoint depends on it.
+    if self._entrypoint:
+      return False
+    return _is_asgi_app(
+        os.path.join(self._module_configuration.application_root, 'main.py'))
+
+  def _GetRequirementsSnapshot(self):
+    """Returns the requirement lines the virtualenv is installed from."""
+    return (_read_normalized_requirements(self._OrigRequirementsFile) +
+            self._GetExtraRequirements())
+
+  def _GetInstalledDistributions(self, venv_dir):
+    """Returns a dict of normalized project name to installed version."""
+    try:
+      output = subprocess.check_output([
+          self._GetVenvPythonPath(venv_dir), '-c',
+          _LIST_INSTALLED_DISTRIBUTIONS_SCRIPT])
+    except (OSError, subprocess.CalledProcessError):
+      return None
+    return {
+        _normalize_project_name(name): version
+        for name, version in json.loads(six.ensure_str(output)).items()
+    }
+
+  def _SyncVirtualenv(self):
+    """Applies a requirements.txt edit to the current virtualenv in place.
+
+    The old and new requirements are diffed against the installed
+    distributions; removed projects are uninstalled and new or changed ones
+    installed, everything else is left alone. A removed project may still be
+    needed by a remaining one, so after an uninstall "pip check" has to pass.
+
+    Returns:
+      True if the virtualenv was synced, False if it has to be recreated.
+    """
+    venv_dir = self._venv_dir
+    if not PythonRuntimeInstanceFactory._venv_sync_enabled or not venv_dir:
+      return False
+    # Cached virtualenvs are shared and must not change under their key.
+    if venv_dir in PythonRuntimeInstanceFactory._venv_cache_in_use:
+      if not PythonRuntimeInstanceFactory._logged_venv_sync_with_cache:
+        PythonRuntimeInstanceFactory._logged_venv_sync_with_cache = True
+        logging.info('Requirements are not synced in place with the virtualenv '
+                     'cache, a cached virtualenv is used or built instead.')
+      return False
+    snapshot_path = os.path.join(venv_dir, _REQUIREMENTS_SNAPSHOT_FILE_NAME)
+    try:
+      with open(snapshot_path, 'r') as f:
+        old_requirements = _parse_simple_requirements(json.load(f))
+    except (IOError, OSError, ValueError):
+      return False
+    requirements_snapshot = self._GetRequirementsSnapshot()
+    new_requirements = _parse_simple_requirements(requirements_snapshot)
+    installed = self._GetInstalledDistributions(venv_dir)
+    if old_requirements is None or new_requirements is None or installed is None:
+      logging.info('Cannot sync requirements in place, recreating virtualenv.')
+      return False
+
+    to_uninstall = sorted(
+        name for name in old_requirements
+        if name not in new_requirements and name in installed)
+    to_install = []
+    for name, line in sorted(new_requirements.items()):
+      if name in installed and old_requirements.get(name) == line:
+        continue
+      pin = _SIMPLE_REQUIREMENT_RE.match(line).group(3) or ''
+      if name in installed and pin.replace(' ', '') == '==' + installed[name]:
+        continue
+      to_install.append(line)
+    if not to_uninstall and not to_install:
+      logging.info('Installed dependency libraries are up to date.')
+    else:
+      # Without the snapshot an interrupted sync leads to a full rebuild.
+      os.remove(snapshot_path)
+      pip_cmd = self._GetPipCommand(venv_dir)
+      pip_out = tempfile.NamedTemporaryFile(delete=False)
+      try:
+        with pip_out, open(pip_out.name, 'r') as pip_out_r:
+          pip_env = self._GetPipEnv(venv_dir)
+          sync_cmds = []
+          if to_uninstall:
+            sync_cmds.append(pip_cmd + ['uninstall', '-y'] + to_uninstall)
+          if to_install:
+            index_args = self._GetPipIndexArgs(
+                venv_dir, to_install, pip_env, pip_out, pip_out_r)
+            sync_cmds.append(pip_cmd + ['install'] + index_args + to_install)
+          if to_uninstall:
+            sync_cmds.append(pip_cmd + ['check'])
+          for sync_cmd in sync_cmds:
+            if self._RunPipCommand(sync_cmd, pip_env, pip_out, pip_out_r) != 0:
+              logging.warning('Failed to run "%s", recreating virtualenv.',
+                              ' '.join(sync_cmd))
+              return False
+      finally:
+        os.remove(pip_out.name)
+
+    with open(snapshot_path, 'w') as f:
+      json.dump(requirements_snapshot, f)
+    return True
+
+  def _GetVenvCacheKey(self):
+    """Returns the digest identifying this module's cached virtualenv."""
+    build_env_variables = self._module_configuration.build_env_variables or {}
+    key_data = {
+        'requirements': sorted(
+            _read_normalized_requirements(self._OrigRequirementsFile)),
+        'extra_requirements': sorted(self._GetExtraRequirements()),
+        'build_env_variables': sorted(
+            '%s=%s' % item for item in build_env_variables.items()),
+        'python': self._GetPythonInterpreterPath(),
+        'python_version': self._python_version,
+        'platform': sys.platform,
+    }
+    return hashlib.sha256(
+        six.ensure_binary(json.dumps(key_data, sort_keys=True))).hexdigest()
+
+  def _GetCachedVirtualenv(self):
+    """Returns the cached virtualenv directory, building it on a miss."""
+    key = self._GetVenvCacheKey()
+    # Modules with the same dependencies share an entry; build it only once.
+    build_locks = PythonRuntimeInstanceFactory._venv_cache_build_locks
+    with PythonRuntimeInstanceFactory._venv_cache_lock:
+      build_lock = build_locks.setdefault(key, threading.Lock())
+    with build_lock:
+      return self._GetOrBuildCachedVirtualenv(key)
+
+  def _GetOrBuildCachedVirtualenv(self, key):
+    cache_dir = PythonRuntimeInstanceFactory._venv_cache_dir
+    venv_dir = os.path.join(cache_dir, key[:32])
+    metadata_path = os.path.join(venv_dir, _VENV_CACHE_METADATA_FILE_NAME)
+    if not os.path.exists(cache_dir):
+      try:
+        os.makedirs(cache_dir)
+      except OSError as e:
+        if e.errno != errno.EEXIST:
+          raise
+    # Another dev_appserver sharing the cache may be building the entry. The
+    # process that creates the directory builds it; the others wait for its
+    # metadata.
+    hit = True
+    while not os.path.exists(metadata_path):
+      try:
+        os.mkdir(venv_dir)
+      except OSError as e:
+        if e.errno != errno.EEXIST:
+          raise
+      else:
+        hit = False
+        break
+      if self._IsVenvCacheBuildInProgress(venv_dir, time.time()):
+        time.sleep(_VENV_CACHE_BUILD_POLL_SECONDS)
+      else:
+        # An interrupted build; start over.
+        self._RemoveAbandonedVenvCacheEntry(venv_dir)
+    self._AcquireCachedVirtualenv(venv_dir)
+
+    http_runtime.startup_timeline.event(
+        'venv_cache', 'module', module=self._module_configuration.module_name,
+        key=key[:32], hit=hit)
+    if hit:
+      logging.info('Reusing cached virtualenv %s for module "%s".', venv_dir,
+                   self._module_configuration.module_name)
+      os.utime(metadata_path, None)
+      return venv_dir
+
+    logging.info('No cached virtualenv for module "%s", creating %s.',
+                 self._module_configuration.module_name, venv_dir)
+    try:
+      self._InstallVirtualenv(venv_dir)
+    except BaseException:
+      self._ReleaseCachedVirtualenv(venv_dir)
+      shutil.rmtree(venv_dir, ignore_errors=True)
+      raise
+
+    with open(metadata_path, 'w') as f:
+      json.dump({
+          'key': key,
+          'module': self._module_configuration.module_name,
+          'python': self._GetPythonInterpreterPath(),
+          'python_version': self._python_version,
+          'created': time.time(),
+          'size_bytes': _get_dir_size(venv_dir),
+      }, f)
+    self._EvictVenvCache()
+    return venv_dir
+
+  @classmethod
+  def _AcquireCachedVirtualenv(cls, venv_dir):
+    """Marks a cache entry as used by this process, see _venv_cache_in_use."""
+    PythonRuntimeInstanceFactory._venv_cache_in_use.append(venv_dir)
+    cls._TouchVenvCacheLease(venv_dir)
+    with PythonRuntimeInstanceFactory._venv_cache_lock:
+      if PythonRuntimeInstanceFactory._venv_cache_lease_thread is None:
+        thread = threading.Thread(target=cls._RefreshVenvCacheLeases,
+                                  name='VenvCacheLeases')
+        thread.daemon = True
+        thread.start()
+        PythonRuntimeInstanceFactory._venv_cache_lease_thread = thread
+
+  @classmethod
+  def _TouchVenvCacheLease(cls, venv_dir):
+    lease_path = os.path.join(venv_dir, _VENV_CACHE_LEASE_FILE_NAME)
+    try:
+      with open(lease_path, 'a'):
+        pass
+      os.utime(lease_path, None)
+    except (IOError, OSError):
+      pass  # The entry isn't built yet, or was removed.
+
+  @classmethod
+  def _RefreshVenvCacheLeases(cls):
+    while True:
+      time.sleep(_VENV_CACHE_LEASE_REFRESH_SECONDS)
+      for venv_dir in set(PythonRuntimeInstanceFactory._venv_cache_in_use):
+        cls._TouchVenvCacheLease(venv_dir)
+
+  @classmethod
+  def _IsVenvCacheLeased(cls, venv_dir, now):
+    """Returns whether a process may be using the cache entry."""
+    try:
+      lease_time = os.path.getmtime(
+          os.path.join(venv_dir, _VENV_CACHE_LEASE_FILE_NAME))
+    except OSError:
+      return False
+    return now - lease_time < _VENV_CACHE_LEASE_SECONDS
+
+  @classmethod
+  def _IsVenvCacheBuildInProgress(cls, venv_dir, now):
+    """Returns whether a process may still be building the cache entry."""
+    if cls._IsVenvCacheLeased(venv_dir, now):
+      return True
+    # The builder may not have written its lease yet.
+    try:
+      return now - os.path.getmtime(venv_dir) < _VENV_CACHE_LEASE_SECONDS
+    except OSError:
+      return False
+
+  @classmethod
+  def _RemoveAbandonedVenvCacheEntry(cls, venv_dir):
+    """Removes an interrupted build, unless another process already did."""
+    # Renaming first lets only one of the processes waiting for the entry
+    # remove it; the directory it leaves is free for the next build.
+    abandoned_dir = '%s.abandoned-%d' % (venv_dir, os.getpid())
+    try:
+      os.rename(venv_dir, abandoned_dir)
+    except OSError:
+      return
+    shutil.rmtree(abandoned_dir, ignore_errors=True)
+
+  @classmethod
+  def _ReleaseCachedVirtualenv(cls, venv_dir):
+    if venv_dir in PythonRuntimeInstanceFactory._venv_cache_in_use:
+      PythonRuntimeInstanceFactory._venv_cache_in_use.remove(venv_dir)
+
+  @classmethod
+  def _EvictVenvCache(cls):
+    """Removes old cached virtualenvs until the cache is within its limits."""
+    cache_dir = PythonRuntimeInstanceFactory._venv_cache_dir
+    now = time.time()
+    entries = []
+    in_use = set(PythonRuntimeInstanceFactory._venv_cache_in_use)
+    for name in os.listdir(cache_dir):
+      venv_dir = os.path.join(cache_dir, name)
+      if not os.path.isdir(venv_dir) or venv_dir in in_use:
+        continue
+      # Used, or being built, by another process sharing the cache.
+      if cls._IsVenvCacheLeased(venv_dir, now):
+        in_use.add(venv_dir)
+        continue
+      metadata_path = os.path.join(venv_dir, _VENV_CACHE_METADATA_FILE_NAME)
+      try:
+        with open(metadata_path, 'r') as f:
+          size = json.load(f).get('size_bytes', 0)
+        last_used = os.path.getmtime(metadata_path)
+      except (IOError, OSError, ValueError):
+        if now - os.path.getmtime(venv_dir) > _VENV_CACHE_ABANDONED_BUILD_SECONDS:
+          shutil.rmtree(venv_dir, ignore_errors=True)
+        continue
+      entries.append((last_used, size, venv_dir))
+
+    # Sizes of the entries in use count against the limit too.
+    total_size = sum(size for _, size, _ in entries)
+    for venv_dir in in_use:
+      try:
+        with open(os.path.join(
+            venv_dir, _VENV_CACHE_METADATA_FILE_NAME), 'r') as f:
+          total_size += json.load(f).get('size_bytes', 0)
+      except (IOError, OSError, ValueError):
+        pass
+    num_entries = len(entries) + len(in_use)
+
+    max_age = PythonRuntimeInstanceFactory._venv_cache_max_age_days * 86400
+    max_size = PythonRuntimeInstanceFactory._venv_cache_max_size_mb * 1024 * 1024
+    for last_used, size, venv_dir in sorted(entries):
+      if (now - last_used <= max_age and
+          num_entries <= PythonRuntimeInstanceFactory._venv_cache_max_entries and
+          total_size <= max_size):
+        break
+      logging.info('Evicting cached virtualenv %s.', venv_dir)
+      shutil.rmtree(venv_dir, ignore_errors=True)
+      total_size -= size
+      num_entries -= 1
 
   def configuration_changed(self, config_changes):
     """Called when the configuration of the module has changed.
@@ -247,8 +1510,24 @@ class PythonRuntimeInstanceFactory(instance.InstanceFactory,
       config_changes: A set containing the changes that occoured. See the
           *_CHANGED constants in the application_configuration module.
     """
+    # Changes by NoCommandLine - pooled instances run the old configuration.
+    if config_changes:
+      self._DrainInstancePool()
+      self._asgi = self._IsAsgiApp()
+      self.max_concurrent_requests = self._GetMaxConcurrentRequests()
     if config_changes & _RECREATE_MODERN_INSTANCE_FACTORY_CONFIG_CHANGES:
+      self._WaitForVirtualenv()
+      self._StopZygote()
       self._SetupVirtualenvFromConfiguration()
+      self._StartZygote()
+    if config_changes:
+      self._ScheduleInstancePoolFill()
+
+  def files_changed(self):
+    """Called when a file relevant to the factory *might* have changed."""
+    # Changes by NoCommandLine - pooled instances run the old code.
+    self._DrainInstancePool()
+    self._ScheduleInstancePoolFill()
 
   def dependency_libraries_changed(self, file_changes):
     """Decide whether dependency libraries in requirements.txt changed.
@@ -271,20 +1550,105 @@ class PythonRuntimeInstanceFactory(instance.InstanceFactory,
         None,
     )
     if dep_libs_changed:
-      self._SetupVirtualenvFromConfiguration()
+      self._WaitForVirtualenv()
+      self._DrainInstancePool()
+      # Changes by NoCommandLine - e.g. the app moved to FastAPI.
+      asgi, self._asgi = self._asgi, self._IsAsgiApp()
+      if asgi != self._asgi:
+        self.max_concurrent_requests = self._GetMaxConcurrentRequests()
+      # The zygote imported the old packages.
+      self._StopZygote()
+      with http_runtime.startup_timeline.phase(
+          'sync_virtualenv', 'module',
+          module=self._module_configuration.module_name) as trace_args:
+        trace_args['synced'] = self._SyncVirtualenv()
+      if not trace_args['synced']:
+        self._SetupVirtualenvFromConfiguration()
+      self._StartZygote()
+      self._ScheduleInstancePoolFill()
     return dep_libs_changed is not None
 
+  def _GetMaxConcurrentRequests(self):
+    """Returns how many requests an instance of the module takes at once.
+
+    That is max_concurrent_requests of app.yaml if set, or what the server of
+    the entrypoint handles at once.
+    """
+    runtime_config = self._runtime_config_getter()
+    if not runtime_config.threadsafe:
+      return 1
+    scaling = self._module_configuration.automatic_scaling_config
+    if scaling is not None and scaling.max_concurrent_requests:
+      return int(scaling.max_concurrent_requests)
+    env = dict(os.environ)
+    env.update((kv.key, kv.value) for kv in runtime_config.environ)
+    concurrency = _get_server_concurrency(' '.join(self._GetRuntimeArgs()),
+                                          env)
+    if concurrency is None:
+      return _DEFAULT_MAX_CONCURRENT_REQUESTS
+    logging.info('Instances of module "%s" take %d concurrent requests (%s).',
+                 self._module_configuration.module_name, concurrency[0],
+                 concurrency[1])
+    return max(1, concurrency[0])
+
   def _GetRuntimeArgs(self):
     # Changes by NoCommandLine to support Windows platform
-    if self._is_windows():
-      return (self._entrypoint or 'waitress-serve --listen=*:${PORT} main:app').split()
+    entrypoint = self._entrypoint or self._GetDefaultEntrypoint()
+    # Changes by NoCommandLine - split the entrypoint like a shell would,
+    # unless it is run by one, which gets it as it is.
+    if http_runtime.needs_shell(entrypoint):
+      return [entrypoint]
+    args = shlex.split(entrypoint, posix=not self._is_windows())
+    # exec is a shell builtin; the server is started without a shell anyway.
+    if len(args) > 1 and args[0] == 'exec':
+      args = args[1:]
+    return args
 
-    return (self._entrypoint or _MODERN_DEFAULT_ENTRYPOINT).split()
+  def _GetDefaultEntrypoint(self):
+    """Returns the entrypoint of a module without one in app.yaml.
+
+    Like App Engine, gunicorn gets as many workers as the instance class has
+    (2 for F1 and B1, 4 for F2 and B2, 8 for the larger ones), but no more
+    than this computer has CPUs, each with 4 threads. On Windows, waitress
+    gets all the threads. ASGI apps get uvicorn workers instead, or uvicorn
+    itself on Windows.
+    """
+    basic_or_manual = (self._module_configuration.basic_scaling_config or
+                       self._module_configuration.manual_scaling_config)
+    instance_class = (self._module_configuration.instance_class or
+                      ('B2' if basic_or_manual else 'F1')).upper()
+    cpus = os.cpu_count() or 1
+    workers = max(1, min(_INSTANCE_CLASS_WORKERS.get(instance_class, 2), cpus))
+    threads = _DEFAULT_ENTRYPOINT_THREADS_PER_WORKER
+    if self._is_windows() and not self._asgi:
+      workers, threads = 1, workers * threads
+    settings = {
+        'workers': workers,
+        'threads': threads,
+        'timeout': (_BASIC_SCALING_TIMEOUT_SECONDS if basic_or_manual
+                    else _AUTOMATIC_SCALING_TIMEOUT_SECONDS),
+        'graceful_timeout': _DEFAULT_ENTRYPOINT_GRACEFUL_TIMEOUT_SECONDS,
+    }
+    if self._asgi:
+      entrypoint = (_WINDOWS_ASGI_DEFAULT_ENTRYPOINT if self._is_windows()
+                    else _ASGI_DEFAULT_ENTRYPOINT) % settings
+    else:
+      entrypoint = (_WINDOWS_DEFAULT_ENTRYPOINT if self._is_windows()
+                    else _MODERN_DEFAULT_ENTRYPOINT) % settings
+    if entrypoint != self._logged_default_entrypoint:
+      self._logged_default_entrypoint = entrypoint
+      logging.info('Module "%s" has no entrypoint, using "%s" for %s app of '
+                   'instance class %s on %d CPUs.',
+                   self._module_configuration.module_name, entrypoint,
+                   'an ASGI' if self._asgi else 'a WSGI', instance_class, cpus)
+    return entrypoint
 
   @classmethod
-  def _WaitForProcWithLastLineStreamed(cls, proc, proc_stdout):
+  def _WaitForProcWithLastLineStreamed(cls, proc, proc_stdout, prefix=None):
     # Stream the last line of a process output, so that users can see
     # progress instead of doubting dev_appserver hangs.
+    if prefix is not None:
+      return cls._WaitForProcWithPrefixedLines(proc, proc_stdout, prefix)
     while proc.poll() is None:  # in progress
       lastline = proc_stdout.readline().strip()
       if lastline:
@@ -297,10 +1661,97 @@ class PythonRuntimeInstanceFactory(instance.InstanceFactory,
     sys.stdout.write('\n')
     return proc.poll()
 
+  @classmethod
+  def _WaitForProcWithPrefixedLines(cls, proc, proc_stdout, prefix):
+    # Changes by NoCommandLine - used when several modules run pip at the same
+    # time. Erasing lines with backspaces would mix up their output, so print
+    # the latest line of each module in full with the module name in front.
+    while True:
+      returncode = proc.poll()
+      lines = [line.strip() for line in proc_stdout.readlines()]
+      lines = [line for line in lines if line]
+      if lines:
+        with PythonRuntimeInstanceFactory._progress_lock:
+          sys.stdout.write('[%s] %s\n' % (prefix, lines[-1]))
+          sys.stdout.flush()
+      if returncode is not None:
+        return returncode
+      time.sleep(0.2)
+
   def _is_windows(self):
     return hasattr(sys, 'getwindowsversion')
 
-  def _RunPipInstall(self, venv_dir, requirements_file_name):
+  def _GetVenvBinDir(self, venv_dir):
+    # On Windows, the virtual env directory is Scripts.
+    return os.path.join(venv_dir, 'Scripts' if self._is_windows() else 'bin')
+
+  def _GetVenvPythonPath(self, venv_dir):
+    return os.path.join(self._GetVenvBinDir(venv_dir),
+                        'python.exe' if self._is_windows() else 'python')
+
+  def _GetPipCommand(self, venv_dir):
+    # Changes by NoCommandLine - run pip as a module of the virtualenv's python.
+    # Unlike the pip script (pip.exe on Windows), this doesn't depend on the
+    # path the virtualenv was created at, see _CloneVirtualenvTemplate.
+    return [self._GetVenvPythonPath(venv_dir), '-m', 'pip']
+
+  def _GetPipEnv(self, venv_dir):
+    """Returns the environment variables pip runs with inside venv_dir."""
+    venv_bin = self._GetVenvBinDir(venv_dir)
+    pip_env = os.environ.copy()
+    pip_env.update({
+        'VIRTUAL_ENV': venv_dir,
+        'PATH': os.pathsep.join([venv_bin, os.environ['PATH']]),
+    })
+    # Changes by NoCommandLine. See NOTE_PIP_USER below
+    """
+      NOTE_PIP_USER 
+      Running pip install on Windows gives the error: [WinError 5] Access is denied:   Consider using the `--user` option or check the permissions.
+    
+      If you then use the --user option, you get another error: Can not perform a '--user' install. User site-packages are not visible in this virtualenv.
+      The solution to this second problem is to set include-system-site-packages to true when creating the virtual env
+    
+      Setting the environment var 'PIP_USER = False' solves the above two problems (source - https://github.com/gitpod-io/gitpod/issues/1997#issuecomment-708480259)
+      Note that we used 'false' which is a string instead of False the boolean value because all environment variables and values have to be string
+    """
+    if(self._is_windows()):
+      pip_env['PIP_USER'] = 'false'
+
+    if self._module_configuration.build_env_variables:
+      pip_env.update(self._module_configuration.build_env_variables)
+    return pip_env
+
+  def _RunPipCommand(self, pip_cmd, pip_env, pip_out, pip_out_r):
+    """Runs a single pip command and returns its exit code."""
+    logging.info('Running %s', ' '.join(pip_cmd))
+    module_name = self._module_configuration.module_name
+    command = ' '.join(pip_cmd[3:])
+    # Changes by NoCommandLine - let pip log with timestamps, to time each
+    # package for the startup timeline.
+    pip_log = None
+    if (http_runtime.startup_timeline.enabled and
+        pip_cmd[3:4] in (['install'], ['wheel'])):
+      pip_log = tempfile.NamedTemporaryFile(suffix='.log', delete=False)
+      pip_log.close()
+      pip_cmd = pip_cmd + ['--log', pip_log.name]
+    with http_runtime.startup_timeline.phase(
+        'pip', 'module', module=module_name, command=command) as trace_args:
+      pip_proc = subprocess.Popen(pip_cmd, stdout=pip_out, env=pip_env)
+      prefix = None
+      if PythonRuntimeInstanceFactory._venv_workers > 1:
+        prefix = module_name
+      returncode = (
+          PythonRuntimeInstanceFactory._WaitForProcWithLastLineStreamed(
+              pip_proc, pip_out_r, prefix))
+      trace_args['returncode'] = returncode
+    if pip_log is not None:
+      try:
+        _record_pip_log_phases(pip_log.name, module_name)
+      finally:
+        os.remove(pip_log.name)
+    return returncode
+
+  def _RunPipInstall(self, venv_dir, requirements_file_name, upgrade_pip=True):
     """Run pip install inside a virtualenv, with decent stdout."""
     # Run pip install based on user supplied requirements.txt.
     pip_out = tempfile.NamedTemporaryFile(delete=False)
@@ -309,54 +1760,431 @@ class PythonRuntimeInstanceFactory(instance.InstanceFactory,
         'to %s', pip_out.name)
 
     with open(pip_out.name, 'r') as pip_out_r:
-      venv_bin = os.path.join(venv_dir, 'bin')
-      if self._is_windows():
-        # On Windows, the virtual env directory is Scripts.
-        venv_bin = os.path.join(venv_dir, 'Scripts')
-      pip_path = os.path.join(venv_bin, 'pip')
+      pip_cmd = self._GetPipCommand(venv_dir)
+      pip_env = self._GetPipEnv(venv_dir)
 
-      pip_env = os.environ.copy()
-      pip_env.update({
-          'VIRTUAL_ENV': venv_dir,
-          'PATH': os.pathsep.join([venv_bin, os.environ['PATH']]),
-      })
-      # Changes by NoCommandLine. See NOTE_PIP_USER below
-      """
-        NOTE_PIP_USER 
-        Running pip install on Windows gives the error: [WinError 5] Access is denied:   Consider using the `--user` option or check the permissions.
-      
-        If you then use the --user option, you get another error: Can not perform a '--user' install. User site-packages are not visible in this virtualenv.
-        The solution to this second problem is to set include-system-site-packages to true when creating the virtual env
-      
-        Setting the environment var 'PIP_USER = False' solves the above two problems (source - https://github.com/gitpod-io/gitpod/issues/1997#issuecomment-708480259)
-        Note that we used 'false' which is a string instead of False the boolean value because all environment variables and values have to be string
-      """
-      if(self._is_windows()):
-        pip_env['PIP_USER'] = 'false'
-
-      if self._module_configuration.build_env_variables:
-        pip_env.update(self._module_configuration.build_env_variables)
-
-      pip_upgrade = (
-          ['python', '-m', 'pip', 'install', '--upgrade', 'pip']
-          if self._is_windows()
-          else [pip_path, 'install', '--upgrade', 'pip']
-      )
       # Changes by NoCommandLine.
+      requirement_args = ['-r', requirements_file_name]
+      if self._is_windows():
+        requirement_args.extend(self._GetExtraRequirements())
+      index_args = self._GetPipIndexArgs(
+          venv_dir, requirement_args, pip_env, pip_out, pip_out_r)
+
+      pip_upgrade = pip_cmd + ['install', '--upgrade', 'pip']
+      # Changes by NoCommandLine - upgrading pip needs the package index, and
+      # virtualenvs cloned from the template come with an up to date pip.
+      if upgrade_pip and index_args:
+        logging.info('Installing without the package index, not upgrading pip.')
+      elif (upgrade_pip and
+            self._RunPipCommand(pip_upgrade, pip_env, pip_out, pip_out_r) != 0):
+        sys.exit('Failed to run "{}"'.format(' '.join(pip_upgrade)))
+
+      # Changes by NoCommandLine - link the packages from the shared package
+      # store instead of unpacking them again into every virtualenv.
+      if (PythonRuntimeInstanceFactory._package_store_dir and
+          self._InstallFromPackageStore(
+              venv_dir, requirement_args + index_args, pip_env, pip_out,
+              pip_out_r)):
+        return
+
       pip_cmds = [
-                pip_upgrade,
-                [pip_path, 'install', '-r', requirements_file_name],
-                ]
+          pip_cmd + ['install'] + index_args + ['-r', requirements_file_name]]
       if self._is_windows():
-          pip_cmds.append([pip_path, 'install',  'waitress'])
+          pip_cmds.append(
+              pip_cmd + ['install'] + index_args + self._GetExtraRequirements())
           
       for pip_cmd in pip_cmds: # End of Changes by NoCommandLine
-        cmd_str = ' '.join(pip_cmd)
-        logging.info('Running %s', cmd_str)
-        pip_proc = subprocess.Popen(pip_cmd, stdout=pip_out, env=pip_env)
-        if PythonRuntimeInstanceFactory._WaitForProcWithLastLineStreamed(
-            pip_proc, pip_out_r) != 0:
-          sys.exit('Failed to run "{}"'.format(cmd_str))
+        if self._RunPipCommand(pip_cmd, pip_env, pip_out, pip_out_r) != 0:
+          sys.exit('Failed to run "{}"'.format(' '.join(pip_cmd)))
+
+  @classmethod
+  def _IsPackageIndexReachable(cls, pip_env):
+    """Checks quickly whether pip can connect to its package index.
+
+    The result is remembered for a while, so modules set up together only
+    probe once.
+
+    Args:
+      pip_env: The environment pip runs with.
+
+    Returns:
+      False if a connection to the index (or the proxy in front of it) can't
+      be opened within a short timeout.
+    """
+    now = time.time()
+    if (PythonRuntimeInstanceFactory._index_reachable is not None and
+        now - PythonRuntimeInstanceFactory._index_probe_time <
+        _INDEX_PROBE_INTERVAL_SECONDS):
+      return PythonRuntimeInstanceFactory._index_reachable
+    index_url = pip_env.get('PIP_INDEX_URL') or _DEFAULT_INDEX_URL
+    proxy_url = pip_env.get('HTTPS_PROXY') or pip_env.get('https_proxy')
+    url = six.moves.urllib.parse.urlparse(
+        proxy_url if proxy_url and index_url.startswith('https') else index_url)
+    if url.scheme == 'file':
+      reachable = True
+    else:
+      try:
+        socket.create_connection(
+            (url.hostname, url.port or (443 if url.scheme == 'https' else 80)),
+            _INDEX_PROBE_TIMEOUT_SECONDS).close()
+        reachable = True
+      except (socket.error, ValueError):
+        reachable = False
+      if not reachable:
+        logging.warning('The package index %s is not reachable, installing '
+                        'without network access.', url.netloc)
+    PythonRuntimeInstanceFactory._index_reachable = reachable
+    PythonRuntimeInstanceFactory._index_probe_time = now
+    return reachable
+
+  def _GetPipIndexArgs(self, venv_dir, requirement_args, pip_env, pip_out,
+                       pip_out_r):
+    """Returns the pip install options selecting where packages come from.
+
+    Without a wheelhouse this is empty, pip finds its index as configured,
+    unless offline mode was turned on explicitly. With a wheelhouse, wheels
+    for the requirements are built into it once while the index is
+    reachable, and installs then only use the wheelhouse.
+
+    Args:
+      venv_dir: The virtualenv pip runs in.
+      requirement_args: The pip install arguments naming the requirements.
+      pip_env: The environment pip runs with.
+      pip_out: The file pip output is redirected to.
+      pip_out_r: A reader of pip_out.
+
+    Returns:
+      A list of pip install options.
+    """
+    wheelhouse_dir = PythonRuntimeInstanceFactory._wheelhouse_dir
+    # The index may come from pip.conf, requirements.txt or another proxy
+    # variable, which the probe doesn't know about; only probe with a
+    # wheelhouse to fall back to.
+    if not wheelhouse_dir:
+      return ['--no-index'] if PythonRuntimeInstanceFactory._offline else []
+
+    wheelhouse_args = ['--no-index', '--find-links', wheelhouse_dir]
+    stamp_path = self._GetWheelhouseStampPath(requirement_args)
+    if os.path.exists(stamp_path):
+      return wheelhouse_args
+    # Only probe when wheels have to be collected.
+    if (PythonRuntimeInstanceFactory._offline or
+        not self._IsPackageIndexReachable(pip_env)):
+      logging.warning('Wheels for the requirements were never collected into '
+                      '%s, pip may not find all of them.', wheelhouse_dir)
+      return wheelhouse_args
+
+    pip_cmd = self._GetPipCommand(venv_dir)
+    wheel_cmd = pip_cmd + ['wheel', '--wheel-dir', wheelhouse_dir,
+                           '--find-links', wheelhouse_dir] + requirement_args
+    if self._RunPipCommand(wheel_cmd, pip_env, pip_out, pip_out_r) != 0:
+      logging.warning('Failed to run "%s", installing from the package index.',
+                      ' '.join(wheel_cmd))
+      return []
+    with open(stamp_path, 'w') as f:
+      json.dump(requirement_args, f)
+    return wheelhouse_args
+
+  def _GetWheelhouseStampPath(self, requirement_args):
+    """Returns the file marking that the wheelhouse has these requirements."""
+    requirements = []
+    args = iter(requirement_args)
+    for arg in args:
+      if arg == '-r':
+        requirements.extend(_read_normalized_requirements(next(args)))
+      else:
+        requirements.append(arg)
+    key_data = {
+        'requirements': sorted(requirements),
+        'python_version': self._python_version,
+        'platform': sys.platform,
+    }
+    digest = hashlib.sha256(
+        six.ensure_binary(json.dumps(key_data, sort_keys=True))).hexdigest()
+    return os.path.join(PythonRuntimeInstanceFactory._wheelhouse_dir,
+                        '.devappserver-%s.json' % digest[:32])
+
+  def _GetPackageStoreEntry(self, item):
+    """Returns the store directory for a distribution in a pip report.
+
+    Args:
+      item: An entry of the "install" list of a pip installation report.
+
+    Returns:
+      The directory holding the unpacked distribution, or None if it comes
+      from a local directory or VCS checkout and can't be shared.
+    """
+    archive_url = item['download_info']['url']
+    if 'archive_info' not in item['download_info']:
+      return None
+    file_name = archive_url.rsplit('/', 1)[-1].split('#', 1)[0]
+    if file_name.endswith('.whl'):
+      # name-version(-build)?-python-abi-platform.whl
+      tag = '-'.join(file_name[:-len('.whl')].split('-')[-3:])
+    else:
+      # Built from an sdist, so the result depends on the interpreter.
+      tag = 'src-' + hashlib.sha256(six.ensure_binary(
+          '%s|%s|%s' % (archive_url, self._python_version, sys.platform)
+      )).hexdigest()[:16]
+    return os.path.join(
+        PythonRuntimeInstanceFactory._package_store_dir,
+        _normalize_project_name(item['metadata']['name']),
+        item['metadata']['version'], tag)
+
+  def _InstallFromPackageStore(self, venv_dir, requirement_args, pip_env,
+                               pip_out, pip_out_r):
+    """Installs the requirements by linking them from the package store.
+
+    pip resolves the requirements without installing anything. Distributions
+    missing from the store are unpacked into it once, then every distribution
+    is hardlinked (or copied where hardlinks aren't possible) into the
+    virtualenv's site-packages and its scripts are generated.
+
+    Args:
+      venv_dir: The virtualenv to install into.
+      requirement_args: The pip install arguments naming the requirements.
+      pip_env: The environment pip runs with.
+      pip_out: The file pip output is redirected to.
+      pip_out_r: A reader of pip_out.
+
+    Returns:
+      True on success, False if pip has to install the requirements instead.
+    """
+    pip_cmd = self._GetPipCommand(venv_dir)
+    report_file = tempfile.NamedTemporaryFile(suffix='.json', delete=False)
+    report_file.close()
+    try:
+      resolve_cmd = pip_cmd + [
+          'install', '--dry-run', '--ignore-installed', '--report',
+          report_file.name] + requirement_args
+      if self._RunPipCommand(resolve_cmd, pip_env, pip_out, pip_out_r) != 0:
+        logging.warning('Could not resolve requirements for the package store.')
+        return False
+      with open(report_file.name, 'r') as f:
+        report = json.load(f)
+    finally:
+      os.remove(report_file.name)
+
+    entries = []
+    for item in report.get('install', []):
+      entry = self._GetPackageStoreEntry(item)
+      if entry is None:
+        logging.info('"%s" cannot be shared through the package store.',
+                     item['metadata']['name'])
+        return False
+      entries.append((item, entry))
+
+    installed = self._GetInstalledDistributions(venv_dir) or {}
+    site_packages = six.ensure_str(subprocess.check_output([
+        self._GetVenvPythonPath(venv_dir), '-c',
+        'import sysconfig; print(sysconfig.get_paths()["purelib"])'])).strip()
+    added = 0
+    entry_points = []
+    for item, entry in entries:
+      name = _normalize_project_name(item['metadata']['name'])
+      version = item['metadata']['version']
+      if installed.get(name) == version:
+        continue
+      if name in installed:
+        uninstall_cmd = pip_cmd + ['uninstall', '-y', name]
+        if self._RunPipCommand(
+            uninstall_cmd, pip_env, pip_out, pip_out_r) != 0:
+          return False
+      if not os.path.exists(entry):
+        add_cmd = self._AddToPackageStore(
+            item['download_info']['url'], entry, pip_cmd, pip_env, pip_out,
+            pip_out_r)
+        if add_cmd is not None:
+          logging.warning('Failed to run "%s"', ' '.join(add_cmd))
+          return False
+        added += 1
+      for root, _, files in os.walk(entry):
+        if 'entry_points.txt' in files and root.endswith('.dist-info'):
+          entry_points.append(os.path.join(root, 'entry_points.txt'))
+      with http_runtime.startup_timeline.phase(
+          'link_package', 'module',
+          module=self._module_configuration.module_name, package=name,
+          version=version):
+        _link_tree(entry, site_packages, skip=('bin', 'Scripts'))
+
+    if entry_points and subprocess.call(
+        [self._GetVenvPythonPath(venv_dir), '-c', _MAKE_SCRIPTS_SCRIPT,
+         self._GetVenvBinDir(venv_dir)] + entry_points, env=pip_env):
+      sys.exit('Failed to create scripts in {}'.format(venv_dir))
+    logging.info('Linked %d distributions from the package store %s (%d new).',
+                 len(entries), PythonRuntimeInstanceFactory._package_store_dir,
+                 added)
+    return True
+
+  def _AddToPackageStore(self, archive_url, entry, pip_cmd, pip_env, pip_out,
+                         pip_out_r):
+    """Unpacks a distribution into the package store.
+
+    Returns:
+      None on success, otherwise the pip command that failed.
+    """
+    parent_dir = os.path.dirname(entry)
+    if not os.path.exists(parent_dir):
+      os.makedirs(parent_dir)
+    # Unpack next to the entry and rename it into place once it is complete,
+    # so a concurrent or interrupted install never leaves a partial entry.
+    target_dir = tempfile.mkdtemp(dir=parent_dir, suffix='.tmp')
+    add_cmd = pip_cmd + ['install', '--no-deps', '--ignore-installed',
+                         '--target', target_dir, archive_url]
+    try:
+      if self._RunPipCommand(add_cmd, pip_env, pip_out, pip_out_r) != 0:
+        return add_cmd
+      try:
+        os.rename(target_dir, entry)
+      except OSError:
+        if not os.path.exists(entry):  # Not added by someone else meanwhile.
+          raise
+    finally:
+      shutil.rmtree(target_dir, ignore_errors=True)
+    return None
+
+  def _GetVirtualenvTemplate(self):
+    """Returns the template virtualenv of the python interpreter.
+
+    The template is built on first use: a plain `python -m venv` whose pip is
+    upgraded if the package index is reachable. It is built next to its final
+    location and renamed into place, so concurrent devappservers never see a
+    partial template.
+
+    Returns:
+      A (template directory, path it was built at) tuple, or None if the
+      template can't be built.
+    """
+    key_data = {
+        'python': self._GetPythonInterpreterPath(),
+        'python_version': self._python_version,
+        'platform': sys.platform,
+    }
+    template_dir = os.path.join(
+        PythonRuntimeInstanceFactory._venv_template_dir,
+        hashlib.sha256(six.ensure_binary(
+            json.dumps(key_data, sort_keys=True))).hexdigest()[:32])
+    metadata_path = os.path.join(
+        template_dir, _VENV_TEMPLATE_METADATA_FILE_NAME)
+    with PythonRuntimeInstanceFactory._venv_template_lock:
+      if not os.path.exists(metadata_path):
+        with http_runtime.startup_timeline.phase(
+            'build_virtualenv_template', 'module',
+            module=self._module_configuration.module_name):
+          self._BuildVirtualenvTemplate(template_dir, key_data)
+    try:
+      with open(metadata_path, 'r') as f:
+        return template_dir, json.load(f)['venv_dir']
+    except (IOError, OSError, ValueError, KeyError):
+      return None
+
+  def _BuildVirtualenvTemplate(self, template_dir, key_data):
+    parent_dir = os.path.dirname(template_dir)
+    if not os.path.exists(parent_dir):
+      os.makedirs(parent_dir)
+    build_dir = tempfile.mkdtemp(dir=parent_dir, suffix='.tmp')
+    logging.info('Creating template virtualenv %s for "%s".', template_dir,
+                 self._GetPythonInterpreterPath())
+    try:
+      args = [self._GetPythonInterpreterPath(), '-m', 'venv', build_dir]
+      if subprocess.call(args):
+        logging.warning('Failed creating template virtualenv with "%s".',
+                        ' '.join(args))
+        return
+      pip_env = self._GetPipEnv(build_dir)
+      if (not PythonRuntimeInstanceFactory._offline and
+          self._IsPackageIndexReachable(pip_env)):
+        pip_upgrade = self._GetPipCommand(build_dir) + [
+            'install', '--upgrade', 'pip']
+        pip_out = tempfile.NamedTemporaryFile(delete=False)
+        try:
+          with pip_out, open(pip_out.name, 'r') as pip_out_r:
+            if self._RunPipCommand(pip_upgrade, pip_env, pip_out, pip_out_r):
+              logging.warning('Failed to run "%s"', ' '.join(pip_upgrade))
+        finally:
+          os.remove(pip_out.name)
+      metadata = dict(key_data, venv_dir=build_dir, created=time.time())
+      with open(os.path.join(
+          build_dir, _VENV_TEMPLATE_METADATA_FILE_NAME), 'w') as f:
+        json.dump(metadata, f)
+      try:
+        os.rename(build_dir, template_dir)
+      except OSError:
+        if not os.path.exists(template_dir):  # Not built by someone else.
+          raise
+    finally:
+      shutil.rmtree(build_dir, ignore_errors=True)
+
+  def _CloneVirtualenvTemplate(self, venv_dir):
+    """Creates the virtualenv in venv_dir as a clone of the template.
+
+    Files are hardlinked from the template, symlinks (e.g. bin/python) are
+    kept as they are. Text files that contain the path the template was
+    built at, like the activate scripts, are rewritten for venv_dir. Script
+    launchers with that path compiled in (pip.exe) are generated again.
+
+    Args:
+      venv_dir: The directory of the new virtualenv, must be empty.
+
+    Returns:
+      True if the virtualenv was cloned, False if it has to be created.
+    """
+    # A cache entry being built already holds the lease of its builder.
+    if (not PythonRuntimeInstanceFactory._venv_template_dir or
+        (os.path.exists(venv_dir) and
+         set(os.listdir(venv_dir)) - {_VENV_CACHE_LEASE_FILE_NAME})):
+      return False
+    template = self._GetVirtualenvTemplate()
+    if template is None:
+      return False
+    template_dir, built_at = template
+
+    def _link_or_copy(src, dst):
+      try:
+        os.link(src, dst)
+      except OSError:
+        shutil.copy2(src, dst)
+
+    shutil.copytree(
+        template_dir, venv_dir, symlinks=True, copy_function=_link_or_copy,
+        ignore=lambda d, names: (
+            [_VENV_TEMPLATE_METADATA_FILE_NAME] if d == template_dir else []),
+        dirs_exist_ok=True)
+
+    old_path = six.ensure_binary(built_at)
+    new_path = six.ensure_binary(venv_dir)
+    bin_dir = self._GetVenvBinDir(venv_dir)
+    regenerate_scripts = False
+    for path in [os.path.join(venv_dir, 'pyvenv.cfg')] + [
+        os.path.join(bin_dir, name) for name in os.listdir(bin_dir)]:
+      if os.path.islink(path) or not os.path.isfile(path):
+        continue
+      with open(path, 'rb') as f:
+        content = f.read()
+      if old_path not in content:
+        continue
+      # Hardlinked from the template, so never change the file in place.
+      mode = os.stat(path).st_mode
+      os.remove(path)
+      if b'\0' in content:
+        regenerate_scripts = True
+        continue
+      with open(path, 'wb') as f:
+        f.write(content.replace(old_path, new_path))
+      os.chmod(path, mode)
+
+    if regenerate_scripts:
+      entry_points = []
+      for root, _, files in os.walk(venv_dir):
+        if 'entry_points.txt' in files and root.endswith('.dist-info'):
+          entry_points.append(os.path.join(root, 'entry_points.txt'))
+      if subprocess.call(
+          [self._GetVenvPythonPath(venv_dir), '-c', _MAKE_SCRIPTS_SCRIPT,
+           bin_dir] + entry_points):
+        logging.warning('Failed to create scripts in %s', bin_dir)
+    logging.info('Cloned virtualenv %s from template %s.', venv_dir,
+                 template_dir)
+    return True
 
   def _SetupVirtualenv(self, venv_dir, requirements_file_name):
     """Create virtualenv for py3 instances and run pip install."""
@@ -383,23 +2211,34 @@ class PythonRuntimeInstanceFactory(instance.InstanceFactory,
         self._RunPipInstall(venv_dir, requirements_file_name)
         
     else: # end of changes by NoCommandLine
-      args = [self._GetPythonInterpreterPath(), '-m', 'venv', venv_dir]
-      call_res = subprocess.call(args)
-      if call_res:
-        # `python3 -m venv` Failed.
-        # Clean up venv_dir and try 'virtualenv' command instead.
-        self._CleanUpVenv(venv_dir)
-        fallback_args = ['virtualenv', venv_dir]
-        logging.warning(
-            'Failed creating virtualenv with "%s", \n'
-            'trying "%s"', ' '.join(args), ' '.join(fallback_args))
-        call_res = subprocess.call(fallback_args)
-        if call_res:
-          raise IOError('Cannot create virtualenv {}'.format(venv_dir))
-        logging.warning(
-            'Runtime python interpreter will be selected by virtualenv')
-      self._RunPipInstall(venv_dir, requirements_file_name)
+      # Changes by NoCommandLine - clone the template virtualenv if there is one.
+      with http_runtime.startup_timeline.phase(
+          'create_virtualenv', 'module',
+          module=self._module_configuration.module_name) as trace_args:
+        cloned = self._CloneVirtualenvTemplate(venv_dir)
+        trace_args['cloned'] = cloned
+        if not cloned:
+          args = [self._GetPythonInterpreterPath(), '-m', 'venv', venv_dir]
+          call_res = subprocess.call(args)
+          if call_res:
+            # `python3 -m venv` Failed.
+            # Clean up venv_dir and try 'virtualenv' command instead.
+            self._CleanUpVenv(venv_dir)
+            fallback_args = ['virtualenv', venv_dir]
+            logging.warning(
+                'Failed creating virtualenv with "%s", \n'
+                'trying "%s"', ' '.join(args), ' '.join(fallback_args))
+            call_res = subprocess.call(fallback_args)
+            if call_res:
+              raise IOError('Cannot create virtualenv {}'.format(venv_dir))
+            logging.warning(
+                'Runtime python interpreter will be selected by virtualenv')
+      self._RunPipInstall(
+          venv_dir, requirements_file_name, upgrade_pip=not cloned)
+
+    return self._GetVirtualenvEnvVars(venv_dir)
 
+  def _GetVirtualenvEnvVars(self, venv_dir):
     # These env vars are used in subprocess to have the same effect as running
     # `source ${venv_dir}/bin/activate`
     if self._is_windows():
@@ -428,9 +2267,117 @@ class PythonRuntimeInstanceFactory(instance.InstanceFactory,
       res[kv.key] = kv.value
     return res
 
+  def _UseZygote(self):
+    if self._is_windows():
+      return False
+    for kv in self._runtime_config_getter().environ:
+      if kv.key == _ZYGOTE_ENV:
+        return kv.value.lower() in ('1', 'true', 'yes', 'on')
+    return PythonRuntimeInstanceFactory._zygote_enabled
+
+  def _StartZygote(self):
+    """Starts the zygote of the module, if it uses one."""
+    if not self._UseZygote():
+      return
+    env = dict(os.environ)
+    env.update(self.venv_env_vars)
+    with self._zygote_lock:
+      assert self._zygote is None
+      with http_runtime.startup_timeline.phase(
+          'start_zygote', 'module',
+          module=self._module_configuration.module_name):
+        self._zygote = http_runtime.Zygote(
+            self._GetVenvPythonPath(self._venv_dir), env,
+            self._module_configuration.application_root)
+
+  def _StopZygote(self):
+    with self._zygote_lock:
+      zygote, self._zygote = self._zygote, None
+    if zygote is not None:
+      zygote.stop()
+
   def _get_process_flavor(self):
     return http_runtime.START_PROCESS_WITH_ENTRYPOINT
 
+  def _CreateRuntimeProxy(self, instance_id):
+    # Not a reference to self, which would keep a replaced factory alive.
+    runtime_config_getter = self._runtime_config_getter
+
+    def instance_config_getter():
+      runtime_config = runtime_config_getter()
+      runtime_config.instance_id = str(instance_id)
+      return runtime_config
+
+    return http_runtime.HttpRuntimeProxy(
+        self._GetRuntimeArgs(),
+        instance_config_getter,
+        self._module_configuration,
+        env=self._GetRuntimeEnvironmentVariables(instance_id),
+        start_process_flavor=self._get_process_flavor(),
+        request_id_header_name=_MODERN_REQUEST_ID_HEADER_NAME,
+        zygote=self._zygote,
+        max_connections=self.max_concurrent_requests,
+    )
+
+  def _FillInstancePool(self):
+    """Starts instances in the background until the pool is full."""
+    # The virtualenv is still set up in the background, _ProvisionVirtualenv
+    # fills the pool once it is ready.
+    if not self._venv_provisioned:
+      return
+    warmup_url_map = None
+    if 'warmup' in (self._module_configuration.inbound_services or []):
+      warmup_url_map = self.WARMUP_URL_MAP
+    with self._instance_pool_lock:
+      while (len(self._instance_pool) <
+             PythonRuntimeInstanceFactory._instance_pool_size):
+        # The SDK numbers the instances of a module, so pooled instances get
+        # the ids of the next instances it creates.
+        instance_id = max([self._next_instance_id] + [
+            proxy.instance_id + 1 for proxy in self._instance_pool])
+        proxy = _PooledRuntimeProxy(
+            self._CreateRuntimeProxy(instance_id), warmup_url_map, instance_id)
+        self._instance_pool.append(proxy)
+        threading.Thread(target=proxy.prestart,
+                         name='InstancePool-%s' % instance_id,
+                         daemon=True).start()
+
+  def _ScheduleInstancePoolFill(self):
+    """Fills the pool once no change came for a while, see files_changed."""
+    # Not a reference to self, which would keep a replaced factory alive.
+    factory_ref = weakref.ref(self)
+
+    def fill():
+      factory = factory_ref()
+      if factory is not None:
+        factory._FillInstancePool()
+
+    with self._instance_pool_lock:
+      if self._instance_pool_fill_timer is not None:
+        self._instance_pool_fill_timer.cancel()
+      self._instance_pool_fill_timer = threading.Timer(
+          _INSTANCE_POOL_REFILL_DELAY_SECONDS, fill)
+      self._instance_pool_fill_timer.daemon = True
+      self._instance_pool_fill_timer.start()
+
+  def _DrainInstancePool(self, wait=False):
+    """Stops the pooled instances.
+
+    Args:
+      wait: True to wait until they are stopped, by default they are stopped
+        in the background.
+    """
+    with self._instance_pool_lock:
+      pool, self._instance_pool = self._instance_pool, []
+      if self._instance_pool_fill_timer is not None:
+        self._instance_pool_fill_timer.cancel()
+        self._instance_pool_fill_timer = None
+    for proxy in pool:
+      if wait:
+        proxy.quit()
+      else:
+        threading.Thread(target=proxy.quit, daemon=True).start()
+
   def new_instance(self, instance_id, expect_ready_request=False):
     """Create and return a new Instance.
 
@@ -444,22 +2391,39 @@ class PythonRuntimeInstanceFactory(instance.InstanceFactory,
     Returns:
       The newly created instance.Instance.
     """
-    def instance_config_getter():
-      runtime_config = self._runtime_config_getter()
-      runtime_config.instance_id = str(instance_id)
-      return runtime_config
+    self._WaitForVirtualenv()
 
-    proxy = http_runtime.HttpRuntimeProxy(
-        self._GetRuntimeArgs(),
-        instance_config_getter,
-        self._module_configuration,
-        env=self._GetRuntimeEnvironmentVariables(instance_id),
-        start_process_flavor=self._get_process_flavor(),
-        request_id_header_name=_MODERN_REQUEST_ID_HEADER_NAME,
-    )
-    return instance.Instance(self.request_data,
-                             instance_id,
-                             proxy,
-                             self.max_concurrent_requests,
-                             self.max_background_threads,
-                             expect_ready_request)
+    # Changes by NoCommandLine - use an instance started in the background.
+    proxy = None
+    with self._instance_pool_lock:
+      if isinstance(instance_id, int):
+        self._next_instance_id = max(self._next_instance_id, instance_id + 1)
+      for pooled_proxy in self._instance_pool:
+        if str(pooled_proxy.instance_id) == str(instance_id):
+          proxy = pooled_proxy
+          break
+      else:
+        if self._instance_pool:
+          proxy = self._instance_pool[0]
+      if proxy is not None:
+        self._instance_pool.remove(proxy)
+    if proxy is not None and proxy.instance_id != instance_id:
+      proxy.set_instance_id(instance_id)
+    if PythonRuntimeInstanceFactory._instance_pool_size > 0:
+      http_runtime.startup_timeline.event(
+          'instance_pool', 'instance',
+          module=self._module_configuration.module_name,
+          instance=str(instance_id), hit=proxy is not None)
+    if proxy is not None:
+      self._FillInstancePool()
+    else:
+      proxy = self._CreateRuntimeProxy(instance_id)
+    instance_class = instance.Instance
+    if PythonRuntimeInstanceFactory._adaptive_concurrency:
+      instance_class = _AdaptiveInstance
+    return instance_class(self.request_data,
+                          instance_id,
+                          proxy,
+                          self.max_concurrent_requests,
+                          self.max_background_threads,
+                          expect_ready_request)
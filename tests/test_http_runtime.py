@@ -0,0 +1,883 @@
+"""Tests of http_runtime.py of the gcloud_sdk_470.0.0+ source tree.
+
+The module is loaded on top of the stand-in SDK modules of the benchmarks.
+
+Usage:
+  python -m unittest discover tests
+"""
+import email.message
+import io
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+import run_benchmarks  # pylint: disable=g-import-not-at-top
+
+_VARIANT_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src',
+    'gcloud_sdk_470.0.0+')
+
+http_runtime, instance_factory = run_benchmarks.load_variant(_VARIANT_DIR)
+
+
+class StartupTimelineTest(unittest.TestCase):
+
+  def setUp(self):
+    self.trace_dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, self.trace_dir)
+
+  def _ReadTrace(self, suffix):
+    name, = [name for name in os.listdir(self.trace_dir)
+             if name.endswith(suffix)]
+    with open(os.path.join(self.trace_dir, name)) as f:
+      return f.read()
+
+  def testRecordsPhasesAndEvents(self):
+    timeline = http_runtime.StartupTimeline()
+    with self.assertLogs(level='INFO'):
+      timeline.set_trace_dir(self.trace_dir)
+    with timeline.phase('venv', 'module', module='default') as args:
+      args['cached'] = True
+    timeline.event('ready', 'instance', instance='0')
+    timeline.set_trace_dir(None)
+    entries = [json.loads(line)
+               for line in self._ReadTrace('.jsonl').splitlines()]
+    self.assertEqual(['venv', 'ready'], [entry['name'] for entry in entries])
+    self.assertEqual({'module': 'default', 'cached': True}, entries[0]['args'])
+    self.assertGreaterEqual(entries[0]['duration'], 0)
+    self.assertIsNone(entries[1]['duration'])
+    # The trace array is left open; Chrome and Perfetto accept that.
+    trace_events = json.loads(self._ReadTrace('.trace.json') + '{}]')[:-1]
+    self.assertEqual(['M', 'X', 'i'], [e['ph'] for e in trace_events])
+
+  def testRecordsNothingWithoutTraceDir(self):
+    timeline = http_runtime.StartupTimeline()
+    self.assertFalse(timeline.enabled)
+    with timeline.phase('venv', 'module'):
+      pass
+    timeline.event('ready', 'instance')
+    self.assertEqual([], os.listdir(self.trace_dir))
+
+
+class NeedsShellTest(unittest.TestCase):
+
+  def testPlaceholdersDontNeedShell(self):
+    self.assertFalse(http_runtime.needs_shell(
+        'gunicorn -b :$PORT --bind=fd://${FD} main:app'))
+
+  def testShellSyntaxNeedsShell(self):
+    self.assertTrue(http_runtime.needs_shell('gunicorn main:app | tee log'))
+    self.assertTrue(http_runtime.needs_shell('cd app && gunicorn main:app'))
+    self.assertTrue(http_runtime.needs_shell('gunicorn -w $WORKERS main:app'))
+
+
+@unittest.skipIf(sys.platform == 'win32', 'process groups are POSIX')
+class StopProcessGroupTest(unittest.TestCase):
+
+  def _StartProcess(self, ignore_sigterm):
+    script = ('import signal, sys, time\n'
+              'if %r:\n'
+              '  signal.signal(signal.SIGTERM, signal.SIG_IGN)\n'
+              'sys.stderr.write("started\\n")\n'
+              'sys.stderr.flush()\n'
+              'time.sleep(60)\n' % ignore_sigterm)
+    process = http_runtime._start_process_group(
+        [sys.executable, '-c', script], '', dict(os.environ), None,
+        subprocess.PIPE, False)
+    self.addCleanup(process.stderr.close)
+    self.assertEqual(b'started\n', process.stderr.readline())
+    return process
+
+  def testSigterm(self):
+    process = self._StartProcess(ignore_sigterm=False)
+    http_runtime._stop_process_group(process, True)
+    self.assertEqual(-15, process.wait(5))
+
+  def testSigkillOnceSigtermIgnored(self):
+    process = self._StartProcess(ignore_sigterm=True)
+    with mock.patch.object(http_runtime, '_QUIT_KILL_TIMEOUT_SECONDS', 0.2):
+      start = time.time()
+      http_runtime._stop_process_group(process, True)
+      self.assertEqual(-9, process.wait(5))
+    self.assertGreaterEqual(time.time() - start, 0.2)
+
+  def testSigkillWithoutSigterm(self):
+    process = self._StartProcess(ignore_sigterm=True)
+    http_runtime._stop_process_group(process, False)
+    self.assertEqual(-9, process.wait(5))
+
+
+class ProcessReaperTest(unittest.TestCase):
+
+  def _Watch(self, process):
+    exited = []
+    done = threading.Event()
+
+    def callback(exited_process):
+      exited.append(exited_process)
+      done.set()
+
+    http_runtime._ProcessReaper().watch(process, callback)
+    self.assertTrue(done.wait(5))
+    return exited
+
+  def testCallbackOnceProcessExited(self):
+    process = subprocess.Popen([sys.executable, '-c', 'raise SystemExit(5)'])
+    self.assertEqual([process], self._Watch(process))
+    self.assertEqual(5, process.returncode)
+
+  def testPolledProcess(self):
+    process = mock.Mock(pid=-1)
+    process.poll.side_effect = [None, 7]
+    self.assertEqual([process], self._Watch(process))
+    self.assertEqual(2, process.poll.call_count)
+
+
+class RestartDelayTest(unittest.TestCase):
+
+  def setUp(self):
+    patcher = mock.patch.object(http_runtime.HttpRuntimeProxy,
+                                '_restart_max_backoff_seconds', 3)
+    patcher.start()
+    self.addCleanup(patcher.stop)
+    self.proxy = _NewRuntimeProxy()
+
+  def _GetDelays(self, crashes, uptime=0):
+    delays = []
+    for _ in range(crashes):
+      self.proxy._process_start_time = time.time() - uptime
+      delays.append(self.proxy._get_restart_delay())
+    return delays
+
+  def testBacksOffUpToMax(self):
+    self.assertEqual([0, 1, 2, 3, 3], self._GetDelays(5))
+
+  def testResetOnceProcessRanLongEnough(self):
+    self._GetDelays(3)
+    self.assertEqual([0], self._GetDelays(
+        1, uptime=http_runtime._RESTART_STABLE_SECONDS))
+    self.assertEqual([1], self._GetDelays(1))
+
+
+class ProcessExitedTest(unittest.TestCase):
+
+  def setUp(self):
+    patcher = mock.patch.object(http_runtime.HttpRuntimeProxy, '_restart',
+                                True)
+    patcher.start()
+    self.addCleanup(patcher.stop)
+    self.proxy = _NewRuntimeProxy()
+    self.proxy._process = mock.Mock(returncode=1)
+    self.proxy._process_start_time = time.time()
+    self.restarted = threading.Event()
+    self.proxy._restart_process = lambda delay: self.restarted.set()
+
+  def testRestartedOnceExited(self):
+    with self.assertLogs(level='WARNING'):
+      self.proxy._process_exited(self.proxy._process)
+    self.assertTrue(self.restarted.wait(5))
+    self.assertFalse(self.proxy._available.is_set())
+
+  def testNotRestartedWhenQuit(self):
+    self.proxy._quit_requested.set()
+    self.proxy._process_exited(self.proxy._process)
+    self.assertFalse(self.restarted.wait(0.05))
+    self.assertTrue(self.proxy._available.is_set())
+
+
+class RuntimeLogBufferTest(unittest.TestCase):
+
+  def setUp(self):
+    self.log_dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, self.log_dir)
+    self.log_path = os.path.join(self.log_dir, 'runtime.log')
+
+  def _NewBuffer(self, capacity, log_path=None):
+    log_buffer = http_runtime._RuntimeLogBuffer(capacity, log_path)
+    self.addCleanup(log_buffer.mark_eof)
+    return log_buffer
+
+  def testReadsOnlyOutputAfterOffset(self):
+    log_buffer = self._NewBuffer(100)
+    log_buffer.append(b'abc\n')
+    log_buffer.append(b'def\n')
+    self.assertEqual((b'abc\ndef\n', 8), log_buffer.read())
+    self.assertEqual((b'c\ndef\n', 8), log_buffer.read(2))
+    self.assertEqual((b'', 8), log_buffer.read(8))
+
+  def testEvictedOutputDroppedWithoutLogFile(self):
+    log_buffer = self._NewBuffer(4)
+    for data in (b'aaaa', b'bbbb', b'cccc'):
+      log_buffer.append(data)
+    self.assertEqual((b'cccc', 12), log_buffer.read())
+    self.assertEqual(b'cccc', log_buffer.tail(10))
+
+  def testEvictedOutputReadFromLogFile(self):
+    log_buffer = self._NewBuffer(4, self.log_path)
+    for data in (b'aaaa', b'bbbb', b'cccc'):
+      log_buffer.append(data)
+    self.assertEqual((b'aaaabbbbcccc', 12), log_buffer.read())
+    self.assertEqual((b'abbbbcccc', 12), log_buffer.read(3))
+
+  def testRotatedOutputSkipped(self):
+    log_buffer = self._NewBuffer(4, self.log_path)
+    with mock.patch.object(http_runtime, '_LOG_FILE_MAX_BYTES', 8):
+      for data in (b'aaaa', b'bbbb', b'cccc', b'dddd', b'eeee'):
+        log_buffer.append(data)
+    self.assertEqual((b'ccccddddeeee', 20), log_buffer.read())
+    with open(self.log_path + '.1', 'rb') as f:
+      self.assertEqual(b'aaaabbbb', f.read())
+
+  def testReadRequest(self):
+    log_buffer = self._NewBuffer(100)
+    log_buffer.append(b'before\n')
+    log_buffer.begin_request('r')
+    log_buffer.append(b'during\n')
+    log_buffer.end_request('r')
+    log_buffer.append(b'after\n')
+    self.assertEqual(b'during\n', log_buffer.read_request('r'))
+    self.assertIsNone(log_buffer.read_request('unknown'))
+
+
+class RuntimeLogParserTest(unittest.TestCase):
+
+  def setUp(self):
+    self.log_store = http_runtime._RuntimeLogStore(100)
+    self.parser = http_runtime._RuntimeLogParser('0', self.log_store)
+
+  def _Records(self, request_id='r'):
+    return [(record.severity, record.message)
+            for record in self.log_store.get_request_records(request_id)]
+
+  def testSeverities(self):
+    self.parser.feed(
+        b'[2024-01-01 00:00:00 +0000] [7] [INFO] Booting worker\n'
+        b'{"severity": "warn", "message": "structured"}\n'
+        b'plain\r\n\n', 'r')
+    self.assertEqual([('INFO', '[2024-01-01 00:00:00 +0000] [7] [INFO] '
+                               'Booting worker'),
+                      ('WARNING', 'structured'),
+                      ('DEFAULT', 'plain')], self._Records())
+
+  def testTracebackLinesAreErrors(self):
+    self.parser.feed(
+        b'Traceback (most recent call last):\n'
+        b'  File "main.py", line 1, in <module>\n'
+        b'ValueError: bad\n'
+        b'next\n', 'r')
+    self.assertEqual(['ERROR', 'ERROR', 'ERROR', 'DEFAULT'],
+                     [severity for severity, _ in self._Records()])
+    self.assertEqual(3, len(self.log_store.get_errors(60)))
+
+  def testPartialLineAddedOnFlush(self):
+    self.parser.feed(b'par', 'r')
+    self.parser.feed(b'tial', 'r')
+    self.assertEqual([], self._Records())
+    self.parser.flush('r')
+    self.assertEqual([('DEFAULT', 'partial')], self._Records())
+
+
+class RuntimeLogStoreTest(unittest.TestCase):
+
+  def _Record(self, request_id, severity='INFO', timestamp=None):
+    return http_runtime.RuntimeLogRecord(
+        timestamp or time.time(), severity, '0', request_id, request_id)
+
+  def testOldestRecordsDropped(self):
+    log_store = http_runtime._RuntimeLogStore(3)
+    for request_id in ('a', 'b', 'a', 'c', 'd'):
+      log_store.add(self._Record(request_id, 'ERROR'))
+    self.assertEqual([], log_store.get_request_records('b'))
+    self.assertEqual(1, len(log_store.get_request_records('a')))
+    self.assertEqual(['a', 'c', 'd'],
+                     [record.request_id for record in log_store.get_errors(60)])
+
+  def testErrorsOfLastSeconds(self):
+    log_store = http_runtime._RuntimeLogStore(10)
+    log_store.add(self._Record('old', 'ERROR', time.time() - 120))
+    log_store.add(self._Record('info'))
+    log_store.add(self._Record('new', 'CRITICAL'))
+    self.assertEqual(['new'], [record.request_id
+                               for record in log_store.get_errors(60)])
+
+
+class _Console(object):
+  """Collects what is written to it from other threads."""
+
+  def __init__(self):
+    self.writes = []
+
+  def write(self, data):
+    self.writes.append(data)
+
+  def flush(self):
+    pass
+
+  def wait_for(self, data, timeout=5):
+    deadline = time.time() + timeout
+    while b''.join(self.writes) != data and time.time() < deadline:
+      time.sleep(0.01)
+    return b''.join(self.writes)
+
+
+@unittest.skipIf(sys.platform == 'win32', 'the log pump needs POSIX pipes')
+class LogPumpTest(unittest.TestCase):
+
+  def setUp(self):
+    r, self.w = os.pipe()
+    self.addCleanup(self._CloseWriteEnd)
+    self.pipe = open(r, 'rb', buffering=0)
+    self.console = _Console()
+    self.log_buffer = http_runtime._RuntimeLogBuffer(1024)
+    http_runtime._LogPump().add(self.pipe, self.console, self.log_buffer)
+
+  def _CloseWriteEnd(self):
+    if self.w is not None:
+      os.close(self.w)
+      self.w = None
+
+  def testCopiesCompleteLinesUntilClosed(self):
+    os.write(self.w, b'one\ntw')
+    self.assertEqual(b'one\n', self.console.wait_for(b'one\n'))
+    os.write(self.w, b'o\n')
+    self._CloseWriteEnd()
+    self.assertTrue(self.log_buffer.wait_for_eof(5))
+    self.assertEqual(b'one\ntwo\n', self.console.wait_for(b'one\ntwo\n'))
+    self.assertEqual(b'one\ntwo\n', self.log_buffer.read()[0])
+    self.assertTrue(self.pipe.closed)
+
+  def testPartialLineWrittenAfterDelay(self):
+    os.write(self.w, b'Loading')
+    self.assertEqual(b'Loading', self.console.wait_for(b'Loading'))
+
+
+class _BlockedConsole(_Console):
+  """A console that takes writes only once released."""
+
+  def __init__(self):
+    super(_BlockedConsole, self).__init__()
+    self.writing = threading.Event()
+    self.released = threading.Event()
+
+  def write(self, data):
+    self.writing.set()
+    self.released.wait(5)
+    super(_BlockedConsole, self).write(data)
+
+
+class ConsoleForwarderTest(unittest.TestCase):
+
+  def _NewForwarder(self, policy):
+    """Returns a forwarder whose console is busy writing b'first\\n'."""
+    self.console = _BlockedConsole()
+    self.addCleanup(self.console.released.set)
+    forwarder = http_runtime._ConsoleForwarder(self.console, policy, 10)
+    forwarder.write(b'first\n')
+    self.assertTrue(self.console.writing.wait(5))
+    return forwarder
+
+  def testDropsOldestQueuedOutput(self):
+    forwarder = self._NewForwarder(http_runtime.LOG_FORWARD_DROP_OLDEST)
+    forwarder.write(b'aaaa\n')
+    forwarder.write(b'bbbb\n')
+    self.console.released.set()
+    forwarder.drain(5)
+    self.assertEqual(
+        b'first\n[dev_appserver] 5 bytes of runtime output were not shown, '
+        b'the console could not keep up.\nbbbb\n',
+        b''.join(self.console.writes))
+    self.assertEqual(5, forwarder.get_stats()['dropped_bytes'])
+
+  def testSamplesLines(self):
+    forwarder = self._NewForwarder(http_runtime.LOG_FORWARD_SAMPLE)
+    forwarder.write(b''.join(b'%d\n' % i for i in range(10, 30)))
+    self.console.released.set()
+    forwarder.drain(5)
+    self.assertTrue(b''.join(self.console.writes).endswith(b'\n19\n29\n'))
+    self.assertEqual(54, forwarder.get_stats()['dropped_bytes'])
+
+  def testBlocksUntilConsoleCaughtUp(self):
+    forwarder = self._NewForwarder(http_runtime.LOG_FORWARD_BLOCK)
+    writer = threading.Thread(target=forwarder.write, args=(b'second!!\n',))
+    writer.start()
+    writer.join(0.05)
+    self.assertTrue(writer.is_alive())
+    self.console.released.set()
+    writer.join(5)
+    forwarder.drain(5)
+    self.assertEqual(b'first\nsecond!!\n', b''.join(self.console.writes))
+    self.assertEqual(9, forwarder.get_stats()['delayed_bytes'])
+
+
+@unittest.skipUnless(hasattr(socket, 'AF_UNIX'), 'the zygote needs POSIX')
+class ZygoteProcessTest(unittest.TestCase):
+
+  def setUp(self):
+    self.zygote_conn, conn = socket.socketpair()
+    self.addCleanup(self.zygote_conn.close)
+    self.addCleanup(conn.close)
+    # The pid of this process, which is alive.
+    self.process = http_runtime._ZygoteProcess(os.getpid(), conn, None)
+
+  def testPollDoesNotBlock(self):
+    self.assertIsNone(self.process.poll())
+    self.zygote_conn.sendall(b'{"returncode": ')
+    self.assertIsNone(self.process.poll())
+    self.zygote_conn.sendall(b'3}\n')
+    self.assertEqual(3, self.process.poll())
+
+  def testWaitTimesOut(self):
+    self.assertRaises(subprocess.TimeoutExpired, self.process.wait, 0.05)
+
+  def testPollWhileWaiting(self):
+    returncodes = []
+    waiter = threading.Thread(
+        target=lambda: returncodes.append(self.process.wait()))
+    waiter.start()
+    time.sleep(0.05)
+    self.assertIsNone(self.process.poll())
+    self.zygote_conn.sendall(b'{"returncode": -9}\n')
+    waiter.join(5)
+    self.assertEqual([-9], returncodes)
+    self.assertEqual(-9, self.process.poll())
+
+
+@unittest.skipUnless(hasattr(socket, 'AF_UNIX'), 'the zygote needs POSIX')
+class ZygoteTest(unittest.TestCase):
+
+  def setUp(self):
+    self.app_dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, self.app_dir)
+    with open(os.path.join(self.app_dir, 'main.py'), 'w') as f:
+      f.write('import sys\n'
+              'sys.stderr.write("%s\\n" % " ".join(sys.argv[1:]))\n'
+              'sys.exit(3)\n')
+    with mock.patch.dict(os.environ,
+                         {http_runtime._ZYGOTE_PRELOAD_ENV: 'json'}):
+      self.zygote = http_runtime.Zygote(sys.executable, dict(os.environ),
+                                        self.app_dir)
+    self.addCleanup(self.zygote.stop)
+
+  def testForkedProcessRunsEntrypoint(self):
+    process = self.zygote.spawn(['python', 'main.py', 'hello'],
+                                dict(os.environ), self.app_dir)
+    self.addCleanup(process._conn.close)
+    with process.stderr:
+      self.assertEqual(3, process.wait(10))
+      self.assertEqual(b'hello\n', process.stderr.read())
+
+
+def _NewRuntimeProxy(args=('python', 'main.py'), max_connections=None):
+  return http_runtime.HttpRuntimeProxy(
+      list(args), lambda: mock.Mock(environ=[], instance_id='0'),
+      mock.Mock(module_name='default', config_path='app.yaml'), env={},
+      start_process_flavor=http_runtime.START_PROCESS_WITH_ENTRYPOINT,
+      max_connections=max_connections)
+
+
+class MaxConnectionsTest(unittest.TestCase):
+
+  def testKeptConnectionsAreCapped(self):
+    self.assertEqual(8, _NewRuntimeProxy(max_connections=8)._max_connections)
+    self.assertEqual(http_runtime._MAX_KEEP_ALIVE_CONNECTIONS,
+                     _NewRuntimeProxy(max_connections=400)._max_connections)
+
+
+class PortRangeTest(unittest.TestCase):
+
+  def setUp(self):
+    first = self._FindFreePorts(3)
+    patcher = mock.patch.multiple(
+        http_runtime.HttpRuntimeProxy, _port_range=(first, first + 2),
+        _reserved_ports=set(), _next_port_in_range=None)
+    patcher.start()
+    self.addCleanup(patcher.stop)
+    self.first = first
+
+  def _FindFreePorts(self, count):
+    """Returns the first of count consecutive ports nobody listens on."""
+    for first in range(20000, 60000, count):
+      probes = []
+      try:
+        for port in range(first, first + count):
+          probes.append(socket.socket(socket.AF_INET, socket.SOCK_STREAM))
+          probes[-1].bind(('', port))
+        return first
+      except socket.error:
+        pass
+      finally:
+        for probe in probes:
+          probe.close()
+    self.skipTest('no free ports')
+
+  def testParsePortRange(self):
+    self.assertEqual((8100, 8199), http_runtime._parse_port_range('8100-8199'))
+    with self.assertLogs(level='WARNING'):
+      self.assertIsNone(http_runtime._parse_port_range('8199-8100'))
+    self.assertIsNone(http_runtime._parse_port_range(None))
+
+  def testPortsHandedOutRoundRobin(self):
+    proxies = [_NewRuntimeProxy() for _ in range(3)]
+    self.assertEqual(self.first, proxies[0]._reserve_port_in_range())
+    self.assertEqual(self.first + 1, proxies[1]._reserve_port_in_range())
+    proxies[0]._release_port()
+    self.assertEqual(self.first + 2, proxies[2]._reserve_port_in_range())
+    self.assertEqual(self.first, proxies[0]._reserve_port_in_range())
+    self.assertIsNone(_NewRuntimeProxy()._reserve_port_in_range())
+
+  def testListeningSocketBoundInRange(self):
+    proxy = _NewRuntimeProxy()
+    listen_socket = proxy._bind_listening_socket()
+    self.addCleanup(listen_socket.close)
+    self.assertEqual(self.first, listen_socket.getsockname()[1])
+    self.assertEqual(self.first, proxy._reserved_port)
+
+
+@unittest.skipUnless(hasattr(socket, 'AF_UNIX'), 'sd_notify needs POSIX')
+class ReadyNotificationTest(unittest.TestCase):
+
+  def setUp(self):
+    patcher = mock.patch.multiple(
+        http_runtime.HttpRuntimeProxy, _ready_notify=True,
+        _args_without_notify=set())
+    patcher.start()
+    self.addCleanup(patcher.stop)
+    self.proxy = _NewRuntimeProxy()
+    self.proxy._process = mock.Mock()
+    self.proxy._process.poll.return_value = None
+    self.proxy._create_notify_socket()
+    self.addCleanup(self.proxy._close_notify_socket)
+
+  def testWaitsForReady(self):
+    path = self.proxy._env['NOTIFY_SOCKET']
+    with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as runtime:
+      runtime.sendto(b'STATUS=Starting', path)
+      runtime.sendto(b'STATUS=Listening\nREADY=1', path)
+    self.proxy._wait_for_ready_notification()
+    self.assertTrue(self.proxy._notified_ready)
+    self.assertNotIn('NOTIFY_SOCKET', self.proxy._env)
+    self.assertFalse(os.path.exists(path))
+
+  def testNotWaitedForAgainAfterTimeout(self):
+    with mock.patch.object(http_runtime, '_READY_NOTIFY_TIMEOUT_SECONDS', 0.2):
+      with self.assertLogs(level='WARNING'):
+        self.proxy._wait_for_ready_notification()
+    self.assertFalse(self.proxy._notified_ready)
+    self.proxy._create_notify_socket()
+    self.assertNotIn('NOTIFY_SOCKET', self.proxy._env)
+
+  def testStopsWaitingWhenProcessExited(self):
+    self.proxy._process.poll.return_value = 1
+    start = time.time()
+    self.proxy._wait_for_ready_notification()
+    self.assertLess(time.time() - start, 1)
+    self.assertFalse(self.proxy._notified_ready)
+
+
+class ReadyPathTest(unittest.TestCase):
+
+  def setUp(self):
+    patcher = mock.patch.object(http_runtime.HttpRuntimeProxy, '_ready_path',
+                                '/ready')
+    patcher.start()
+    self.addCleanup(patcher.stop)
+    self.proxy = _NewRuntimeProxy()
+    self.proxy._connection_pool = mock.Mock()
+
+  def testWaitsFor2xx(self):
+    connections = [mock.Mock() for _ in range(3)]
+    connections[0].request.side_effect = ConnectionRefusedError()
+    connections[1].getresponse.return_value.status = 503
+    connections[2].getresponse.return_value.status = 204
+    self.proxy._connection_pool.connect.side_effect = connections
+    with mock.patch.object(http_runtime, '_READY_PATH_INTERVAL_SECONDS', 0):
+      self.proxy._wait_for_ready_path()
+    connections[2].request.assert_called_once_with('GET', '/ready')
+    for connection in connections:
+      connection.close.assert_called_once_with()
+
+  def testNotWaitedForOnceProcessExited(self):
+    self.proxy._process = mock.Mock()
+    self.proxy._process.poll.return_value = 1
+    self.proxy._wait_for_ready_path()
+    self.proxy._connection_pool.connect.assert_not_called()
+
+
+class ListenFdArgsTest(unittest.TestCase):
+
+  def _GetArgs(self, entrypoint):
+    return _NewRuntimeProxy(entrypoint.split())._get_args_with_fd(5)
+
+  def testGunicornBindsFd(self):
+    self.assertEqual(['gunicorn', '-b', 'fd://5', 'main:app'],
+                     self._GetArgs('gunicorn -b :$PORT main:app'))
+    self.assertEqual(['gunicorn', '--bind=fd://5', 'main:app'],
+                     self._GetArgs('gunicorn --bind=0.0.0.0:${PORT} main:app'))
+
+  def testFdPlaceholder(self):
+    self.assertEqual(['python', 'main.py', '--fd=5'],
+                     self._GetArgs('python main.py --fd=${FD}'))
+
+  def testPortUsedOtherwise(self):
+    self.assertIsNone(self._GetArgs('python main.py --port=$PORT'))
+
+
+class UnixSocketArgsTest(unittest.TestCase):
+
+  def _GetArgs(self, entrypoint):
+    return _NewRuntimeProxy(entrypoint.split())._get_args_with_unix_socket(
+        '/tmp/rt/socket')
+
+  def testAddressReplacedWithSocket(self):
+    self.assertEqual(['gunicorn', '--bind=unix:/tmp/rt/socket', 'main:app'],
+                     self._GetArgs('gunicorn -b :$PORT main:app'))
+    self.assertEqual(['gunicorn', '--bind=unix:/tmp/rt/socket', 'main:app'],
+                     self._GetArgs('gunicorn -b:${PORT} main:app'))
+    self.assertEqual(['uvicorn', 'main:app', '--uds=/tmp/rt/socket'],
+                     self._GetArgs('uvicorn main:app --host 0.0.0.0 '
+                                   '--port $PORT'))
+
+  def testSocketPlaceholder(self):
+    self.assertEqual(['python', 'main.py', '/tmp/rt/socket'],
+                     self._GetArgs('python main.py ${SOCKET}'))
+
+  def testPortUsedOtherwise(self):
+    self.assertIsNone(self._GetArgs('python main.py --port=$PORT'))
+    self.assertIsNone(self._GetArgs('gunicorn -b :$PORT main:app $PORT'))
+
+
+@unittest.skipUnless(hasattr(socket, 'AF_UNIX'), 'needs Unix domain sockets')
+class UnixHTTPConnectionTest(unittest.TestCase):
+
+  def testRequestOverSocket(self):
+    socket_dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, socket_dir)
+    path = os.path.join(socket_dir, 'socket')
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    self.addCleanup(server.close)
+    server.bind(path)
+    server.listen(1)
+    requests = []
+
+    def serve():
+      conn, _ = server.accept()
+      with conn:
+        requests.append(conn.recv(4096))
+        conn.sendall(b'HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok')
+
+    thread = threading.Thread(target=serve)
+    thread.start()
+    connection = http_runtime._UnixHTTPConnection(path)
+    self.addCleanup(connection.close)
+    connection.request('GET', '/ready')
+    response = connection.getresponse()
+    self.assertEqual((200, b'ok'), (response.status, response.read()))
+    thread.join(5)
+    self.assertTrue(requests[0].startswith(b'GET /ready HTTP/1.1\r\n'))
+
+
+
+class _PooledConnection(object):
+  """A connection over a socket pair, whose peer is the runtime process."""
+
+  def __init__(self):
+    self.sock, self.peer = socket.socketpair()
+
+  def close(self):
+    if self.sock is not None:
+      self.sock.close()
+      self.sock = None
+    self.peer.close()
+
+
+class ConnectionPoolTest(unittest.TestCase):
+
+  def setUp(self):
+    self.connections = []
+    self.pool = http_runtime._ConnectionPool(self._NewConnection, 2, 15)
+    self.addCleanup(self.pool.close)
+
+  def _NewConnection(self):
+    self.connections.append(_PooledConnection())
+    self.addCleanup(self.connections[-1].close)
+    return self.connections[-1]
+
+  def testLastIdleConnectionReused(self):
+    first, _ = self.pool.get()
+    second, _ = self.pool.get()
+    self.pool.put(first)
+    self.pool.put(second)
+    self.assertEqual((second, True), self.pool.get())
+    self.assertEqual((first, True), self.pool.get())
+    self.assertFalse(self.pool.get()[1])
+
+  def testIdleConnectionExpires(self):
+    connection, _ = self.pool.get()
+    self.pool.put(connection)
+    now = time.time()
+    with mock.patch.object(http_runtime.time, 'time', return_value=now + 16):
+      new_connection, reused = self.pool.get()
+    self.assertFalse(reused)
+    self.assertIsNot(connection, new_connection)
+    self.assertIsNone(connection.sock)
+
+  def testConnectionClosedByRuntimeDropped(self):
+    connection, _ = self.pool.get()
+    self.pool.put(connection)
+    connection.peer.close()
+    new_connection, reused = self.pool.get()
+    self.assertFalse(reused)
+    self.assertIsNot(connection, new_connection)
+    self.assertIsNone(connection.sock)
+
+  def testAtMostMaxSizeKept(self):
+    connections = [self.pool.get()[0] for _ in range(3)]
+    for connection in connections:
+      self.pool.put(connection)
+    self.assertIsNone(connections[2].sock)
+    self.pool.close()
+    self.assertEqual([None, None], [c.sock for c in connections[:2]])
+
+
+class _FakeResponse(object):
+
+  def __init__(self, blocks):
+    self.status = 200
+    self.reason = 'OK'
+    self.msg = email.message.Message()
+    self.msg['Content-Type'] = 'text/plain'
+    self._blocks = list(blocks)
+    self.closed = False
+
+  def read1(self, unused_size):
+    return self._blocks.pop(0) if self._blocks else b''
+
+  def close(self):
+    self.closed = True
+
+
+class _FakeConnection(object):
+  """Records the request, and answers with a _FakeResponse."""
+
+  def __init__(self, response_blocks):
+    self.sock = object()
+    self.response = _FakeResponse(response_blocks)
+    self.request_body = None
+    self.request_headers = None
+    self.spooled_body = None
+
+  def request(self, unused_method, unused_url, body, headers):
+    self.request_headers = headers
+    if hasattr(body, 'read'):
+      self.spooled_body = body
+      self.request_body = body.read()
+    else:
+      self.request_body = body
+
+  def getresponse(self):
+    return self.response
+
+  def close(self):
+    self.sock = None
+
+
+class ForwardingHttpProxyTest(unittest.TestCase):
+
+  def _Forward(self, body, content_length=None, response_blocks=(b'ok',),
+               spool_bytes=1024, wsgi_input=None, stale_connection=None):
+    self.connection = _FakeConnection(response_blocks)
+    pool = mock.Mock()
+    if stale_connection is not None:
+      pool.get.return_value = (stale_connection, True)
+      pool.connect.return_value = self.connection
+    else:
+      pool.get.return_value = (self.connection, False)
+    proxy = http_runtime._ForwardingHttpProxy(
+        pool, 'localhost', 8080, lambda: False, lambda: '', None,
+        request_spool_bytes=spool_bytes)
+    environ = {
+        'REQUEST_METHOD': 'POST',
+        'PATH_INFO': '/upload',
+        'CONTENT_LENGTH': str(len(body) if content_length is None
+                              else content_length),
+        'wsgi.input': wsgi_input or io.BytesIO(body),
+    }
+    statuses = []
+    response = proxy.handle(
+        environ, lambda status, headers: statuses.append(status), None, None,
+        'request-id', http_runtime.instance.NORMAL_REQUEST)
+    return statuses, response
+
+  def testSmallBodyIsSentFromMemory(self):
+    statuses, response = self._Forward(b'x' * 1024)
+    self.assertEqual([b'ok'], list(response))
+    self.assertEqual(['200 OK'], statuses)
+    self.assertEqual(b'x' * 1024, self.connection.request_body)
+    self.assertIsNone(self.connection.spooled_body)
+
+  def testLargeBodyIsSpooledAndClosed(self):
+    statuses, response = self._Forward(b'x' * 1025)
+    self.assertEqual([b'ok'], list(response))
+    self.assertEqual(b'x' * 1025, self.connection.request_body)
+    self.assertTrue(self.connection.spooled_body.closed)
+
+  def testShortBodyGetsItsContentLength(self):
+    unused_statuses, response = self._Forward(b'x' * 2000,
+                                              content_length=4096)
+    list(response)
+    self.assertEqual(b'x' * 2000, self.connection.request_body)
+    self.assertEqual('2000',
+                     self.connection.request_headers['CONTENT-LENGTH'])
+
+  def testSpoolClosedWhenClientFails(self):
+    spools = []
+    temporary_file = http_runtime.tempfile.TemporaryFile
+
+    def spool(**kwargs):
+      spools.append(temporary_file(**kwargs))
+      return spools[-1]
+
+    wsgi_input = mock.Mock()
+    wsgi_input.read.side_effect = [b'x' * 1024, IOError('client went away')]
+    unused_statuses, response = self._Forward(b'x' * 2048,
+                                              wsgi_input=wsgi_input)
+    with mock.patch.object(http_runtime.tempfile, 'TemporaryFile', spool):
+      self.assertRaises(IOError, list, response)
+    self.assertTrue(spools[0].closed)
+
+  def testSpooledBodySentAgainOnNewConnection(self):
+    stale_connection = mock.Mock()
+
+    def request(unused_method, unused_url, body, unused_headers):
+      body.read(100)
+      raise ConnectionResetError()
+
+    stale_connection.request.side_effect = request
+    unused_statuses, response = self._Forward(
+        b'x' * 2048, stale_connection=stale_connection)
+    self.assertEqual([b'ok'], list(response))
+    stale_connection.close.assert_called_once_with()
+    self.assertEqual(b'x' * 2048, self.connection.request_body)
+    self.assertTrue(self.connection.spooled_body.closed)
+
+  def testResponseIsStreamedAsSent(self):
+    unused_statuses, response = self._Forward(
+        b'', response_blocks=(b'data: 1\n\n', b'data: 2\n\n'))
+    self.assertEqual(b'data: 1\n\n', next(response))
+    self.assertEqual(b'data: 2\n\n', next(response))
+    self.assertRaises(StopIteration, next, response)
+    self.assertTrue(self.connection.response.closed)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,480 @@
+"""Tests of instance_factory.py of the gcloud_sdk_470.0.0+ source tree.
+
+The module is loaded on top of the stand-in SDK modules of the benchmarks.
+
+Usage:
+  python -m unittest discover tests
+"""
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+import run_benchmarks  # pylint: disable=g-import-not-at-top
+
+_VARIANT_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src',
+    'gcloud_sdk_470.0.0+')
+
+http_runtime, instance_factory = run_benchmarks.load_variant(_VARIANT_DIR)
+Factory = instance_factory.PythonRuntimeInstanceFactory
+
+
+def _NewFactory():
+  """Returns a factory without running __init__, which sets up a venv."""
+  factory = Factory.__new__(Factory)
+  factory._venv_dir = ''
+  factory._instance_pool = []
+  factory._instance_pool_lock = threading.Lock()
+  factory._instance_pool_fill_timer = None
+  factory._zygote = None
+  factory._zygote_lock = threading.Lock()
+  return factory
+
+
+class GetPipIndexArgsTest(unittest.TestCase):
+
+  def setUp(self):
+    patcher = mock.patch.multiple(Factory, _wheelhouse_dir=None,
+                                  _offline=False)
+    patcher.start()
+    self.addCleanup(patcher.stop)
+
+  def testNoWheelhouseUsesIndexWithoutProbing(self):
+    with mock.patch.object(socket, 'create_connection') as create_connection:
+      args = _NewFactory()._GetPipIndexArgs(
+          '/venv', ['-r', 'requirements.txt'], {}, None, None)
+    self.assertEqual([], args)
+    create_connection.assert_not_called()
+
+  def testNoWheelhouseOffline(self):
+    Factory._offline = True
+    with mock.patch.object(socket, 'create_connection') as create_connection:
+      args = _NewFactory()._GetPipIndexArgs(
+          '/venv', ['-r', 'requirements.txt'], {}, None, None)
+    self.assertEqual(['--no-index'], args)
+    create_connection.assert_not_called()
+
+  def testCollectedWheelhouseUsedWithoutProbing(self):
+    wheelhouse_dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, wheelhouse_dir)
+    Factory._wheelhouse_dir = wheelhouse_dir
+    factory = _NewFactory()
+    factory._python_version = '3'
+    with open(factory._GetWheelhouseStampPath(['flask']), 'w') as f:
+      json.dump(['flask'], f)
+    with mock.patch.object(socket, 'create_connection') as create_connection:
+      args = factory._GetPipIndexArgs('/venv', ['flask'], {}, None, None)
+    self.assertEqual(['--no-index', '--find-links', wheelhouse_dir], args)
+    create_connection.assert_not_called()
+
+
+class GetRuntimeArgsTest(unittest.TestCase):
+
+  def _GetRuntimeArgs(self, entrypoint):
+    factory = _NewFactory()
+    factory._module_configuration = mock.Mock(entrypoint=entrypoint)
+    with mock.patch.object(Factory, '_is_windows', return_value=False):
+      return factory._GetRuntimeArgs()
+
+  def testExecIsStripped(self):
+    self.assertEqual(
+        ['gunicorn', '-b', ':$PORT', 'main:app'],
+        self._GetRuntimeArgs('exec gunicorn -b :$PORT main:app'))
+
+  def testExecKeptForShell(self):
+    self.assertEqual(
+        ['exec gunicorn main:app && true'],
+        self._GetRuntimeArgs('exec gunicorn main:app && true'))
+
+  def testShellEntrypointKeptAsItIs(self):
+    entrypoint = 'gunicorn -b :$PORT "main:create_app(\'a  b\')" | tee log'
+    self.assertEqual([entrypoint], self._GetRuntimeArgs(entrypoint))
+
+
+class GetDefaultEntrypointTest(unittest.TestCase):
+
+  def _GetDefaultEntrypoint(self, instance_class, cpus, windows=False,
+                            basic_scaling=None):
+    factory = _NewFactory()
+    factory._asgi = False
+    factory._logged_default_entrypoint = None
+    factory._module_configuration = mock.Mock(
+        instance_class=instance_class, basic_scaling_config=basic_scaling,
+        manual_scaling_config=None, module_name='default')
+    with mock.patch.object(Factory, '_is_windows', return_value=windows), \
+         mock.patch.object(os, 'cpu_count', return_value=cpus):
+      return factory._GetDefaultEntrypoint()
+
+  def testWorkersOfInstanceClass(self):
+    self.assertIn(' -w 2 ', self._GetDefaultEntrypoint(None, 16))
+    self.assertIn(' -w 4 ', self._GetDefaultEntrypoint('f2', 16))
+    self.assertIn(' -w 8 ', self._GetDefaultEntrypoint('B4_1G', 16))
+
+  def testWorkersLimitedByCpus(self):
+    self.assertIn(' -w 1 ', self._GetDefaultEntrypoint('F4', 1))
+
+  def testTimeoutOfScaling(self):
+    self.assertIn(' --timeout 600 ', self._GetDefaultEntrypoint(None, 2))
+    self.assertIn(' --timeout 86400 ',
+                  self._GetDefaultEntrypoint(None, 2, basic_scaling=object()))
+
+  def testWaitressGetsAllThreads(self):
+    self.assertIn(' --threads=32 ',
+                  self._GetDefaultEntrypoint('F4', 8, windows=True))
+
+
+class IsAsgiAppTest(unittest.TestCase):
+
+  def _IsAsgiApp(self, source):
+    app_dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, app_dir)
+    main_file_name = os.path.join(app_dir, 'main.py')
+    with open(main_file_name, 'w') as f:
+      f.write(source)
+    return instance_factory._is_asgi_app(main_file_name)
+
+  def testAsgiApps(self):
+    self.assertTrue(self._IsAsgiApp(
+        'from fastapi import FastAPI\napp = FastAPI()\n'))
+    self.assertTrue(self._IsAsgiApp(
+        'import starlette.applications\n'
+        'app = starlette.applications.Starlette()\n'
+        'app = CORSMiddleware(app)\n'))
+    self.assertTrue(self._IsAsgiApp(
+        'async def app(scope, receive, send):\n  pass\n'))
+
+  def testWsgiApps(self):
+    self.assertFalse(self._IsAsgiApp(
+        'from flask import Flask\napp = Flask(__name__)\n'))
+    self.assertFalse(self._IsAsgiApp(
+        'app = FastAPI()\napp = Flask(__name__)\n'))
+    self.assertFalse(self._IsAsgiApp('def app(environ, start_response):\n'
+                                     '  pass\n'))
+
+  def testUnknown(self):
+    self.assertFalse(self._IsAsgiApp('app = FastAPI(\n'))
+    self.assertFalse(instance_factory._is_asgi_app('/does/not/exist.py'))
+
+  def testDefaultEntrypointOfAsgiApp(self):
+    factory = _NewFactory()
+    factory._asgi = True
+    factory._logged_default_entrypoint = None
+    factory._module_configuration = mock.Mock(
+        instance_class='F2', basic_scaling_config=None,
+        manual_scaling_config=None, module_name='default')
+    with mock.patch.object(os, 'cpu_count', return_value=4):
+      with mock.patch.object(Factory, '_is_windows', return_value=False):
+        self.assertIn('-w 4 -k uvicorn.workers.UvicornWorker',
+                      factory._GetDefaultEntrypoint())
+      with mock.patch.object(Factory, '_is_windows', return_value=True):
+        self.assertIn('uvicorn --host 0.0.0.0 --port ${PORT} --workers 4',
+                      factory._GetDefaultEntrypoint())
+
+
+class EvictVenvCacheTest(unittest.TestCase):
+
+  def setUp(self):
+    self.cache_dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, self.cache_dir)
+    patcher = mock.patch.multiple(
+        Factory, _venv_cache_dir=self.cache_dir, _venv_cache_max_entries=0,
+        _venv_cache_in_use=[])
+    patcher.start()
+    self.addCleanup(patcher.stop)
+
+  def _AddEntry(self, name, leased):
+    venv_dir = os.path.join(self.cache_dir, name)
+    os.mkdir(venv_dir)
+    with open(os.path.join(
+        venv_dir, instance_factory._VENV_CACHE_METADATA_FILE_NAME), 'w') as f:
+      json.dump({'size_bytes': 1}, f)
+    if leased:
+      Factory._TouchVenvCacheLease(venv_dir)
+    return venv_dir
+
+  def testEntryLeasedByAnotherProcessIsKept(self):
+    leased = self._AddEntry('leased', leased=True)
+    unused = self._AddEntry('unused', leased=False)
+    Factory._EvictVenvCache()
+    self.assertTrue(os.path.exists(leased))
+    self.assertFalse(os.path.exists(unused))
+
+  def testExpiredLeaseIsEvicted(self):
+    venv_dir = self._AddEntry('expired', leased=True)
+    expired = time.time() - instance_factory._VENV_CACHE_LEASE_SECONDS - 1
+    lease_path = os.path.join(venv_dir,
+                              instance_factory._VENV_CACHE_LEASE_FILE_NAME)
+    os.utime(lease_path, (expired, expired))
+    Factory._EvictVenvCache()
+    self.assertFalse(os.path.exists(venv_dir))
+
+
+class GetOrBuildCachedVirtualenvTest(unittest.TestCase):
+
+  # Builds the cache entry in another process, like a second dev_appserver
+  # sharing the cache directory.
+  _BUILDER_SCRIPT = '''
+import os, sys, time
+venv_dir, lease_name, metadata_name = sys.argv[1:]
+os.mkdir(venv_dir)
+open(os.path.join(venv_dir, lease_name), 'w').close()
+open(os.path.join(venv_dir, 'built-by-other-process'), 'w').close()
+time.sleep(0.5)
+with open(os.path.join(venv_dir, metadata_name), 'w') as f:
+  f.write('{}')
+'''
+
+  def setUp(self):
+    self.cache_dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, self.cache_dir)
+    patcher = mock.patch.multiple(
+        Factory, _venv_cache_dir=self.cache_dir, _venv_cache_in_use=[],
+        _AcquireCachedVirtualenv=mock.DEFAULT,
+        _InstallVirtualenv=mock.DEFAULT, _EvictVenvCache=mock.DEFAULT,
+        _GetPythonInterpreterPath=mock.Mock(return_value=sys.executable))
+    self.mocks = patcher.start()
+    self.addCleanup(patcher.stop)
+    patcher = mock.patch.object(
+        instance_factory, '_VENV_CACHE_BUILD_POLL_SECONDS', 0.05)
+    patcher.start()
+    self.addCleanup(patcher.stop)
+    self.factory = _NewFactory()
+    self.factory._module_configuration = mock.Mock(module_name='default')
+    self.factory._python_version = '3'
+    self.key = 'k' * 64
+    self.venv_dir = os.path.join(self.cache_dir, self.key[:32])
+
+  def testWaitsForBuildOfAnotherProcess(self):
+    builder = subprocess.Popen([
+        sys.executable, '-c', self._BUILDER_SCRIPT, self.venv_dir,
+        instance_factory._VENV_CACHE_LEASE_FILE_NAME,
+        instance_factory._VENV_CACHE_METADATA_FILE_NAME])
+    self.addCleanup(builder.wait)
+    while not os.path.exists(self.venv_dir):
+      time.sleep(0.01)
+    self.assertEqual(
+        self.venv_dir, self.factory._GetOrBuildCachedVirtualenv(self.key))
+    self.mocks['_InstallVirtualenv'].assert_not_called()
+    self.assertTrue(os.path.exists(
+        os.path.join(self.venv_dir, 'built-by-other-process')))
+
+  def testRebuildsInterruptedBuild(self):
+    os.mkdir(self.venv_dir)
+    open(os.path.join(self.venv_dir, 'partial'), 'w').close()
+    expired = time.time() - instance_factory._VENV_CACHE_LEASE_SECONDS - 1
+    os.utime(self.venv_dir, (expired, expired))
+    self.assertEqual(
+        self.venv_dir, self.factory._GetOrBuildCachedVirtualenv(self.key))
+    self.mocks['_InstallVirtualenv'].assert_called_once_with(self.venv_dir)
+    self.assertFalse(os.path.exists(os.path.join(self.venv_dir, 'partial')))
+    self.assertEqual([self.key[:32]], os.listdir(self.cache_dir))
+
+
+class GetServerConcurrencyTest(unittest.TestCase):
+
+  def _GetConcurrency(self, entrypoint, env=None):
+    concurrency = instance_factory._get_server_concurrency(entrypoint,
+                                                           env or {})
+    return concurrency and concurrency[0]
+
+  def testGunicorn(self):
+    self.assertEqual(8, self._GetConcurrency(
+        'exec gunicorn -b :$PORT -w4 --threads=2 main:app'))
+    self.assertEqual(3, self._GetConcurrency('gunicorn main:app',
+                                             {'WEB_CONCURRENCY': '3'}))
+    self.assertEqual(20, self._GetConcurrency(
+        'python -m gunicorn -w 2 -k gevent --worker-connections 10 main:app'))
+
+  def testOtherServers(self):
+    self.assertEqual(6, self._GetConcurrency(
+        'waitress-serve --threads=6 main:app'))
+    self.assertEqual(2 * 5, self._GetConcurrency(
+        'uvicorn main:app --workers 2 --limit-concurrency 5'))
+
+  def testUnknownServer(self):
+    self.assertIsNone(self._GetConcurrency('python main.py'))
+    self.assertIsNone(self._GetConcurrency('gunicorn -w many main:app'))
+    self.assertIsNone(self._GetConcurrency('gunicorn "main:app'))
+
+
+class AdaptiveInstanceTest(unittest.TestCase):
+
+  def _NewInstance(self):
+    proxy = mock.Mock()
+    proxy.handle.return_value = [b'ok']
+    return instance_factory._AdaptiveInstance(None, 0, proxy, 8)
+
+  def testAdaptsLimit(self):
+    inst = self._NewInstance()
+    with mock.patch.object(instance_factory._AdaptiveInstance,
+                           '_Adapt') as adapt:
+      self.assertEqual([b'ok'], list(inst.handle({}, None, None, None, 'r', 0)))
+    adapt.assert_called_once()
+
+  def testResponseClosedEarly(self):
+    inst = self._NewInstance()
+    inst._runtime_proxy.handle.return_value = [b'a', b'b']
+    with mock.patch.object(instance_factory._AdaptiveInstance,
+                           '_Adapt') as adapt:
+      body = inst.handle({}, None, None, None, 'r', 0)
+      self.assertEqual(b'a', next(body))
+      body.close()
+    adapt.assert_called_once()
+    self.assertEqual(0, inst._num_outstanding_requests)
+
+  def testTurnedOffWithoutInstanceAttributes(self):
+    with mock.patch.multiple(
+        instance_factory._AdaptiveInstance,
+        _INSTANCE_ATTRIBUTES=('_condition', '_renamed_by_the_sdk'),
+        _logged_unsupported=False):
+      inst = self._NewInstance()
+      with mock.patch.object(instance_factory._AdaptiveInstance,
+                             '_Adapt') as adapt:
+        self.assertEqual([b'ok'],
+                         list(inst.handle({}, None, None, None, 'r', 0)))
+    adapt.assert_not_called()
+
+
+class PooledRuntimeProxyTest(unittest.TestCase):
+
+  def testRuntimeStoppedWhenWarmupFails(self):
+    proxy = mock.Mock()
+    pooled = instance_factory._PooledRuntimeProxy(proxy, mock.Mock(), 0)
+    with mock.patch.object(instance_factory._PooledRuntimeProxy, '_WarmUp',
+                           side_effect=IOError('warmup failed')), \
+         self.assertLogs():
+      pooled.prestart()
+    self.assertRaises(IOError, pooled.start)
+    pooled.quit()
+    proxy.quit.assert_called_once_with()
+
+  def testRuntimeNotStoppedWhenStartFails(self):
+    proxy = mock.Mock()
+    proxy.start.side_effect = IOError('start failed')
+    pooled = instance_factory._PooledRuntimeProxy(proxy, None, 0)
+    with self.assertLogs():
+      pooled.prestart()
+    pooled.quit()
+    proxy.quit.assert_not_called()
+
+
+class InstancePoolTest(unittest.TestCase):
+
+  def setUp(self):
+    patcher = mock.patch.multiple(
+        Factory, _instance_pool_size=2, _adaptive_concurrency=False,
+        _FillInstancePool=mock.DEFAULT)
+    self.mocks = patcher.start()
+    self.addCleanup(patcher.stop)
+    self.factory = _NewFactory()
+    self.factory._venv_future = None
+    self.factory._next_instance_id = 0
+    self.factory._module_configuration = mock.Mock(module_name='default')
+    self.factory.request_data = None
+    self.factory.max_concurrent_requests = 8
+    self.factory.max_background_threads = 0
+    self.factory._instance_pool = [
+        instance_factory._PooledRuntimeProxy(mock.Mock(), None, instance_id)
+        for instance_id in (0, 1)]
+
+  def testInstanceGetsPooledProxyWithItsId(self):
+    inst = self.factory.new_instance(1)
+    self.assertEqual(1, inst._runtime_proxy.instance_id)
+    inst._runtime_proxy._proxy.set_instance_id.assert_not_called()
+    self.assertEqual([0], [proxy.instance_id
+                           for proxy in self.factory._instance_pool])
+    self.assertEqual(2, self.factory._next_instance_id)
+
+  def testPooledProxyTakesIdOfInstance(self):
+    inst = self.factory.new_instance(7)
+    self.assertEqual(7, inst._runtime_proxy.instance_id)
+    inst._runtime_proxy._proxy.set_instance_id.assert_called_once_with(7)
+
+  def testRefilledOnceAfterSeveralChanges(self):
+    with mock.patch.object(
+        instance_factory, '_INSTANCE_POOL_REFILL_DELAY_SECONDS', 0.05):
+      self.factory.files_changed()
+      self.factory.files_changed()
+      self.assertEqual([], self.factory._instance_pool)
+      time.sleep(0.2)
+    self.mocks['_FillInstancePool'].assert_called_once_with()
+
+
+class SyncVirtualenvTest(unittest.TestCase):
+
+  def setUp(self):
+    patcher = mock.patch.multiple(Factory, _wheelhouse_dir=None,
+                                  _offline=False, _venv_sync_enabled=True)
+    patcher.start()
+    self.addCleanup(patcher.stop)
+    self.app_dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, self.app_dir)
+    self.factory = _NewFactory()
+    self.factory._venv_dir = os.path.join(self.app_dir, 'venv')
+    os.mkdir(self.factory._venv_dir)
+    self.factory._module_configuration = mock.Mock(
+        config_path=os.path.join(self.app_dir, 'app.yaml'),
+        module_name='default')
+    for name, value in (('_GetExtraRequirements', []),
+                        ('_GetPipCommand', ['python', '-m', 'pip']),
+                        ('_GetPipEnv', {})):
+      patcher = mock.patch.object(Factory, name, return_value=value)
+      patcher.start()
+      self.addCleanup(patcher.stop)
+
+  def _Sync(self, old_requirements, new_requirements, installed, check_fails):
+    with open(os.path.join(self.factory._venv_dir,
+                           instance_factory._REQUIREMENTS_SNAPSHOT_FILE_NAME),
+              'w') as f:
+      json.dump(old_requirements, f)
+    with open(os.path.join(self.app_dir, 'requirements.txt'), 'w') as f:
+      f.write('\n'.join(new_requirements) + '\n')
+    commands = []
+    self.pip_out_names = set()
+
+    def run_pip_command(pip_cmd, unused_pip_env, pip_out, *unused_args):
+      self.pip_out_names.add(pip_out.name)
+      commands.append(pip_cmd[3:])
+      return 1 if check_fails and pip_cmd[3:] == ['check'] else 0
+
+    with mock.patch.object(Factory, '_GetInstalledDistributions',
+                           return_value=installed), \
+         mock.patch.object(Factory, '_RunPipCommand',
+                           side_effect=run_pip_command):
+      return self.factory._SyncVirtualenv(), commands
+
+  def testRemovedPinStillNeededRecreatesVirtualenv(self):
+    synced, commands = self._Sync(
+        ['flask', 'werkzeug==2.0.0'], ['flask'],
+        {'flask': '2.0.0', 'werkzeug': '2.0.0'}, check_fails=True)
+    self.assertFalse(synced)
+    self.assertEqual([['uninstall', '-y', 'werkzeug'], ['check']], commands)
+
+  def testPipOutputRemovedWhenSyncFails(self):
+    synced, unused_commands = self._Sync(
+        ['flask', 'werkzeug==2.0.0'], ['flask'],
+        {'flask': '2.0.0', 'werkzeug': '2.0.0'}, check_fails=True)
+    self.assertFalse(synced)
+    self.assertEqual(1, len(self.pip_out_names))
+    self.assertFalse(os.path.exists(self.pip_out_names.pop()))
+
+  def testRemovedProjectUninstalled(self):
+    synced, commands = self._Sync(
+        ['flask', 'requests'], ['flask'],
+        {'flask': '2.0.0', 'requests': '2.31.0'}, check_fails=False)
+    self.assertTrue(synced)
+    self.assertEqual([['uninstall', '-y', 'requests'], ['check']], commands)
+
+
+if __name__ == '__main__':
+  unittest.main()